@@ -0,0 +1,236 @@
+"""Scaling benchmark of block_raster_calculator's tile workers.
+
+Builds a synthetic batch shaped like pollination_pipeline.py's people fed
+scenarios, a coarse yield under a fine pixel area and a pollination
+sufficiency and ag mask per scenario, then times evaluating it with 1 up
+to N tile workers:
+
+    python benchmark_block_raster_calculator.py --n_pixels 8000 \\
+        --n_scenarios 3 --workers 1 2 4 8 --output scaling.json
+
+Each worker count is timed ``--repeat`` times from a fresh target
+directory. Results are written as json with the fixture parameters and
+the platform, and the median of each worker count is printed with its
+speedup and parallel efficiency over 1 worker. Efficiency that falls off
+well before the cores run out means the single writer or the disk has
+become the bound.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from ecoshard import taskgraph
+import numpy
+
+import benchmark_common
+import block_raster_calculator
+
+LOGGER = logging.getLogger(__name__)
+
+BENCHMARK_VERSION = 1
+FIXTURE_ORIGIN = (9.0, 12.0)
+# target pixels per yield pixel on a side, like 5 min yield under 10 s
+YIELD_RATIO = 6
+FLOAT_NODATA = -1.0
+MASK_NODATA = 255
+# a large --n_pixels makes fine rasters over the 4 GB of a classic TIFF
+FIXTURE_CREATION_OPTIONS = ('TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW')
+PEOPLE_FED_EXPRESSION = (
+    'crop_yield*poll_suff*pixel_area*(ag_mask>0)+(ag_mask<1)*-9999')
+
+
+def make_fixtures(fixture_dir, n_pixels, n_scenarios, pixel_size_deg, seed):
+    """Create the synthetic inputs of the benchmark, if they don't exist.
+
+    Args:
+        fixture_dir (str): directory to create them in.
+        n_pixels (int): rows and columns of the fine rasters, a multiple of
+            ``YIELD_RATIO``.
+        n_scenarios (int): scenarios including the baseline.
+        pixel_size_deg (float): pixel size of the fine rasters in degrees.
+        seed (int): seed of the random fields.
+
+    Returns:
+        dictionary of the fixture paths.
+    """
+    fixture = {
+        'yield_path': os.path.join(fixture_dir, 'yield.tif'),
+        'pixel_area_path': os.path.join(fixture_dir, 'pixel_area.tif'),
+        'scenario_list': [
+            (f'sc{scenario_index}',
+             os.path.join(fixture_dir, f'poll_suff_{scenario_index}.tif'),
+             os.path.join(fixture_dir, f'ag_mask_{scenario_index}.tif'))
+            for scenario_index in range(n_scenarios)],
+    }
+    if benchmark_common.fixtures_exist(fixture_dir):
+        return fixture
+    LOGGER.info(f'creating fixtures in {fixture_dir}')
+    os.makedirs(fixture_dir, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    n_coarse = n_pixels // YIELD_RATIO
+    yield_array = rng.uniform(0, 5, (n_coarse, n_coarse)).astype(
+        numpy.float32)
+    yield_array[rng.random(yield_array.shape) < 0.05] = FLOAT_NODATA
+    benchmark_common.write_raster(
+        yield_array, FIXTURE_ORIGIN, pixel_size_deg*YIELD_RATIO,
+        FLOAT_NODATA, fixture['yield_path'],
+        creation_options=FIXTURE_CREATION_OPTIONS)
+    area_row = numpy.cos(numpy.radians(
+        FIXTURE_ORIGIN[1] - (numpy.arange(n_pixels)+0.5)*pixel_size_deg))
+    benchmark_common.write_raster(
+        numpy.repeat(
+            area_row[:, numpy.newaxis]*(pixel_size_deg*111.32)**2*100,
+            n_pixels, axis=1).astype(numpy.float32),
+        FIXTURE_ORIGIN, pixel_size_deg, FLOAT_NODATA,
+        fixture['pixel_area_path'], creation_options=FIXTURE_CREATION_OPTIONS)
+    for _, poll_suff_path, ag_mask_path in fixture['scenario_list']:
+        benchmark_common.write_raster(
+            rng.uniform(0, 1, (n_pixels, n_pixels)).astype(numpy.float32),
+            FIXTURE_ORIGIN, pixel_size_deg, FLOAT_NODATA, poll_suff_path,
+            creation_options=FIXTURE_CREATION_OPTIONS)
+        benchmark_common.write_raster(
+            (rng.random((n_pixels, n_pixels)) < 0.4).astype(numpy.uint8),
+            FIXTURE_ORIGIN, pixel_size_deg, MASK_NODATA, ag_mask_path,
+            creation_options=FIXTURE_CREATION_OPTIONS)
+    benchmark_common.mark_fixtures_done(fixture_dir)
+    return fixture
+
+
+def _bench_n_workers(fixture, run_dir, pixel_size_deg, n_workers):
+    """Seconds to evaluate the scenario batch with ``n_workers``."""
+    calculation_list = [{
+        'expression': PEOPLE_FED_EXPRESSION,
+        'symbol_to_path_map': {
+            'crop_yield': fixture['yield_path'],
+            'poll_suff': poll_suff_path,
+            'pixel_area': fixture['pixel_area_path'],
+            'ag_mask': ag_mask_path,
+        },
+        'target_nodata': -9999,
+        'target_pixel_size': (pixel_size_deg, -pixel_size_deg),
+        'resample_method': 'near',
+        'target_raster_path': os.path.join(
+            run_dir, f'ppl_fed_{scenario_name}.tif'),
+    } for scenario_name, poll_suff_path, ag_mask_path in (
+        fixture['scenario_list'])]
+    # tasks run in this process so it can start the tile workers
+    task_graph = taskgraph.TaskGraph(run_dir, -1)
+    start_time = time.perf_counter()
+    block_raster_calculator.evaluate_calculation_list(
+        calculation_list, task_graph, run_dir, n_workers=n_workers)
+    task_graph.join()
+    elapsed_s = time.perf_counter() - start_time
+    task_graph.close()
+    return elapsed_s
+
+
+def run_benchmarks(fixture, workspace_dir, worker_count_list, args):
+    """Time each worker count ``args.repeat`` times.
+
+    Returns:
+        dictionary mapping each worker count to its ``seconds`` of each
+        repeat, their ``min`` and ``median``, and the ``speedup`` and
+        ``efficiency`` of the median over the first worker count's.
+    """
+    worker_result_map = {}
+    for n_workers in worker_count_list:
+        worker_result = benchmark_common.time_repeats(
+            f'{n_workers} workers', args.repeat,
+            os.path.join(workspace_dir, f'workers_{n_workers}'),
+            args.keep_runs, lambda run_dir: _bench_n_workers(
+                fixture, run_dir, args.pixel_size_deg, n_workers))
+        base_median = worker_result_map.get(
+            worker_count_list[0], worker_result)['median']
+        worker_result['speedup'] = base_median / max(
+            worker_result['median'], 1e-9)
+        worker_result['efficiency'] = worker_result['speedup'] * (
+            worker_count_list[0] / n_workers)
+        worker_result_map[n_workers] = worker_result
+        print(
+            f'{n_workers:4d} workers median {worker_result["median"]:9.3f}s '
+            f'speedup x{worker_result["speedup"]:5.2f} '
+            f'efficiency {worker_result["efficiency"]:5.0%}', flush=True)
+    return worker_result_map
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description=(
+            'benchmark the scaling of the block raster calculator with '
+            'tile workers on synthetic data'))
+    parser.add_argument(
+        '--workspace_dir', default='benchmark_calculator_workspace',
+        help='directory for the fixtures and runs')
+    parser.add_argument(
+        '--n_pixels', type=int, default=6000,
+        help=(
+            f'rows and columns of the fine input rasters, a multiple of '
+            f'{YIELD_RATIO}'))
+    parser.add_argument(
+        '--pixel_size_deg', type=float, default=10/3600,
+        help='pixel size of the fine input rasters in degrees')
+    parser.add_argument(
+        '--n_scenarios', type=int, default=3,
+        help='scenarios in the batch, including the baseline')
+    parser.add_argument(
+        '--workers', type=int, nargs='+',
+        help='worker counts to time, powers of 2 up to the cores by default')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='times to run each count')
+    parser.add_argument('--seed', type=int, default=1, help='fixture seed')
+    parser.add_argument(
+        '--output', default='benchmark_calculator_results.json',
+        help='path to write the json results to')
+    parser.add_argument(
+        '--keep_runs', action='store_true',
+        help='keep the targets of each run')
+    args = parser.parse_args()
+    if args.n_pixels % YIELD_RATIO:
+        parser.error(f'--n_pixels must be a multiple of {YIELD_RATIO}')
+
+    worker_count_list = args.workers
+    if not worker_count_list:
+        worker_count_list = [1]
+        while worker_count_list[-1]*2 <= multiprocessing.cpu_count():
+            worker_count_list.append(worker_count_list[-1]*2)
+        if worker_count_list[-1] != multiprocessing.cpu_count():
+            worker_count_list.append(multiprocessing.cpu_count())
+    fixture_params = {
+        'n_pixels': args.n_pixels,
+        'pixel_size_deg': args.pixel_size_deg,
+        'n_scenarios': args.n_scenarios,
+        'seed': args.seed,
+    }
+    fixture_dir = os.path.join(
+        args.workspace_dir,
+        f'fixtures_{args.n_pixels}_{args.pixel_size_deg:.6f}_'
+        f'{args.n_scenarios}_{args.seed}')
+    fixture = make_fixtures(
+        fixture_dir, args.n_pixels, args.n_scenarios, args.pixel_size_deg,
+        args.seed)
+    worker_result_map = run_benchmarks(
+        fixture, os.path.join(args.workspace_dir, 'runs'), worker_count_list,
+        args)
+    result = {
+        'benchmark_version': BENCHMARK_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'fixture': fixture_params,
+        'repeat': args.repeat,
+        'platform': dict(
+            benchmark_common.platform_info(),
+            numexpr=block_raster_calculator.numexpr is not None),
+        'workers': {
+            str(n_workers): worker_result
+            for n_workers, worker_result in worker_result_map.items()},
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(result, output_file, indent=2)
+    print(f'wrote {args.output}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Helpers shared by the offline benchmarks.
+
+The benchmarks build synthetic fixtures once per set of parameters, time
+each case ``--repeat`` times from a fresh run directory and write json
+results with the platform they ran on:
+
+    fixture = {...}
+    if not benchmark_common.fixtures_exist(fixture_dir):
+        os.makedirs(fixture_dir, exist_ok=True)
+        benchmark_common.write_raster(
+            array, origin, pixel_size_deg, nodata, fixture['dem_path'])
+        benchmark_common.mark_fixtures_done(fixture_dir)
+    case_result = benchmark_common.time_repeats(
+        'case', args.repeat, os.path.join(workspace_dir, 'case'),
+        args.keep_runs, lambda run_dir: bench_case(fixture, run_dir))
+"""
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import time
+
+from osgeo import gdal
+from osgeo import osr
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+FIXTURE_CREATION_OPTIONS = ('TILED=YES', 'COMPRESS=LZW')
+_DONE_TOKEN_BASENAME = 'fixtures.done'
+
+
+def write_raster(
+        array, origin, pixel_size_deg, nodata, target_path,
+        creation_options=FIXTURE_CREATION_OPTIONS):
+    """Write a 2D array as a tiled lat/lng GeoTIFF."""
+    datatype = {
+        numpy.dtype(numpy.uint8): gdal.GDT_Byte,
+        numpy.dtype(numpy.float32): gdal.GDT_Float32,
+    }[array.dtype]
+    raster = gdal.GetDriverByName('GTiff').Create(
+        target_path, array.shape[1], array.shape[0], 1, datatype,
+        options=creation_options)
+    raster.SetProjection(osr.SRS_WKT_WGS84_LAT_LONG)
+    raster.SetGeoTransform(
+        [origin[0], pixel_size_deg, 0, origin[1], 0, -pixel_size_deg])
+    band = raster.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    band = None
+    raster = None
+
+
+def fixtures_exist(fixture_dir):
+    """True if the fixtures in ``fixture_dir`` were all created."""
+    return os.path.exists(os.path.join(fixture_dir, _DONE_TOKEN_BASENAME))
+
+
+def mark_fixtures_done(fixture_dir):
+    """Record that the fixtures in ``fixture_dir`` are complete."""
+    with open(os.path.join(
+            fixture_dir, _DONE_TOKEN_BASENAME), 'w') as done_token_file:
+        done_token_file.write(time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def time_repeats(label, repeat, workspace_dir, keep_runs, bench_func):
+    """Time a benchmark case ``repeat`` times.
+
+    Args:
+        label (str): name of the case in the log.
+        repeat (int): times to run the case.
+        workspace_dir (str): directory of the case's run directories, each
+            repeat gets a fresh one.
+        keep_runs (bool): if False a run directory is removed after its
+            repeat.
+        bench_func (callable): takes a run directory and returns the
+            seconds the case took in it.
+
+    Returns:
+        dictionary with the ``seconds`` of each repeat and their ``min``
+        and ``median``.
+    """
+    seconds_list = []
+    for repeat_index in range(repeat):
+        run_dir = os.path.join(workspace_dir, str(repeat_index))
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        seconds_list.append(bench_func(run_dir))
+        LOGGER.info(
+            f'{label} {repeat_index+1} of {repeat}: '
+            f'{seconds_list[-1]:.3f}s')
+        if not keep_runs:
+            shutil.rmtree(run_dir, ignore_errors=True)
+    return {
+        'seconds': seconds_list,
+        'min': min(seconds_list),
+        'median': statistics.median(seconds_list),
+    }
+
+
+def platform_info():
+    """Dictionary of the platform and library versions of a result."""
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'gdal': gdal.__version__,
+        'numpy': numpy.__version__,
+    }
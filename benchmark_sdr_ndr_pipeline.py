@@ -0,0 +1,585 @@
+"""Offline benchmark of the hot paths of run_ndr_sdr_pipeline.py.
+
+Builds synthetic DEM, erosivity, erodibility, land cover, fertilizer and
+precipitation rasters, a biophysical table and a HydroSHEDS-like grid of
+watershed polygons, then times each stage of the pipeline on them with no
+network access:
+
+    python benchmark_sdr_ndr_pipeline.py --n_pixels 2000 --repeat 5 \\
+        --output after.json --baseline before.json
+
+Each stage is timed ``--repeat`` times from a fresh working directory so
+nothing is reused between repeats. Results are written as json with the
+fixture parameters and the platform, and when a ``--baseline`` result is
+given every stage's median is compared to it. With
+``--fail_on_regression`` the exit status is 1 if any stage got slower than
+the tolerance allows.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+
+from ecoshard import geoprocessing
+from ecoshard import taskgraph
+from osgeo import ogr
+from osgeo import osr
+import numpy
+
+import benchmark_common
+import pipeline_logging
+import pipeline_telemetry
+import run_ndr_sdr_pipeline as pipeline
+
+LOGGER = logging.getLogger(__name__)
+
+BENCHMARK_VERSION = 1
+# longitude and latitude of the upper left corner of the fixtures, in the
+# middle of a UTM zone so the watersheds all project into one
+FIXTURE_ORIGIN = (9.0, 12.0)
+LULC_CODE_LIST = [11, 21, 41, 52, 71, 81, 82]
+LULC_NODATA = 0
+FLOAT_NODATA = -1.0
+WATERSHED_BASENAME = 'bm_bas_15s_beta'
+SDR_RESULT_LIST = [
+    'sed_export.tif', 'sed_retention.tif', 'sed_deposition.tif', 'usle.tif']
+NDR_RESULT_LIST = [
+    'n_export.tif', 'n_retention.tif',
+    os.path.join('intermediate_outputs', 'modified_load_n.tif')]
+STAGE_LIST = [
+    'batch_into_watershed_subsets', 'create_fid_subset', 'warp_raster_stack',
+    'execute_sdr_job', 'execute_ndr_job', 'write_global_grid_piece',
+    'stitch_worker', 'job_logging_file', 'job_logging_listener']
+# records each job of the logging stages logs
+LOG_RECORDS_PER_JOB = 200
+
+
+def _smooth_field(rng, n_pixels, low, high, n_waves=4):
+    """Float32 field between ``low`` and ``high`` made of random waves."""
+    y, x = numpy.mgrid[0:n_pixels, 0:n_pixels] / n_pixels
+    field = numpy.zeros((n_pixels, n_pixels))
+    for _ in range(n_waves):
+        fx, fy = rng.uniform(1, 6, 2)
+        phase_x, phase_y = rng.uniform(0, 2*numpy.pi, 2)
+        field += (
+            numpy.sin(2*numpy.pi*fx*x+phase_x) *
+            numpy.cos(2*numpy.pi*fy*y+phase_y))
+    field = (field-field.min()) / (field.max()-field.min())
+    return (low + field*(high-low)).astype(numpy.float32)
+
+
+def make_fixtures(fixture_dir, n_pixels, n_watersheds, pixel_size_deg, seed):
+    """Create the synthetic inputs of a benchmark, if they don't exist.
+
+    Args:
+        fixture_dir (str): directory to create them in.
+        n_pixels (int): rows and columns of the input rasters.
+        n_watersheds (int): watersheds on a side of the square watershed
+            grid covering the rasters.
+        pixel_size_deg (float): pixel size of the inputs in degrees.
+        seed (int): seed of the random fields.
+
+    Returns:
+        dictionary of the fixture paths and grid.
+    """
+    extent_deg = n_pixels * pixel_size_deg
+    fixture = {
+        'dem_path': os.path.join(fixture_dir, 'dem.tif'),
+        'erosivity_path': os.path.join(fixture_dir, 'erosivity.tif'),
+        'erodibility_path': os.path.join(fixture_dir, 'erodibility.tif'),
+        'lulc_path': os.path.join(fixture_dir, 'lulc.tif'),
+        'fertilizer_path': os.path.join(fixture_dir, 'fertilizer.tif'),
+        'precipitation_path': os.path.join(fixture_dir, 'precipitation.tif'),
+        'biophysical_table_path': os.path.join(
+            fixture_dir, 'biophysical.csv'),
+        'watershed_dir': os.path.join(fixture_dir, 'watersheds'),
+        'watershed_path': os.path.join(
+            fixture_dir, 'watersheds', f'{WATERSHED_BASENAME}.shp'),
+        'wgs84_bb': [
+            FIXTURE_ORIGIN[0], FIXTURE_ORIGIN[1]-extent_deg,
+            FIXTURE_ORIGIN[0]+extent_deg, FIXTURE_ORIGIN[1]],
+    }
+    fixture['epsg'] = geoprocessing.get_utm_zone(
+        FIXTURE_ORIGIN[0]+extent_deg/2, FIXTURE_ORIGIN[1]-extent_deg/2)
+    fixture['job_watershed_path'] = os.path.join(
+        fixture_dir, f'{WATERSHED_BASENAME}_job.gpkg')
+    if benchmark_common.fixtures_exist(fixture_dir):
+        return fixture
+    LOGGER.info(f'creating fixtures in {fixture_dir}')
+    os.makedirs(fixture['watershed_dir'], exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+
+    # a slope down to the south cut by valleys so flow routes into many
+    # outlets, with noise to break up flat areas
+    y, x = numpy.mgrid[0:n_pixels, 0:n_pixels]
+    dem_array = (
+        2000 - 1500*y/n_pixels +
+        80*numpy.abs(numpy.sin(numpy.pi*x*n_watersheds/n_pixels)) +
+        rng.normal(0, 2, (n_pixels, n_pixels))).astype(numpy.float32)
+    benchmark_common.write_raster(
+        dem_array, FIXTURE_ORIGIN, pixel_size_deg, FLOAT_NODATA,
+        fixture['dem_path'])
+    for path_key, low, high in [
+            ('erosivity_path', 500, 8000),
+            ('erodibility_path', 0.01, 0.06),
+            ('fertilizer_path', 0, 150),
+            ('precipitation_path', 200, 2500)]:
+        benchmark_common.write_raster(
+            _smooth_field(rng, n_pixels, low, high), FIXTURE_ORIGIN,
+            pixel_size_deg, FLOAT_NODATA, fixture[path_key])
+
+    # patches of land cover from a coarse random grid
+    patch_size = max(1, n_pixels // 64)
+    n_patches = -(-n_pixels // patch_size)
+    patch_array = rng.choice(
+        numpy.array(LULC_CODE_LIST, dtype=numpy.uint8),
+        (n_patches, n_patches))
+    lulc_array = numpy.repeat(numpy.repeat(
+        patch_array, patch_size, axis=0), patch_size, axis=1)[
+            :n_pixels, :n_pixels]
+    benchmark_common.write_raster(
+        numpy.ascontiguousarray(lulc_array), FIXTURE_ORIGIN, pixel_size_deg,
+        LULC_NODATA, fixture['lulc_path'])
+
+    with open(fixture['biophysical_table_path'], 'w') as table_file:
+        table_file.write(
+            'lucode,usle_c,usle_p,load_n,eff_n,crit_len_n,'
+            'proportion_subsurface_n\n')
+        for lucode in LULC_CODE_LIST:
+            table_file.write(
+                f'{lucode},{rng.uniform(0.001, 0.3):.4f},1,'
+                f'{rng.uniform(1, 30):.2f},{rng.uniform(0.1, 0.8):.2f},'
+                f'150,0\n')
+
+    # square basins in rows and columns like a level of HydroSHEDS
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+    wgs84_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    watershed_vector = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(
+        fixture['watershed_path'])
+    watershed_layer = watershed_vector.CreateLayer(
+        WATERSHED_BASENAME, wgs84_srs, ogr.wkbPolygon)
+    watershed_layer.CreateField(ogr.FieldDefn('BASIN_ID', ogr.OFTInteger))
+    watershed_layer.CreateField(ogr.FieldDefn('UP_AREA', ogr.OFTReal))
+    basin_size_deg = extent_deg / n_watersheds
+    watershed_layer.StartTransaction()
+    for row in range(n_watersheds):
+        for col in range(n_watersheds):
+            x0 = FIXTURE_ORIGIN[0] + col*basin_size_deg
+            y0 = FIXTURE_ORIGIN[1] - row*basin_size_deg
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for point_x, point_y in [
+                    (x0, y0), (x0+basin_size_deg, y0),
+                    (x0+basin_size_deg, y0-basin_size_deg),
+                    (x0, y0-basin_size_deg), (x0, y0)]:
+                ring.AddPoint_2D(point_x, point_y)
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            feature = ogr.Feature(watershed_layer.GetLayerDefn())
+            feature.SetGeometry(polygon)
+            feature.SetField('BASIN_ID', row*n_watersheds+col+1)
+            feature.SetField('UP_AREA', basin_size_deg**2)
+            watershed_layer.CreateFeature(feature)
+    watershed_layer.CommitTransaction()
+    watershed_layer = None
+    watershed_vector = None
+
+    # every basin in one job, the work a large batch of small basins does
+    pipeline._create_fid_subset(
+        fixture['watershed_path'], list(range(n_watersheds**2)),
+        fixture['epsg'], fixture['job_watershed_path'])
+    benchmark_common.mark_fixtures_done(fixture_dir)
+    return fixture
+
+
+def _global_grid(wgs84_bb):
+    """(geotransform, raster_size) of the global pixel grid over a box."""
+    pixel_size = pipeline.GLOBAL_PIXEL_SIZE_DEG
+    n_cols = int(round((wgs84_bb[2]-wgs84_bb[0]) / pixel_size))
+    n_rows = int(round((wgs84_bb[3]-wgs84_bb[1]) / pixel_size))
+    return (
+        [wgs84_bb[0], pixel_size, 0, wgs84_bb[3], 0, -pixel_size],
+        (n_cols, n_rows))
+
+
+def _suffixed(path_list, result_suffix):
+    return [
+        f'%s_{result_suffix}%s' % os.path.splitext(path)
+        for path in path_list]
+
+
+def _bench_batch_into_watershed_subsets(fixture, run_dir, args):
+    watershed_dir = os.path.join(run_dir, 'watersheds')
+    shutil.copytree(fixture['watershed_dir'], watershed_dir)
+    start_time = time.perf_counter()
+    pipeline._batch_into_watershed_subsets(
+        watershed_dir, 4, os.path.join(run_dir, 'batch.token'))
+    return time.perf_counter() - start_time
+
+
+def _bench_create_fid_subset(fixture, run_dir, args):
+    start_time = time.perf_counter()
+    pipeline._create_fid_subset(
+        fixture['watershed_path'], list(range(args.n_watersheds**2)),
+        fixture['epsg'], os.path.join(run_dir, 'subset.gpkg'))
+    return time.perf_counter() - start_time
+
+
+def _bench_warp_raster_stack(fixture, run_dir, args):
+    base_raster_path_list = [
+        fixture['dem_path'], fixture['erosivity_path'],
+        fixture['erodibility_path'], fixture['lulc_path']]
+    warped_raster_path_list = [
+        os.path.join(run_dir, os.path.basename(path))
+        for path in base_raster_path_list]
+    watershed_info = geoprocessing.get_vector_info(
+        fixture['job_watershed_path'])
+    lat_lng_bb = geoprocessing.transform_bounding_box(
+        watershed_info['bounding_box'], watershed_info['projection_wkt'],
+        osr.SRS_WKT_WGS84_LAT_LONG)
+    dem_pixel_size = geoprocessing.get_raster_info(
+        fixture['dem_path'])['pixel_size']
+    start_time = time.perf_counter()
+    task_graph = taskgraph.TaskGraph(run_dir, -1)
+    pipeline._warp_raster_stack(
+        task_graph, base_raster_path_list, warped_raster_path_list,
+        ['bilinear', 'bilinear', 'bilinear', 'mode'], dem_pixel_size,
+        pipeline.TARGET_PIXEL_SIZE_M, lat_lng_bb, osr.SRS_WKT_WGS84_LAT_LONG,
+        fixture['job_watershed_path'])
+    task_graph.join()
+    task_graph.close()
+    return time.perf_counter() - start_time
+
+
+def _bench_execute_sdr_job(fixture, run_dir, args):
+    global_geotransform, global_raster_size = _global_grid(
+        fixture['wgs84_bb'])
+    stitch_queue = queue.Queue()
+    start_time = time.perf_counter()
+    pipeline._execute_sdr_job(
+        fixture['wgs84_bb'], fixture['job_watershed_path'], run_dir,
+        fixture['dem_path'], fixture['erosivity_path'],
+        fixture['erodibility_path'], fixture['lulc_path'],
+        fixture['biophysical_table_path'],
+        pipeline.THRESHOLD_FLOW_ACCUMULATION, pipeline.K_PARAM,
+        pipeline.SDR_MAX, pipeline.IC_0_PARAM, pipeline.TARGET_PIXEL_SIZE_M,
+        'lucode', (global_geotransform, global_raster_size, True), None,
+        stitch_queue, None, _suffixed(SDR_RESULT_LIST, 'bench'), 'bench')
+    elapsed_s = time.perf_counter() - start_time
+    if stitch_queue.get_nowait()[0] is None:
+        raise RuntimeError('the SDR job had nothing to stitch')
+    return elapsed_s
+
+
+def _bench_execute_ndr_job(fixture, run_dir, args):
+    global_geotransform, global_raster_size = _global_grid(
+        fixture['wgs84_bb'])
+    stitch_queue = queue.Queue()
+    start_time = time.perf_counter()
+    pipeline._execute_ndr_job(
+        fixture['wgs84_bb'], fixture['job_watershed_path'], run_dir,
+        fixture['dem_path'], fixture['lulc_path'],
+        fixture['precipitation_path'], fixture['fertilizer_path'],
+        fixture['biophysical_table_path'],
+        pipeline.THRESHOLD_FLOW_ACCUMULATION, pipeline.K_PARAM,
+        pipeline.TARGET_PIXEL_SIZE_M, 'lucode',
+        (global_geotransform, global_raster_size, True), None, stitch_queue,
+        None, _suffixed(NDR_RESULT_LIST, 'bench'), 'bench')
+    elapsed_s = time.perf_counter() - start_time
+    if stitch_queue.get_nowait()[0] is None:
+        raise RuntimeError('the NDR job had nothing to stitch')
+    return elapsed_s
+
+
+def _make_job_results(fixture, run_dir, n_jobs):
+    """Local result rasters of ``n_jobs`` jobs tiling the fixture extent.
+
+    Returns:
+        list of (job_dir, result_path, wgs84_bb) of each job.
+    """
+    n_side = int(numpy.ceil(numpy.sqrt(n_jobs)))
+    bb = fixture['wgs84_bb']
+    job_size_deg = (bb[2]-bb[0]) / n_side
+    # results are at about the resolution the models run at
+    n_job_pixels = max(2, int(
+        job_size_deg*111000 / pipeline.TARGET_PIXEL_SIZE_M))
+    rng = numpy.random.default_rng(n_jobs)
+    job_list = []
+    for job_index in range(n_jobs):
+        row, col = divmod(job_index, n_side)
+        job_bb = [
+            bb[0]+col*job_size_deg, bb[3]-(row+1)*job_size_deg,
+            bb[0]+(col+1)*job_size_deg, bb[3]-row*job_size_deg]
+        job_dir = os.path.join(run_dir, f'job_{job_index}')
+        os.makedirs(job_dir, exist_ok=True)
+        result_path = os.path.join(job_dir, 'result.tif')
+        benchmark_common.write_raster(
+            rng.uniform(0, 10, (n_job_pixels, n_job_pixels)).astype(
+                numpy.float32),
+            (job_bb[0], job_bb[3]), job_size_deg/n_job_pixels, FLOAT_NODATA,
+            result_path)
+        job_list.append((job_dir, result_path, job_bb))
+    return job_list
+
+
+def _bench_write_global_grid_piece(fixture, run_dir, args):
+    global_geotransform, global_raster_size = _global_grid(
+        fixture['wgs84_bb'])
+    job_list = _make_job_results(fixture, run_dir, args.n_stitch_jobs)
+    start_time = time.perf_counter()
+    for job_dir, result_path, _ in job_list:
+        pipeline._write_global_grid_piece(
+            [result_path]*len(SDR_RESULT_LIST), global_geotransform,
+            global_raster_size, os.path.join(job_dir, 'piece.tif'))
+    return time.perf_counter() - start_time
+
+
+def _bench_stitch_worker(fixture, run_dir, args):
+    global_geotransform, global_raster_size = _global_grid(
+        fixture['wgs84_bb'])
+    job_list = _make_job_results(fixture, run_dir, args.n_stitch_jobs)
+    stitch_queue = queue.Queue()
+    for job_dir, result_path, _ in job_list:
+        piece_path = os.path.join(job_dir, 'piece.tif')
+        pipeline._write_global_grid_piece(
+            [result_path]*len(SDR_RESULT_LIST), global_geotransform,
+            global_raster_size, piece_path)
+        stitch_queue.put(
+            (piece_path, job_dir, pipeline_telemetry.COMPLETED))
+    stitch_queue.put(None)
+    _, global_stitch_raster_path_list = (
+        pipeline._create_global_stitch_rasters(
+            {path: os.path.join(run_dir, f'global_{path}')
+             for path in SDR_RESULT_LIST},
+            fixture['wgs84_bb'], 'bench', None))
+    signal_done_queue = queue.Queue()
+    start_time = time.perf_counter()
+    pipeline.stitch_worker(
+        stitch_queue, global_stitch_raster_path_list, len(job_list),
+        signal_done_queue,
+        {job_dir: job_bb for job_dir, _, job_bb in job_list})
+    return time.perf_counter() - start_time
+
+
+def _log_job(job_index, job_log_dir):
+    """Log a job's worth of records the way a pipeline job would."""
+    job_logger = logging.getLogger(f'{__name__}.job')
+    with pipeline_logging.captured_job_log(f'job_{job_index}', job_log_dir):
+        for record_index in range(LOG_RECORDS_PER_JOB):
+            job_logger.info(
+                'job %d record %d of %d', job_index, record_index,
+                LOG_RECORDS_PER_JOB)
+
+
+def _bench_job_logging(run_dir, n_jobs, use_listener):
+    """Time ``n_jobs`` jobs logging from a pool of forked workers.
+
+    The workers share a log file as they do without ``--log_listener`` or
+    send their records to a ``LogListener``, the time includes writing
+    every record.
+    """
+    log_path = os.path.join(run_dir, 'bench.log')
+    root_logger = logging.getLogger()
+    root_handler_list = list(root_logger.handlers)
+    for handler in root_handler_list:
+        root_logger.removeHandler(handler)
+    log_listener = None
+    try:
+        start_time = time.perf_counter()
+        if use_listener:
+            log_listener = pipeline_logging.LogListener(log_path)
+            log_listener.start()
+        else:
+            file_handler = logging.FileHandler(log_path)
+            file_handler.setFormatter(
+                logging.Formatter(pipeline_logging.DEFAULT_LOG_FORMAT))
+            root_logger.addHandler(file_handler)
+        with multiprocessing.get_context('fork').Pool(
+                multiprocessing.cpu_count()) as pool:
+            pool.starmap(
+                _log_job, [(job_index, run_dir) for job_index in range(
+                    n_jobs)])
+            pool.close()
+            pool.join()
+        if log_listener is not None:
+            log_listener.stop()
+        elapsed_s = time.perf_counter() - start_time
+    finally:
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+            handler.close()
+        for handler in root_handler_list:
+            root_logger.addHandler(handler)
+    with open(log_path, 'r') as log_file:
+        n_lines = sum(1 for _ in log_file)
+    if n_lines < n_jobs*LOG_RECORDS_PER_JOB:
+        raise RuntimeError(
+            f'expected {n_jobs*LOG_RECORDS_PER_JOB} log lines but got '
+            f'{n_lines}')
+    return elapsed_s
+
+
+def _bench_job_logging_file(fixture, run_dir, args):
+    return _bench_job_logging(run_dir, args.n_stitch_jobs, False)
+
+
+def _bench_job_logging_listener(fixture, run_dir, args):
+    return _bench_job_logging(run_dir, args.n_stitch_jobs, True)
+
+
+_STAGE_FUNCTION_MAP = {
+    'batch_into_watershed_subsets': _bench_batch_into_watershed_subsets,
+    'create_fid_subset': _bench_create_fid_subset,
+    'warp_raster_stack': _bench_warp_raster_stack,
+    'execute_sdr_job': _bench_execute_sdr_job,
+    'execute_ndr_job': _bench_execute_ndr_job,
+    'write_global_grid_piece': _bench_write_global_grid_piece,
+    'stitch_worker': _bench_stitch_worker,
+    'job_logging_file': _bench_job_logging_file,
+    'job_logging_listener': _bench_job_logging_listener,
+}
+
+
+def run_benchmarks(fixture, workspace_dir, stage_list, args):
+    """Time each stage ``args.repeat`` times.
+
+    Returns:
+        dictionary mapping each stage to its ``seconds`` of each repeat and
+        their ``min`` and ``median``.
+    """
+    stage_result_map = {}
+    for stage in stage_list:
+        stage_result_map[stage] = benchmark_common.time_repeats(
+            stage, args.repeat, os.path.join(workspace_dir, stage),
+            args.keep_runs,
+            lambda run_dir: _STAGE_FUNCTION_MAP[stage](
+                fixture, run_dir, args))
+        print(
+            f'{stage:32s} median {stage_result_map[stage]["median"]:9.3f}s '
+            f'min {stage_result_map[stage]["min"]:9.3f}s', flush=True)
+    return stage_result_map
+
+
+def compare_to_baseline(result, baseline, tolerance):
+    """Compare the stage medians of two benchmark results.
+
+    Args:
+        result (dict): benchmark result.
+        baseline (dict): earlier benchmark result to compare to.
+        tolerance (float): a stage whose median is more than this fraction
+            slower than the baseline's is a regression.
+
+    Returns:
+        (report_line_list, regression_stage_list) tuple.
+    """
+    report_line_list = []
+    regression_stage_list = []
+    if baseline.get('fixture') != result['fixture']:
+        report_line_list.append(
+            f'warning: baseline fixture {baseline.get("fixture")} is not '
+            f'{result["fixture"]}')
+    for stage, stage_result in result['stages'].items():
+        baseline_stage = baseline.get('stages', {}).get(stage)
+        if baseline_stage is None:
+            report_line_list.append(f'{stage:32s} not in baseline')
+            continue
+        ratio = stage_result['median'] / max(baseline_stage['median'], 1e-9)
+        status = ''
+        if ratio > 1 + tolerance:
+            status = 'REGRESSION'
+            regression_stage_list.append(stage)
+        elif ratio < 1 - tolerance:
+            status = 'faster'
+        report_line_list.append(
+            f'{stage:32s} {baseline_stage["median"]:9.3f}s -> '
+            f'{stage_result["median"]:9.3f}s  x{ratio:5.2f} {status}')
+    return report_line_list, regression_stage_list
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='benchmark the SDR/NDR pipeline on synthetic data')
+    parser.add_argument(
+        '--workspace_dir', default='benchmark_workspace',
+        help='directory for the fixtures and runs')
+    parser.add_argument(
+        '--n_pixels', type=int, default=1000,
+        help='rows and columns of the synthetic input rasters')
+    parser.add_argument(
+        '--pixel_size_deg', type=float, default=3/3600,
+        help='pixel size of the synthetic input rasters in degrees')
+    parser.add_argument(
+        '--n_watersheds', type=int, default=8,
+        help='watersheds on a side of the synthetic watershed grid')
+    parser.add_argument(
+        '--n_stitch_jobs', type=int, default=64,
+        help='jobs the stitch and logging stages run')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='times to run each stage')
+    parser.add_argument('--seed', type=int, default=1, help='fixture seed')
+    parser.add_argument(
+        '--stages', nargs='+', choices=STAGE_LIST, default=STAGE_LIST,
+        help='stages to time, all by default')
+    parser.add_argument(
+        '--output', default='benchmark_results.json',
+        help='path to write the json results to')
+    parser.add_argument(
+        '--baseline', help='path to earlier json results to compare to')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='fraction a stage may be slower than the baseline')
+    parser.add_argument(
+        '--fail_on_regression', action='store_true',
+        help='exit with status 1 if a stage regressed')
+    parser.add_argument(
+        '--keep_runs', action='store_true',
+        help='keep the working directory of each run')
+    args = parser.parse_args()
+
+    fixture_params = {
+        'n_pixels': args.n_pixels,
+        'pixel_size_deg': args.pixel_size_deg,
+        'n_watersheds': args.n_watersheds,
+        'n_stitch_jobs': args.n_stitch_jobs,
+        'seed': args.seed,
+    }
+    fixture_dir = os.path.join(
+        args.workspace_dir,
+        f'fixtures_{args.n_pixels}_{args.pixel_size_deg:.6f}_'
+        f'{args.n_watersheds}_{args.seed}')
+    fixture = make_fixtures(
+        fixture_dir, args.n_pixels, args.n_watersheds, args.pixel_size_deg,
+        args.seed)
+    stage_result_map = run_benchmarks(
+        fixture, os.path.join(args.workspace_dir, 'runs'), args.stages, args)
+    result = {
+        'benchmark_version': BENCHMARK_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'fixture': fixture_params,
+        'repeat': args.repeat,
+        'platform': benchmark_common.platform_info(),
+        'stages': stage_result_map,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(result, output_file, indent=2)
+    print(f'wrote {args.output}', flush=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        report_line_list, regression_stage_list = compare_to_baseline(
+            result, baseline, args.tolerance)
+        print(f'compared to {args.baseline}:', flush=True)
+        print('\n'.join(report_line_list), flush=True)
+        if regression_stage_list and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1102 @@
+"""Blockwise evaluation of raster calculator expressions.
+
+A calculation is the dictionary the pollination scripts hand to
+``evaluate_calculation``:
+
+    {
+        'expression': 'raster1*raster2*raster3*(raster4>0)+(raster4<1)*-9999',
+        'symbol_to_path_map': {'raster1': 'yield.tif', ...},
+        'target_nodata': -9999,
+        'target_pixel_size': (0.0027777777777777778, -0.0027777777777777778),
+        'resample_method': 'near',
+        'target_raster_path': 'ppl_fed.tif',
+    }
+
+The target grid has the target pixel size over the intersection of the
+inputs' bounding boxes and the target is written a block at a time. An
+input whose pixels line up with the target grid is read in place, one
+coarser by a whole number of target pixels, such as a 10 km yield under a
+300 m target with ``near`` resampling, is read at its own resolution for
+each block and its pixels repeated in memory, so no resampled copy of it
+is ever written. Only the other inputs are aligned to disk first.
+``evaluate_calculation_list`` does this for calculations that land on the
+same grid together, reading each block of their inputs once for all of
+their targets, and can total each target by zones such as countries as
+the blocks are written. With ``n_workers`` the blocks of a grid are split
+between a pool of tile worker processes while this process stays the one
+writer of the targets.
+
+The expression is compiled once into a kernel that takes every input
+block and writes the result block into a preallocated buffer, so no
+operator makes a temporary array. With numexpr installed the whole
+expression, nodata mask included, is one fused numexpr program that
+streams the block through in cache sized chunks. Without it the
+expression tree is evaluated with numpy ufuncs into a fixed set of block
+buffers that are reused for every block.
+
+A target pixel is ``target_nodata`` if any input the expression uses is
+within ``numpy.isclose`` tolerance of its nodata, or is NaN if its nodata
+is NaN. Otherwise it's the expression evaluated in float64, with NaN and
+infinite results replaced by the calculation's ``default_nan`` and
+``default_inf`` if they're given.
+"""
+import ast
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+from osgeo import ogr
+import numpy
+
+try:
+    import numexpr
+except ImportError:
+    # the numpy ufunc kernel is used instead
+    numexpr = None
+
+LOGGER = logging.getLogger(__name__)
+
+# most pixels of a block of the target evaluated at once
+BLOCK_PIXELS = 2**20
+# numpy.isclose defaults, the tolerance an input is treated as nodata within
+NODATA_RTOL = 1e-05
+NODATA_ATOL = 1e-08
+DEFAULT_TARGET_DATATYPE = gdal.GDT_Float32
+TARGET_CREATION_OPTIONS = (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'BLOCKXSIZE=256',
+    'BLOCKYSIZE=256')
+# metadata items of a ``rasterize_zones`` raster
+ZONE_ID_LIST_METADATA = 'zone_id_list'
+ZONE_ID_FIELD_METADATA = 'zone_id_field'
+
+_BIN_OP_MAP = {
+    ast.Add: (numpy.add, '+'),
+    ast.Sub: (numpy.subtract, '-'),
+    ast.Mult: (numpy.multiply, '*'),
+    ast.Div: (numpy.true_divide, '/'),
+    ast.Pow: (numpy.power, '**'),
+    ast.BitAnd: (numpy.logical_and, '&'),
+    ast.BitOr: (numpy.logical_or, '|'),
+}
+_COMPARE_OP_MAP = {
+    ast.Gt: (numpy.greater, '>'),
+    ast.GtE: (numpy.greater_equal, '>='),
+    ast.Lt: (numpy.less, '<'),
+    ast.LtE: (numpy.less_equal, '<='),
+    ast.Eq: (numpy.equal, '=='),
+    ast.NotEq: (numpy.not_equal, '!='),
+}
+_FUNCTION_MAP = {
+    'abs': numpy.absolute,
+    'sqrt': numpy.sqrt,
+    'exp': numpy.exp,
+    'log': numpy.log,
+    'log10': numpy.log10,
+    'where': numpy.where,
+}
+
+
+def _check_node(node):
+    """Raise ValueError if ``node`` isn't a supported expression."""
+    if isinstance(node, ast.Expression):
+        _check_node(node.body)
+    elif isinstance(node, ast.BinOp) and type(node.op) in _BIN_OP_MAP:
+        if (isinstance(node.op, ast.Div) and
+                isinstance(node.right, ast.Constant) and
+                node.right.value == 0):
+            raise ValueError(f'"{ast.unparse(node)}" divides by zero')
+        _check_node(node.left)
+        _check_node(node.right)
+    elif isinstance(node, ast.UnaryOp) and isinstance(
+            node.op, (ast.USub, ast.UAdd)):
+        _check_node(node.operand)
+    elif (isinstance(node, ast.Compare) and len(node.ops) == 1 and
+            type(node.ops[0]) in _COMPARE_OP_MAP):
+        _check_node(node.left)
+        _check_node(node.comparators[0])
+    elif (isinstance(node, ast.Call) and
+            isinstance(node.func, ast.Name) and
+            node.func.id in _FUNCTION_MAP and not node.keywords and
+            len(node.args) == (3 if node.func.id == 'where' else 1)):
+        for arg_node in node.args:
+            _check_node(arg_node)
+    elif isinstance(node, ast.Constant) and isinstance(
+            node.value, (int, float)) and not isinstance(node.value, bool):
+        pass
+    elif isinstance(node, ast.Name):
+        pass
+    else:
+        raise ValueError(
+            f'unsupported expression "{ast.unparse(node)}", expected '
+            f'arithmetic, comparisons and {", ".join(_FUNCTION_MAP)} of '
+            f'symbols and numbers')
+
+
+def _to_numexpr(node):
+    """numexpr source of ``node`` with comparisons as 0/1 floats.
+
+    numexpr doesn't do arithmetic on booleans so a comparison used as a
+    number, as in ``raster1*(raster4>0)``, is wrapped in a ``where``.
+    """
+    if isinstance(node, ast.BinOp):
+        op_str = _BIN_OP_MAP[type(node.op)][1]
+        if op_str in ('&', '|'):
+            return (
+                f'where(({_to_numexpr_bool(node.left)}) {op_str} '
+                f'({_to_numexpr_bool(node.right)}), 1.0, 0.0)')
+        return (
+            f'({_to_numexpr(node.left)} {op_str} '
+            f'{_to_numexpr(node.right)})')
+    if isinstance(node, ast.UnaryOp):
+        op_str = '-' if isinstance(node.op, ast.USub) else '+'
+        return f'({op_str}{_to_numexpr(node.operand)})'
+    if isinstance(node, ast.Compare):
+        return f'where({_to_numexpr_bool(node)}, 1.0, 0.0)'
+    if isinstance(node, ast.Call):
+        if node.func.id == 'where':
+            return (
+                f'where({_to_numexpr_bool(node.args[0])}, '
+                f'{_to_numexpr(node.args[1])}, {_to_numexpr(node.args[2])})')
+        return f'{node.func.id}({_to_numexpr(node.args[0])})'
+    if isinstance(node, ast.Constant):
+        return repr(float(node.value))
+    return node.id
+
+
+def _to_numexpr_bool(node):
+    """numexpr source of ``node`` as a boolean, nonzero is True."""
+    if isinstance(node, ast.Compare):
+        return (
+            f'({_to_numexpr(node.left)} '
+            f'{_COMPARE_OP_MAP[type(node.ops[0])][1]} '
+            f'{_to_numexpr(node.comparators[0])})')
+    return f'({_to_numexpr(node)} != 0)'
+
+
+class CompiledExpression:
+    """An expression compiled into a kernel over blocks of its symbols.
+
+    Args:
+        expression (str): arithmetic of symbols and numbers, comparisons
+            are 1 where true and 0 where false.
+        nodata_map (dict): maps a symbol to the nodata value of its raster,
+            or None if it has none.
+        target_nodata (float): value of the target where any input is
+            nodata.
+        default_nan (float): if not None, NaN results are set to this.
+        default_inf (float): if not None, infinite results are set to this.
+        use_numexpr (bool): if False the numpy kernel is used even if
+            numexpr is installed.
+
+    Raises:
+        ValueError if the expression isn't supported or uses a symbol that
+        isn't in ``nodata_map``.
+    """
+
+    def __init__(
+            self, expression, nodata_map, target_nodata, default_nan=None,
+            default_inf=None, use_numexpr=True):
+        self.expression = expression
+        self._tree = ast.parse(expression.strip(), mode='eval')
+        _check_node(self._tree)
+        self.symbol_list = sorted({
+            node.id for node in ast.walk(self._tree)
+            if isinstance(node, ast.Name) and not (
+                node.id in _FUNCTION_MAP)})
+        missing_symbol_set = set(self.symbol_list) - set(nodata_map)
+        if missing_symbol_set:
+            raise ValueError(
+                f'{expression} uses {sorted(missing_symbol_set)} which have '
+                f'no raster')
+        self._nodata_map = {
+            symbol: nodata_map[symbol] for symbol in self.symbol_list}
+        self.target_nodata = target_nodata
+        self.default_nan = default_nan
+        self.default_inf = default_inf
+        self.use_numexpr = use_numexpr and numexpr is not None
+        if self.use_numexpr:
+            self._numexpr_source = _to_numexpr(self._tree.body)
+            invalid_source = self._numexpr_invalid_source()
+            if invalid_source is not None:
+                self._numexpr_source = (
+                    f'where({invalid_source}, {float(target_nodata)!r}, '
+                    f'{self._numexpr_source})')
+            LOGGER.debug(f'compiled {expression} to {self._numexpr_source}')
+        # block buffers of the numpy kernel, reused while the size is the
+        # same
+        self._buffer_list = []
+        self._buffer_shape = None
+
+    def _numexpr_invalid_source(self):
+        """numexpr source that's True where any input is nodata."""
+        term_list = []
+        for symbol, nodata in self._nodata_map.items():
+            if nodata is None:
+                continue
+            if numpy.isnan(nodata):
+                term_list.append(f'({symbol} != {symbol})')
+            else:
+                term_list.append(
+                    f'(abs({symbol} - {float(nodata)!r}) <= '
+                    f'{NODATA_ATOL + NODATA_RTOL*abs(float(nodata))!r})')
+        return ' | '.join(term_list) if term_list else None
+
+    def __call__(self, array_map, out):
+        """Evaluate the expression on one block.
+
+        Args:
+            array_map (dict): maps each symbol to its float64 block.
+            out (numpy.ndarray): float64 array the result is written to,
+                the same shape as the blocks.
+
+        Returns:
+            ``out``
+        """
+        if self.use_numexpr:
+            numexpr.evaluate(
+                self._numexpr_source, local_dict=array_map, out=out,
+                casting='unsafe')
+        else:
+            self._evaluate_numpy(array_map, out)
+        if self.default_nan is not None:
+            numpy.copyto(out, self.default_nan, where=numpy.isnan(out))
+        if self.default_inf is not None:
+            numpy.copyto(out, self.default_inf, where=numpy.isinf(out))
+        return out
+
+    def _take_buffer(self, buffer_index):
+        while len(self._buffer_list) <= buffer_index:
+            self._buffer_list.append(numpy.empty(self._buffer_shape))
+        return self._buffer_list[buffer_index]
+
+    def _evaluate_node(self, node, array_map, out, next_buffer):
+        """Evaluate ``node`` into ``out``.
+
+        Subexpressions are evaluated into the block buffers from index
+        ``next_buffer`` on, so a tree needs as many buffers as it is deep.
+        """
+        if isinstance(node, ast.Name):
+            numpy.copyto(out, array_map[node.id])
+        elif isinstance(node, ast.Constant):
+            out.fill(node.value)
+        elif isinstance(node, ast.UnaryOp):
+            self._evaluate_node(node.operand, array_map, out, next_buffer)
+            if isinstance(node.op, ast.USub):
+                numpy.negative(out, out=out)
+        elif isinstance(node, ast.Call) and node.func.id == 'where':
+            self._evaluate_node(node.args[0], array_map, out, next_buffer)
+            choice_buffer = self._take_buffer(next_buffer)
+            self._evaluate_node(
+                node.args[2], array_map, choice_buffer, next_buffer+1)
+            condition_buffer = self._take_buffer(next_buffer+1)
+            numpy.not_equal(out, 0, out=condition_buffer)
+            self._evaluate_node(node.args[1], array_map, out, next_buffer+2)
+            numpy.copyto(out, choice_buffer, where=condition_buffer == 0)
+        elif isinstance(node, ast.Call):
+            self._evaluate_node(node.args[0], array_map, out, next_buffer)
+            _FUNCTION_MAP[node.func.id](out, out=out)
+        else:
+            if isinstance(node, ast.Compare):
+                left_node, right_node = node.left, node.comparators[0]
+                ufunc = _COMPARE_OP_MAP[type(node.ops[0])][0]
+            else:
+                left_node, right_node = node.left, node.right
+                ufunc = _BIN_OP_MAP[type(node.op)][0]
+            self._evaluate_node(left_node, array_map, out, next_buffer)
+            if isinstance(right_node, ast.Constant):
+                right_operand = float(right_node.value)
+            elif isinstance(right_node, ast.Name):
+                right_operand = array_map[right_node.id]
+            else:
+                right_operand = self._take_buffer(next_buffer)
+                self._evaluate_node(
+                    right_node, array_map, right_operand, next_buffer+1)
+            # comparisons write 0/1 straight into the float block
+            ufunc(out, right_operand, out=out, casting='unsafe')
+
+    def _evaluate_numpy(self, array_map, out):
+        if self._buffer_shape != out.shape:
+            self._buffer_list = []
+            self._buffer_shape = out.shape
+        with numpy.errstate(all='ignore'):
+            self._evaluate_node(self._tree.body, array_map, out, 0)
+        invalid_mask = None
+        for symbol, nodata in self._nodata_map.items():
+            if nodata is None:
+                continue
+            if numpy.isnan(nodata):
+                symbol_invalid_mask = numpy.isnan(array_map[symbol])
+            else:
+                symbol_invalid_mask = numpy.isclose(
+                    array_map[symbol], nodata, rtol=NODATA_RTOL,
+                    atol=NODATA_ATOL)
+            if invalid_mask is None:
+                invalid_mask = symbol_invalid_mask
+            else:
+                invalid_mask |= symbol_invalid_mask
+        if invalid_mask is not None:
+            out[invalid_mask] = self.target_nodata
+
+
+def block_window_list(raster_size, block_size):
+    """Windows of about ``BLOCK_PIXELS`` that follow the raster's blocks.
+
+    Windows are whole rows of blocks when a row of blocks fits, so a
+    striped GeoTIFF's strips are each decoded once, otherwise they're
+    squares of whole blocks.
+
+    Args:
+        raster_size (tuple): (n_cols, n_rows) of the raster.
+        block_size (tuple): (block_xsize, block_ysize) of its first band.
+
+    Returns:
+        list of (xoff, yoff, win_xsize, win_ysize).
+    """
+    n_cols, n_rows = raster_size
+    block_xsize, block_ysize = block_size
+    if n_cols * block_ysize <= BLOCK_PIXELS:
+        win_xsize = n_cols
+        win_ysize = max(
+            block_ysize, BLOCK_PIXELS // n_cols // block_ysize * block_ysize)
+    else:
+        side_blocks = max(1, int(
+            numpy.sqrt(BLOCK_PIXELS / (block_xsize*block_ysize))))
+        win_xsize = min(n_cols, side_blocks * block_xsize)
+        win_ysize = side_blocks * block_ysize
+    return [
+        (xoff, yoff, min(win_xsize, n_cols-xoff), min(win_ysize, n_rows-yoff))
+        for yoff in range(0, n_rows, win_ysize)
+        for xoff in range(0, n_cols, win_xsize)]
+
+
+def _create_target(target_grid, target_raster_path, target_datatype,
+                   target_nodata):
+    """Create a GeoTIFF on ``target_grid``, return it and its band."""
+    projection_wkt, geotransform, (n_cols, n_rows) = target_grid
+    target_raster = gdal.GetDriverByName('GTiff').Create(
+        target_raster_path, n_cols, n_rows, 1, target_datatype,
+        options=TARGET_CREATION_OPTIONS)
+    target_raster.SetProjection(projection_wkt)
+    target_raster.SetGeoTransform(list(geotransform))
+    target_band = target_raster.GetRasterBand(1)
+    target_band.SetNoDataValue(target_nodata)
+    return target_raster, target_band
+
+
+def _read_block(band, input_window, xoff, yoff, win_xsize, win_ysize,
+                target_array):
+    """Read a window of the target grid from an input into ``target_array``.
+
+    An input coarser than the target by a whole number of pixels is read at
+    its own resolution and each of its pixels repeated over the target
+    pixels it covers, the same as a nearest neighbor resampling.
+
+    Args:
+        band (gdal.Band): band of the input.
+        input_window (tuple): (x_ratio, y_ratio, col_shift, row_shift) of
+            the input, see ``_input_window``.
+        xoff, yoff, win_xsize, win_ysize (int): window on the target grid.
+        target_array (numpy.ndarray): float64 array of the window's shape.
+
+    Returns:
+        ``target_array``
+    """
+    x_ratio, y_ratio, col_shift, row_shift = input_window
+    xoff += col_shift
+    yoff += row_shift
+    if x_ratio == 1 and y_ratio == 1:
+        return band.ReadAsArray(
+            xoff, yoff, win_xsize, win_ysize, buf_obj=target_array)
+    col_index = numpy.arange(xoff, xoff+win_xsize) // x_ratio
+    row_index = numpy.arange(yoff, yoff+win_ysize) // y_ratio
+    coarse_array = band.ReadAsArray(
+        int(col_index[0]), int(row_index[0]),
+        int(col_index[-1]-col_index[0]+1),
+        int(row_index[-1]-row_index[0]+1)).astype(numpy.float64)
+    # only the rows are expanded before the result is taken into place
+    numpy.take(
+        coarse_array.take(row_index-row_index[0], axis=0),
+        col_index-col_index[0], axis=1, out=target_array)
+    return target_array
+
+
+def rasterize_zones(
+        zone_vector_path, zone_id_field, target_grid, target_raster_path):
+    """Rasterize the zone of each pixel of ``target_grid``.
+
+    Pixel values are zone codes, 0 outside every zone and ``i`` for the
+    zone id at index ``i-1`` of the json list in the ``zone_id_list``
+    metadata item. Features that share an id share a code.
+
+    Args:
+        zone_vector_path (str): path to a polygon vector.
+        zone_id_field (str): field with the id of each feature's zone.
+        target_grid (tuple): (projection_wkt, geotransform, raster_size) of
+            the raster to create.
+        target_raster_path (str): path to the GeoTIFF to create.
+
+    Returns:
+        None
+    """
+    vector = gdal.OpenEx(zone_vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    zone_vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    zone_layer = zone_vector.CreateLayer(
+        'zones', layer.GetSpatialRef(), ogr.wkbUnknown)
+    zone_layer.CreateField(ogr.FieldDefn('zone_code', ogr.OFTInteger))
+    zone_code_map = {}
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        zone_id = str(feature.GetField(zone_id_field))
+        zone_code = zone_code_map.setdefault(zone_id, len(zone_code_map)+1)
+        zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+        zone_feature.SetGeometry(geom.Clone())
+        zone_feature.SetField('zone_code', zone_code)
+        zone_layer.CreateFeature(zone_feature)
+    zone_feature = None
+    feature = None
+    layer = None
+    vector = None
+
+    working_path = '%s_working%s' % os.path.splitext(target_raster_path)
+    target_raster, _ = _create_target(
+        target_grid, working_path, gdal.GDT_Int32, 0)
+    target_raster.SetMetadataItem(
+        ZONE_ID_LIST_METADATA, json.dumps(list(zone_code_map)))
+    target_raster.SetMetadataItem(ZONE_ID_FIELD_METADATA, zone_id_field)
+    gdal.RasterizeLayer(
+        target_raster, [1], zone_layer, options=['ATTRIBUTE=zone_code'])
+    zone_layer = None
+    zone_vector = None
+    target_raster = None
+    os.replace(working_path, target_raster_path)
+
+
+def _write_zone_table(
+        zone_table_path, zone_id_field, zone_id_list, count_array,
+        sum_array):
+    """Write the count and sum of the valid pixels of each zone."""
+    working_path = f'{zone_table_path}_working'
+    with open(working_path, 'w') as table_file:
+        table_file.write(f'{zone_id_field},count,sum\n')
+        for zone_id, count, value_sum in sorted(zip(
+                zone_id_list, count_array[1:].tolist(),
+                sum_array[1:].tolist())):
+            if count:
+                table_file.write(f'{zone_id},{count},{value_sum!r}\n')
+    os.replace(working_path, zone_table_path)
+
+
+class _BlockEvaluator:
+    """Evaluate expressions on windows of their target grid.
+
+    The inputs are opened and the expressions compiled once, then every
+    window is read into the same buffers. Tile workers each build their
+    own from the same arguments.
+    """
+
+    def __init__(
+            self, expression_list, target_grid, input_window_map,
+            zone_raster_path):
+        """Open the inputs of ``expression_list``.
+
+        Args are those of ``evaluate_expression_list``.
+        """
+        self.expression_list = expression_list
+        self._raster_map = {}
+        self._band_map = {}
+        self.compiled_expression_list = []
+        for expression in expression_list:
+            nodata_map = {}
+            for symbol, path in expression['symbol_to_path_map'].items():
+                if path not in self._band_map:
+                    self._raster_map[path] = gdal.OpenEx(
+                        path, gdal.OF_RASTER)
+                    self._band_map[path] = self._raster_map[
+                        path].GetRasterBand(1)
+                nodata_map[symbol] = self._band_map[path].GetNoDataValue()
+            self.compiled_expression_list.append(CompiledExpression(
+                expression['expression'], nodata_map,
+                expression['target_nodata'],
+                expression.get('default_nan'),
+                expression.get('default_inf')))
+        # only the inputs the expressions use are read
+        self.path_list = sorted({
+            expression['symbol_to_path_map'][symbol]
+            for expression, compiled_expression in zip(
+                expression_list, self.compiled_expression_list)
+            for symbol in compiled_expression.symbol_list})
+        if target_grid is None:
+            base_raster = self._raster_map[self.path_list[0]]
+            target_grid = (
+                base_raster.GetProjection(), base_raster.GetGeoTransform(),
+                (base_raster.RasterXSize, base_raster.RasterYSize))
+        self.target_grid = target_grid
+        self.input_window_map = input_window_map or {}
+        raster_size = tuple(target_grid[2])
+        for path in self.path_list:
+            if path not in self.input_window_map and (
+                    self._raster_map[path].RasterXSize,
+                    self._raster_map[path].RasterYSize) != raster_size:
+                raise ValueError(
+                    f'{path} is not the {raster_size} size of the target '
+                    f'grid')
+        # windows follow the blocks of an input on the grid if there is one
+        self.block_size = None
+        for path in self.path_list:
+            if path not in self.input_window_map:
+                self.block_size = self._band_map[path].GetBlockSize()
+                break
+
+        self._zone_raster = None
+        self._zone_band = None
+        self.zone_index_list = []
+        if zone_raster_path is not None:
+            self._zone_raster = gdal.OpenEx(zone_raster_path, gdal.OF_RASTER)
+            self._zone_band = self._zone_raster.GetRasterBand(1)
+            self.zone_id_list = json.loads(
+                self._zone_raster.GetMetadataItem(ZONE_ID_LIST_METADATA))
+            self.zone_id_field = self._zone_raster.GetMetadataItem(
+                ZONE_ID_FIELD_METADATA)
+            self.zone_index_list = [
+                index for index, expression in enumerate(expression_list)
+                if expression.get('zone_table_path')]
+            # code 0 is outside every zone
+            self.zone_count_array = numpy.zeros(
+                (len(expression_list), len(self.zone_id_list)+1),
+                dtype=numpy.int64)
+            self.zone_sum_array = numpy.zeros(
+                (len(expression_list), len(self.zone_id_list)+1))
+        self._buffer_pixels = 0
+
+    def _allocate(self, n_pixels):
+        """Grow the buffers to hold ``n_pixels``."""
+        if n_pixels <= self._buffer_pixels:
+            return
+        self._buffer_pixels = n_pixels
+        # GDAL converts to float64 as it reads into these
+        self._flat_buffer_map = {
+            path: numpy.empty(n_pixels) for path in self.path_list}
+        self._flat_out = numpy.empty(n_pixels)
+        self._flat_zone_buffer = numpy.empty(n_pixels, dtype=numpy.int32)
+
+    def evaluate(self, window, write_fn):
+        """Evaluate every expression on ``window``.
+
+        Args:
+            window (tuple): (xoff, yoff, win_xsize, win_ysize) on the
+                target grid.
+            write_fn (callable): called with the index of each expression
+                and its result, which is overwritten by the next one.
+
+        Returns:
+            None
+        """
+        xoff, yoff, win_xsize, win_ysize = window
+        n_pixels = win_xsize*win_ysize
+        self._allocate(n_pixels)
+        block_map = {
+            path: _read_block(
+                self._band_map[path],
+                self.input_window_map.get(path, (1, 1, 0, 0)),
+                xoff, yoff, win_xsize, win_ysize,
+                self._flat_buffer_map[path][:n_pixels].reshape(
+                    win_ysize, win_xsize))
+            for path in self.path_list}
+        out = self._flat_out[:n_pixels].reshape(win_ysize, win_xsize)
+        if self._zone_band is not None:
+            zone_array = self._zone_band.ReadAsArray(
+                xoff, yoff, win_xsize, win_ysize,
+                buf_obj=self._flat_zone_buffer[:n_pixels].reshape(
+                    win_ysize, win_xsize))
+        for index, (expression, compiled_expression) in enumerate(zip(
+                self.expression_list, self.compiled_expression_list)):
+            compiled_expression({
+                symbol: block_map[expression['symbol_to_path_map'][symbol]]
+                for symbol in compiled_expression.symbol_list}, out)
+            write_fn(index, out)
+            if index in self.zone_index_list:
+                valid_mask = numpy.isfinite(out) & (
+                    out != expression['target_nodata'])
+                zone_code_array = zone_array[valid_mask]
+                self.zone_count_array[index] += numpy.bincount(
+                    zone_code_array, minlength=len(self.zone_id_list)+1)
+                self.zone_sum_array[index] += numpy.bincount(
+                    zone_code_array, weights=out[valid_mask],
+                    minlength=len(self.zone_id_list)+1)
+
+    def write_zone_tables(self):
+        """Write the zone totals of the expressions that have a table."""
+        for index in self.zone_index_list:
+            _write_zone_table(
+                self.expression_list[index]['zone_table_path'],
+                self.zone_id_field, self.zone_id_list,
+                self.zone_count_array[index], self.zone_sum_array[index])
+
+    def close(self):
+        """Close the inputs."""
+        self._zone_band = None
+        self._zone_raster = None
+        self._band_map = None
+        self._raster_map = None
+
+
+# the evaluator of a tile worker process, set by ``_init_tile_worker``
+_tile_evaluator = None
+
+
+def _init_tile_worker(evaluator_args):
+    global _tile_evaluator
+    _tile_evaluator = _BlockEvaluator(*evaluator_args)
+
+
+def _evaluate_tile(window):
+    """Evaluate a window in a tile worker.
+
+    Returns:
+        (out_list, zone_count_array, zone_sum_array) where ``out_list`` is
+        the result of each expression and the zone arrays, None if there
+        are no zones, are the window's zone totals.
+    """
+    # float32 targets come back as float32, they'd be written as it anyway
+    dtype_list = [
+        numpy.float32 if expression.get(
+            'target_datatype', DEFAULT_TARGET_DATATYPE) == gdal.GDT_Float32
+        else numpy.float64
+        for expression in _tile_evaluator.expression_list]
+    out_list = []
+    if _tile_evaluator.zone_index_list:
+        _tile_evaluator.zone_count_array[:] = 0
+        _tile_evaluator.zone_sum_array[:] = 0
+    _tile_evaluator.evaluate(
+        window, lambda index, out: out_list.append(
+            out.astype(dtype_list[index])))
+    if not _tile_evaluator.zone_index_list:
+        return out_list, None, None
+    return (
+        out_list, _tile_evaluator.zone_count_array,
+        _tile_evaluator.zone_sum_array)
+
+
+def evaluate_expression_list(
+        expression_list, target_grid=None, input_window_map=None,
+        zone_raster_path=None, n_workers=1):
+    """Evaluate expressions over rasters on one grid in a single pass.
+
+    Every block of each input is read once and every expression that uses
+    it is evaluated on it before the next block is read, so inputs shared
+    by expressions are only read and decoded once.
+
+    With ``n_workers`` above 1 the blocks are evaluated as tiles by a pool
+    of worker processes that each open the inputs themselves. Their results
+    come back to this process, which writes them in block order as the
+    only writer of the targets, at most ``2*n_workers`` tiles ahead.
+
+    Args:
+        expression_list (list): dictionaries with the keys
+            ``expression``: expression of the symbols, see
+                ``CompiledExpression``.
+            ``symbol_to_path_map``: maps each symbol to a single band
+                raster.
+            ``target_nodata``: nodata of the target.
+            ``target_raster_path``: path to the GeoTIFF to create on
+                ``target_grid``.
+            ``target_datatype`` (optional): GDAL type of the target.
+            ``default_nan``, ``default_inf`` (optional): values NaN and
+                infinite results are set to.
+            ``zone_table_path`` (optional): if given with
+                ``zone_raster_path``, the csv to write the pixel count and
+                sum of the target's valid pixels in each zone to.
+        target_grid (tuple): (projection_wkt, geotransform, raster_size) of
+            the targets. If None it's the grid of the first input and every
+            input must be on it.
+        input_window_map (dict): maps an input path to its
+            ``_input_window`` on ``target_grid``, inputs that aren't in it
+            must be on ``target_grid``.
+        zone_raster_path (str): if not None, a ``rasterize_zones`` raster
+            on ``target_grid`` to total the targets by as they're written.
+        n_workers (int): tile worker processes, the blocks are evaluated
+            in this process if it's 1. A daemonic process, such as a
+            taskgraph worker, can't start workers and evaluates them itself.
+
+    Returns:
+        None
+    """
+    evaluator = _BlockEvaluator(
+        expression_list, target_grid, input_window_map, zone_raster_path)
+    working_path_list = [
+        '%s_working%s' % os.path.splitext(expression['target_raster_path'])
+        for expression in expression_list]
+    target_band_list = []
+    target_raster_list = []
+    for expression, working_path in zip(expression_list, working_path_list):
+        target_raster, target_band = _create_target(
+            evaluator.target_grid, working_path,
+            expression.get('target_datatype', DEFAULT_TARGET_DATATYPE),
+            expression['target_nodata'])
+        target_raster_list.append(target_raster)
+        target_band_list.append(target_band)
+    window_list = block_window_list(
+        tuple(evaluator.target_grid[2]),
+        evaluator.block_size or target_band_list[0].GetBlockSize())
+
+    if n_workers > 1 and multiprocessing.current_process().daemon:
+        LOGGER.warning(
+            f'evaluating {len(window_list)} blocks in this process, a '
+            f'daemonic process can\'t start {n_workers} tile workers')
+        n_workers = 1
+    LOGGER.info(
+        f'evaluating {len(expression_list)} expressions of '
+        f'{len(evaluator.path_list)} inputs, '
+        f'{len(evaluator.input_window_map)} of them read in place, in '
+        f'{len(window_list)} blocks with {n_workers} workers')
+    if n_workers <= 1:
+        for window in window_list:
+            evaluator.evaluate(
+                window, lambda index, out: target_band_list[index].WriteArray(
+                    out, xoff=window[0], yoff=window[1]))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                n_workers, initializer=_init_tile_worker,
+                initargs=((
+                    expression_list, evaluator.target_grid,
+                    evaluator.input_window_map, zone_raster_path),)
+                ) as executor:
+            pending_tile_list = collections.deque()
+            for window_index, window in enumerate(window_list):
+                pending_tile_list.append(
+                    (window, executor.submit(_evaluate_tile, window)))
+                # write the oldest tile, in order, once enough are queued
+                # to keep the workers busy while this process writes
+                while pending_tile_list and (
+                        len(pending_tile_list) >= 2*n_workers or
+                        window_index == len(window_list)-1):
+                    tile_window, tile_future = pending_tile_list.popleft()
+                    out_list, zone_count_array, zone_sum_array = (
+                        tile_future.result())
+                    for target_band, out in zip(target_band_list, out_list):
+                        target_band.WriteArray(
+                            out, xoff=tile_window[0], yoff=tile_window[1])
+                    if zone_count_array is not None:
+                        evaluator.zone_count_array += zone_count_array
+                        evaluator.zone_sum_array += zone_sum_array
+    evaluator.write_zone_tables()
+    evaluator.close()
+    target_band_list = None
+    target_raster_list = None
+    for expression, working_path in zip(expression_list, working_path_list):
+        os.replace(working_path, expression['target_raster_path'])
+
+
+def evaluate_expression_rasters(
+        expression, symbol_to_path_map, target_nodata, target_raster_path,
+        target_datatype=DEFAULT_TARGET_DATATYPE, default_nan=None,
+        default_inf=None):
+    """Evaluate ``expression`` over rasters that are on the same grid.
+
+    Args:
+        expression (str): expression of the symbols, see
+            ``CompiledExpression``.
+        symbol_to_path_map (dict): maps each symbol to a single band raster,
+            all of the same size.
+        target_nodata (float): nodata of the target.
+        target_raster_path (str): path to the GeoTIFF to create, on the grid
+            of the inputs.
+        target_datatype (int): GDAL type of the target.
+        default_nan (float): if not None, NaN results are set to this.
+        default_inf (float): if not None, infinite results are set to this.
+
+    Returns:
+        None
+    """
+    evaluate_expression_list([{
+        'expression': expression,
+        'symbol_to_path_map': symbol_to_path_map,
+        'target_nodata': target_nodata,
+        'target_raster_path': target_raster_path,
+        'target_datatype': target_datatype,
+        'default_nan': default_nan,
+        'default_inf': default_inf,
+    }])
+
+
+def _target_pixel_size(calculation, info_map):
+    """Pixel size of the target, the finest input's if it's not given."""
+    if calculation.get('target_pixel_size') is not None:
+        return tuple(calculation['target_pixel_size'])
+    return min(
+        (info_map[path]['pixel_size']
+         for path in calculation['symbol_to_path_map'].values()),
+        key=lambda pixel_size: abs(pixel_size[0]))
+
+
+def _grid_key(calculation, info_map):
+    """Calculations with the same key are aligned to the same grid."""
+    bounding_box_mode = calculation.get('bounding_box_mode', 'intersection')
+    return (
+        _target_pixel_size(calculation, info_map),
+        calculation.get('resample_method', 'near'), bounding_box_mode,
+        tuple(geoprocessing.merge_bounding_box_list(
+            [info_map[path]['bounding_box']
+             for path in sorted(set(
+                calculation['symbol_to_path_map'].values()))],
+            bounding_box_mode)))
+
+
+def _pixel_count(extent, pixel_size):
+    """Pixels over ``extent``, rounded up unless it's within float error.
+
+    This is how ``geoprocessing.warp_raster`` sizes its target.
+    """
+    n_pixels = int(abs(extent / pixel_size))
+    if not numpy.isclose(abs(n_pixels*pixel_size) - abs(extent), 0.0):
+        n_pixels += 1
+    return n_pixels
+
+
+def _whole_number(value):
+    """``value`` as an int if it's within float error of one, else None."""
+    if numpy.isclose(value, round(value), rtol=0, atol=1e-6):
+        return int(round(value))
+    return None
+
+
+def _input_window(info, target_grid, resample_method):
+    """How an input is read on the target grid, or None if it can't be.
+
+    An input can be read without aligning it if its pixels line up with the
+    target's and it covers the target. With ``near`` resampling it can
+    also be coarser by a whole number of target pixels, each of its pixels
+    is then repeated over the target pixels it covers.
+
+    Returns:
+        (x_ratio, y_ratio, col_shift, row_shift) where the ratios are the
+        number of target pixels per input pixel and the shifts are the
+        target pixel offset of the target grid's origin from the input's,
+        or None if the input has to be aligned.
+    """
+    projection_wkt, geotransform, (n_cols, n_rows) = target_grid
+    if info['projection_wkt'] != projection_wkt:
+        return None
+    input_geotransform = info['geotransform']
+    x_ratio = _whole_number(input_geotransform[1] / geotransform[1])
+    y_ratio = _whole_number(input_geotransform[5] / geotransform[5])
+    col_shift = _whole_number(
+        (geotransform[0]-input_geotransform[0]) / geotransform[1])
+    row_shift = _whole_number(
+        (geotransform[3]-input_geotransform[3]) / geotransform[5])
+    if None in (x_ratio, y_ratio, col_shift, row_shift):
+        return None
+    if (x_ratio, y_ratio) != (1, 1) and resample_method != 'near':
+        return None
+    input_n_cols, input_n_rows = info['raster_size']
+    if (x_ratio < 1 or y_ratio < 1 or col_shift < 0 or row_shift < 0 or
+            col_shift+n_cols > input_n_cols*x_ratio or
+            row_shift+n_rows > input_n_rows*y_ratio):
+        return None
+    return x_ratio, y_ratio, col_shift, row_shift
+
+
+def _plan_group_inputs(calculation_list, info_map, workspace_dir):
+    """How the inputs of calculations with one ``_grid_key`` are read.
+
+    Returns:
+        (target_grid, input_window_map, aligned_path_map) where
+        ``target_grid`` is the (projection_wkt, geotransform, raster_size)
+        of the targets, ``input_window_map`` maps the inputs read as they
+        are to their ``_input_window`` and ``aligned_path_map`` maps the
+        rest to the path they're aligned to.
+    """
+    path_list = sorted({
+        path for calculation in calculation_list
+        for path in calculation['symbol_to_path_map'].values()})
+    target_pixel_size, resample_method, bounding_box_mode, target_bb = (
+        _grid_key(calculation_list[0], info_map))
+    target_grid = (
+        info_map[path_list[0]]['projection_wkt'],
+        (target_bb[0], target_pixel_size[0], 0.0, target_bb[3], 0.0,
+         target_pixel_size[1]),
+        (_pixel_count(target_bb[2]-target_bb[0], target_pixel_size[0]),
+         _pixel_count(target_bb[3]-target_bb[1], target_pixel_size[1])))
+    input_window_map = {}
+    for path in path_list:
+        input_window = _input_window(
+            info_map[path], target_grid, resample_method)
+        if input_window is not None:
+            input_window_map[path] = input_window
+    align_path_list = [
+        path for path in path_list if path not in input_window_map]
+    calculation_key = hashlib.blake2b(
+        repr([
+            align_path_list, target_pixel_size, resample_method,
+            target_bb]).encode('utf-8'), digest_size=8).hexdigest()
+    align_dir = os.path.join(workspace_dir, f'aligned_{calculation_key}')
+    aligned_path_map = {
+        path: os.path.join(align_dir, f'{index}_{os.path.basename(path)}')
+        for index, path in enumerate(align_path_list)}
+    return target_grid, input_window_map, aligned_path_map
+
+
+def zone_table_path(target_raster_path, zone_id_field):
+    """Path of the zone totals table of a calculation's target."""
+    return f'{os.path.splitext(target_raster_path)[0]}_by_{zone_id_field}.csv'
+
+
+def evaluate_calculation_list(
+        calculation_list, task_graph, workspace_dir, zone_info=None,
+        n_workers=1):
+    """Schedule calculations, those on the same grid in one pass.
+
+    Calculations with the same target pixel size, resampling, bounding box
+    mode and bounding box of their inputs have the same target grid. Their
+    inputs are aligned together once and they're evaluated by a single
+    ``evaluate_expression_list`` task, so an input several of them share is
+    read once for all of them. Inputs whose pixels already line up with the
+    target grid, including coarser ones read with ``near`` resampling, are
+    read in place rather than aligned, see ``_input_window``.
+
+    Args:
+        calculation_list (list): calculations as described in
+            ``evaluate_calculation``.
+        task_graph (taskgraph.TaskGraph): graph to add the tasks to.
+        workspace_dir (str): directory for the aligned inputs.
+        zone_info (tuple): if not None, (zone_vector_path, zone_id_field)
+            of zones, such as countries, to total each target by as it's
+            written, to the ``zone_table_path`` of the target.
+        n_workers (int): tile worker processes each group's task evaluates
+            its blocks with, see ``evaluate_expression_list``. Use it with
+            a ``task_graph`` that runs tasks in this process, its own
+            workers are daemonic and can't start the tile workers.
+
+    Returns:
+        list of the task that writes the target of each calculation.
+    """
+    info_map = {
+        path: geoprocessing.get_raster_info(path)
+        for path in {
+            path for calculation in calculation_list
+            for path in calculation['symbol_to_path_map'].values()}}
+    group_map = collections.defaultdict(list)
+    for calculation_index, calculation in enumerate(calculation_list):
+        group_map[_grid_key(calculation, info_map)].append(calculation_index)
+
+    task_list = [None] * len(calculation_list)
+    for calculation_index_list in group_map.values():
+        group_list = [
+            calculation_list[index] for index in calculation_index_list]
+        target_grid, input_window_map, aligned_path_map = (
+            _plan_group_inputs(group_list, info_map, workspace_dir))
+        target_path_list = [
+            calculation['target_raster_path'] for calculation in group_list]
+        dependent_task_list = []
+        zone_raster_path = None
+        if zone_info is not None:
+            zone_vector_path, zone_id_field = zone_info
+            zone_key = hashlib.blake2b(
+                repr([zone_vector_path, zone_id_field, target_grid]).encode(
+                    'utf-8'), digest_size=8).hexdigest()
+            zone_raster_path = os.path.join(
+                workspace_dir, f'zones_{zone_key}.tif')
+            dependent_task_list.append(task_graph.add_task(
+                func=rasterize_zones,
+                args=(
+                    zone_vector_path, zone_id_field, target_grid,
+                    zone_raster_path),
+                target_path_list=[zone_raster_path],
+                task_name=f'rasterize {zone_id_field} zones'))
+        if aligned_path_map:
+            base_path_list = sorted(aligned_path_map)
+            aligned_path_list = [
+                aligned_path_map[path] for path in base_path_list]
+            os.makedirs(os.path.dirname(aligned_path_list[0]), exist_ok=True)
+            LOGGER.info(
+                f'aligning {len(base_path_list)} inputs of '
+                f'{", ".join(target_path_list)}, reading '
+                f'{len(input_window_map)} in place')
+            dependent_task_list.append(task_graph.add_task(
+                func=geoprocessing.align_and_resize_raster_stack,
+                args=(
+                    base_path_list, aligned_path_list,
+                    [group_list[0].get('resample_method', 'near')] * len(
+                        base_path_list),
+                    target_grid[1][1::4],
+                    # the bounding box of every input, not just these
+                    list(_grid_key(group_list[0], info_map)[3])),
+                target_path_list=aligned_path_list,
+                task_name=f'align inputs of {", ".join(target_path_list)}'))
+        expression_list = [{
+            'expression': calculation['expression'],
+            'symbol_to_path_map': {
+                symbol: aligned_path_map.get(path, path)
+                for symbol, path in (
+                    calculation['symbol_to_path_map'].items())},
+            'target_nodata': calculation['target_nodata'],
+            'target_raster_path': calculation['target_raster_path'],
+            'target_datatype': calculation.get(
+                'target_datatype', DEFAULT_TARGET_DATATYPE),
+            'default_nan': calculation.get('default_nan'),
+            'default_inf': calculation.get('default_inf'),
+        } for calculation in group_list]
+        if zone_raster_path is not None:
+            for expression in expression_list:
+                expression['zone_table_path'] = zone_table_path(
+                    expression['target_raster_path'], zone_id_field)
+        group_task = task_graph.add_task(
+            func=evaluate_expression_list,
+            args=(
+                expression_list, target_grid, input_window_map,
+                zone_raster_path, n_workers),
+            target_path_list=target_path_list + [
+                expression['zone_table_path']
+                for expression in expression_list
+                if 'zone_table_path' in expression],
+            dependent_task_list=dependent_task_list,
+            task_name=f'calculate {", ".join(target_path_list)}')
+        for index in calculation_index_list:
+            task_list[index] = group_task
+    return task_list
+
+
+def evaluate_calculation(
+        calculation, task_graph, workspace_dir, zone_info=None,
+        n_workers=1):
+    """Schedule a calculation on ``task_graph``.
+
+    Args:
+        calculation (dict): with the keys
+            ``expression``: expression of the symbols, see
+                ``CompiledExpression``.
+            ``symbol_to_path_map``: maps each symbol to a single band
+                raster.
+            ``target_nodata``: nodata of the target.
+            ``target_raster_path``: path to the target to create.
+            ``target_pixel_size`` (optional): pixel size of the target,
+                the finest of the inputs' if not given.
+            ``resample_method`` (optional): how inputs are resampled to the
+                target pixel size, ``near`` if not given.
+            ``bounding_box_mode`` (optional): ``intersection``, the
+                default, or ``union`` of the inputs.
+            ``target_datatype`` (optional): GDAL type of the target,
+                ``gdal.GDT_Float32`` if not given.
+            ``default_nan``, ``default_inf`` (optional): values NaN and
+                infinite results are replaced by.
+        task_graph (taskgraph.TaskGraph): graph to add the tasks to.
+        workspace_dir (str): directory for the aligned inputs.
+        zone_info (tuple): if not None, (zone_vector_path, zone_id_field)
+            to total the target by, see ``evaluate_calculation_list``.
+        n_workers (int): tile worker processes, see
+            ``evaluate_calculation_list``.
+
+    Returns:
+        the task that writes the target.
+    """
+    return evaluate_calculation_list(
+        [calculation], task_graph, workspace_dir, zone_info, n_workers)[0]
@@ -0,0 +1,413 @@
+"""Find the watershed jobs whose inputs differ between two runs.
+
+A scenario that only changes a small part of the world, such as a land
+cover conversion where a crop is grown, gives the same results as its
+baseline everywhere else. Rasters are compared block by block through
+hashes of their pixels, the hashes are cached so a baseline is only read
+once however many scenarios are compared to it, and the wgs84 bounding
+boxes of the blocks that differ select the jobs to rerun:
+
+    changed_bb_array = changed_wgs84_bb_array(
+        [(baseline_lulc_path, scenario_lulc_path)], cache_dir)
+    job_id_set = changed_job_set(job_footprint_map, changed_bb_array)
+
+``clone_file`` copies the baseline's global outputs to start the scenario
+from, copy-on-write where the filesystem supports it.
+
+A revised biophysical table only changes the results of the watersheds
+that contain the land cover codes whose rows changed. The codes in each
+job's watersheds are counted once per land cover raster and cached:
+
+    lucode_index = lucode_histogram_index(
+        lulc_path, job_footprint_map, cache_dir)
+    job_id_set = lucode_job_set(lucode_index, changed_lucode_set(
+        read_lucode_table(old_table_path, 'lucode'),
+        read_lucode_table(new_table_path, 'lucode')))
+"""
+import collections
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+from osgeo import osr
+import numpy
+
+try:
+    import fcntl
+except ImportError:
+    # not on windows, files are always copied there
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+# pixels on a side of the blocks compared
+BLOCK_SIZE = 1024
+# rows of land cover read at once when counting codes
+_HISTOGRAM_STRIP_ROWS = 1024
+# linux ioctl that shares the extents of one file with another
+_FICLONE = 0x40049409
+
+
+def file_hash(path):
+    """Hex digest of the bytes of the file at ``path``."""
+    file_hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as hash_file:
+        for chunk in iter(lambda: hash_file.read(2**20), b''):
+            file_hasher.update(chunk)
+    return file_hasher.hexdigest()
+
+
+def _block_window_list(raster_size, block_size):
+    """(xoff, yoff, win_xsize, win_ysize) of each block, row major."""
+    n_cols, n_rows = raster_size
+    return [
+        (xoff, yoff, min(block_size, n_cols-xoff),
+         min(block_size, n_rows-yoff))
+        for yoff in range(0, n_rows, block_size)
+        for xoff in range(0, n_cols, block_size)]
+
+
+def _file_cache_key(path, *extra_list):
+    """Digest that changes when the file at ``path`` or ``extra_list`` do."""
+    path_stat = os.stat(path)
+    return hashlib.blake2b(
+        ':'.join([
+            os.path.abspath(path), str(path_stat.st_size),
+            str(path_stat.st_mtime_ns)] + [
+                str(extra) for extra in extra_list]).encode('utf-8'),
+        digest_size=16).hexdigest()
+
+
+def _write_json(payload, target_path):
+    """Write ``payload`` to ``target_path`` as json, replacing it whole."""
+    os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+    working_path = f'{target_path}_working'
+    with open(working_path, 'w') as working_file:
+        json.dump(payload, working_file)
+    os.replace(working_path, target_path)
+
+
+def raster_block_hashes(raster_path, block_size=BLOCK_SIZE, cache_dir=None):
+    """Hash every block of a raster.
+
+    Args:
+        raster_path (str): path to a raster.
+        block_size (int): pixels on a side of each block.
+        cache_dir (str): if not None, the hashes are cached here by path,
+            size and modification time of the raster.
+
+    Returns:
+        dictionary with the raster's ``grid`` (raster size, geotransform,
+        projection, datatype and nodata of each band) and the hex digest of
+        each block in ``hashes``, in the order of ``_block_window_list``.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_key = _file_cache_key(raster_path, block_size)
+        cache_path = os.path.join(
+            cache_dir,
+            f'{os.path.basename(os.path.splitext(raster_path)[0])}_'
+            f'{cache_key}_block_hashes.json')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as cache_file:
+                return json.load(cache_file)
+
+    raster_info = geoprocessing.get_raster_info(raster_path)
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band_list = [
+        raster.GetRasterBand(band_id+1)
+        for band_id in range(raster.RasterCount)]
+    LOGGER.info(f'hashing blocks of {raster_path}')
+    hash_list = []
+    for xoff, yoff, win_xsize, win_ysize in _block_window_list(
+            raster_info['raster_size'], block_size):
+        block_hasher = hashlib.blake2b(digest_size=16)
+        for band in band_list:
+            block_hasher.update(band.ReadAsArray(
+                xoff, yoff, win_xsize, win_ysize).tobytes())
+        hash_list.append(block_hasher.hexdigest())
+    band_list = None
+    raster = None
+    block_hashes = {
+        'grid': {
+            'raster_size': list(raster_info['raster_size']),
+            'geotransform': list(raster_info['geotransform']),
+            'projection_wkt': raster_info['projection_wkt'],
+            'datatype': raster_info['datatype'],
+            'nodata': list(raster_info['nodata']),
+        },
+        'block_size': block_size,
+        'hashes': hash_list,
+    }
+    if cache_path is not None:
+        _write_json(block_hashes, cache_path)
+    return block_hashes
+
+
+def _is_raster(path):
+    return gdal.OpenEx(path, gdal.OF_RASTER) is not None
+
+
+def changed_wgs84_bb_array(
+        input_pair_list, cache_dir=None, block_size=BLOCK_SIZE):
+    """Bounding boxes of the blocks that differ between input pairs.
+
+    Args:
+        input_pair_list (list): (baseline_path, scenario_path) tuples of the
+            inputs that may differ. Rasters on the same grid are compared
+            block by block, anything else as a whole file.
+        cache_dir (str): if not None, block hashes are cached here.
+        block_size (int): pixels on a side of each block compared.
+
+    Returns:
+        (n, 4) float array of the lat/lng bounding boxes of the blocks that
+        differ, or None if a pair can't be compared block by block and
+        differs, meaning every job has to be rerun.
+    """
+    bb_list = []
+    for baseline_path, scenario_path in input_pair_list:
+        if os.path.abspath(baseline_path) == os.path.abspath(scenario_path):
+            continue
+        if not (_is_raster(baseline_path) and _is_raster(scenario_path)):
+            if file_hash(baseline_path) != file_hash(scenario_path):
+                LOGGER.info(
+                    f'{scenario_path} differs from {baseline_path}, '
+                    f'everything changed')
+                return None
+            continue
+        baseline_hashes = raster_block_hashes(
+            baseline_path, block_size, cache_dir)
+        scenario_hashes = raster_block_hashes(
+            scenario_path, block_size, cache_dir)
+        if baseline_hashes['grid'] != scenario_hashes['grid']:
+            LOGGER.info(
+                f'{scenario_path} is not on the grid of {baseline_path}, '
+                f'everything changed')
+            return None
+        grid = scenario_hashes['grid']
+        gt = grid['geotransform']
+        n_changed = 0
+        for (xoff, yoff, win_xsize, win_ysize), baseline_hash, \
+                scenario_hash in zip(
+                    _block_window_list(grid['raster_size'], block_size),
+                    baseline_hashes['hashes'], scenario_hashes['hashes']):
+            if baseline_hash == scenario_hash:
+                continue
+            n_changed += 1
+            x_list = [gt[0]+xoff*gt[1], gt[0]+(xoff+win_xsize)*gt[1]]
+            y_list = [gt[3]+yoff*gt[5], gt[3]+(yoff+win_ysize)*gt[5]]
+            bb_list.append(geoprocessing.transform_bounding_box(
+                [min(x_list), min(y_list), max(x_list), max(y_list)],
+                grid['projection_wkt'], osr.SRS_WKT_WGS84_LAT_LONG))
+        LOGGER.info(
+            f'{n_changed} of {len(scenario_hashes["hashes"])} blocks of '
+            f'{scenario_path} differ from {baseline_path}')
+    return numpy.array(bb_list, dtype=numpy.float64).reshape((-1, 4))
+
+
+def changed_job_set(job_footprint_map, changed_bb_array):
+    """Jobs whose footprint intersects a changed block.
+
+    Args:
+        job_footprint_map (dict): maps job id to the lat/lng bounding box of
+            its watersheds.
+        changed_bb_array (numpy.ndarray): bounding boxes returned by
+            ``changed_wgs84_bb_array``, if None every job is changed.
+
+    Returns:
+        set of job ids to rerun.
+    """
+    if changed_bb_array is None:
+        return set(job_footprint_map)
+    job_id_set = set()
+    for job_id, job_bb in job_footprint_map.items():
+        if numpy.any(
+                (changed_bb_array[:, 0] <= job_bb[2]) &
+                (changed_bb_array[:, 2] >= job_bb[0]) &
+                (changed_bb_array[:, 1] <= job_bb[3]) &
+                (changed_bb_array[:, 3] >= job_bb[1])):
+            job_id_set.add(job_id)
+    return job_id_set
+
+
+def _wgs84_bb_pixel_window(wgs84_bb, raster_info):
+    """Window of a raster covering a lat/lng box, or None if outside it."""
+    bb = geoprocessing.transform_bounding_box(
+        wgs84_bb, osr.SRS_WKT_WGS84_LAT_LONG, raster_info['projection_wkt'])
+    gt = raster_info['geotransform']
+    n_cols, n_rows = raster_info['raster_size']
+    x_min = max(0, int(numpy.floor((bb[0]-gt[0])/gt[1])))
+    x_max = min(n_cols, int(numpy.ceil((bb[2]-gt[0])/gt[1])))
+    y_min = max(0, int(numpy.floor((bb[3]-gt[3])/gt[5])))
+    y_max = min(n_rows, int(numpy.ceil((bb[1]-gt[3])/gt[5])))
+    if x_min >= x_max or y_min >= y_max:
+        return None
+    return (x_min, y_min, x_max-x_min, y_max-y_min)
+
+
+def lucode_histogram_index(lulc_path, job_footprint_map, cache_dir=None):
+    """Count the land cover codes under each job's footprint.
+
+    Args:
+        lulc_path (str): path to a single band land cover raster.
+        job_footprint_map (dict): maps job id to the lat/lng bounding box of
+            its watersheds, every pixel in the box is counted.
+        cache_dir (str): if not None, the counts are cached here by path,
+            size and modification time of the raster, and only jobs that
+            aren't cached yet are counted.
+
+    Returns:
+        dictionary mapping each job id to a dictionary of the pixel count of
+        each land cover code, as strings, under its footprint. Nodata isn't
+        counted.
+    """
+    cache_path = None
+    lucode_index = {}
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir,
+            f'{os.path.basename(os.path.splitext(lulc_path)[0])}_'
+            f'{_file_cache_key(lulc_path)}_lucode_index.json')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as cache_file:
+                lucode_index = json.load(cache_file)
+    missing_job_list = [
+        job_id for job_id in job_footprint_map if job_id not in lucode_index]
+    if not missing_job_list:
+        return {job_id: lucode_index[job_id] for job_id in job_footprint_map}
+
+    raster_info = geoprocessing.get_raster_info(lulc_path)
+    nodata = raster_info['nodata'][0]
+    lulc_raster = gdal.OpenEx(lulc_path, gdal.OF_RASTER)
+    lulc_band = lulc_raster.GetRasterBand(1)
+    LOGGER.info(
+        f'counting land cover codes of {len(missing_job_list)} jobs in '
+        f'{lulc_path}')
+    for job_id in missing_job_list:
+        lucode_count_map = collections.Counter()
+        window = _wgs84_bb_pixel_window(job_footprint_map[job_id], raster_info)
+        if window is not None:
+            xoff, yoff, win_xsize, win_ysize = window
+            for strip_yoff in range(
+                    yoff, yoff+win_ysize, _HISTOGRAM_STRIP_ROWS):
+                lulc_array = lulc_band.ReadAsArray(
+                    xoff, strip_yoff, win_xsize,
+                    min(_HISTOGRAM_STRIP_ROWS, yoff+win_ysize-strip_yoff))
+                if nodata is not None:
+                    lulc_array = lulc_array[lulc_array != nodata]
+                lucode_array, count_array = numpy.unique(
+                    lulc_array, return_counts=True)
+                for lucode, count in zip(
+                        lucode_array.tolist(), count_array.tolist()):
+                    lucode_count_map[_lucode_key(lucode)] += count
+        lucode_index[job_id] = dict(lucode_count_map)
+    lulc_band = None
+    lulc_raster = None
+    if cache_path is not None:
+        _write_json(lucode_index, cache_path)
+    return {job_id: lucode_index[job_id] for job_id in job_footprint_map}
+
+
+def _lucode_key(lucode):
+    """Land cover code as the string it's keyed by in indexes and tables."""
+    return str(int(float(lucode)))
+
+
+def read_lucode_table(table_path, lucode_field):
+    """Rows of a biophysical table by land cover code.
+
+    Args:
+        table_path (str): path to a csv table.
+        lucode_field (str): column of the land cover codes, matched without
+            regard to case like the models do.
+
+    Returns:
+        dictionary mapping each code, as a string, to a dictionary of the
+        row's values by lower case column name.
+
+    Raises:
+        ValueError if the table has no ``lucode_field`` column.
+    """
+    with open(table_path, 'r', newline='', encoding='utf-8-sig') as table_file:
+        reader = csv.reader(table_file)
+        header_list = [
+            header.strip().lower() for header in next(reader, [])]
+        if lucode_field.lower() not in header_list:
+            raise ValueError(
+                f'{table_path} has no {lucode_field} column, only '
+                f'{header_list}')
+        lucode_index = header_list.index(lucode_field.lower())
+        lucode_row_map = {}
+        for row in reader:
+            if len(row) <= lucode_index or not row[lucode_index].strip():
+                continue
+            lucode_row_map[_lucode_key(row[lucode_index])] = {
+                header: value.strip()
+                for header, value in zip(header_list, row) if header}
+    return lucode_row_map
+
+
+def changed_lucode_set(base_row_map, new_row_map):
+    """Land cover codes whose rows differ between two tables.
+
+    Args:
+        base_row_map (dict): rows returned by ``read_lucode_table``.
+        new_row_map (dict): rows of the new version of the table.
+
+    Returns:
+        set of codes, as strings, that were added, removed or have any
+        value that differs.
+    """
+    return {
+        lucode for lucode in set(base_row_map) | set(new_row_map)
+        if base_row_map.get(lucode) != new_row_map.get(lucode)}
+
+
+def lucode_job_set(lucode_index, lucode_set):
+    """Jobs with any pixel of the codes in ``lucode_set``.
+
+    Args:
+        lucode_index (dict): index returned by ``lucode_histogram_index``.
+        lucode_set (set): land cover codes as strings.
+
+    Returns:
+        set of job ids.
+    """
+    return {
+        job_id for job_id, lucode_count_map in lucode_index.items()
+        if not lucode_set.isdisjoint(lucode_count_map)}
+
+
+def clone_file(base_path, target_path):
+    """Copy a file, sharing its blocks copy-on-write where possible.
+
+    Uses a reflink on filesystems that support it, such as btrfs or xfs,
+    so a global raster is "copied" instantly and only the blocks later
+    written to take up space. Falls back to a full copy.
+
+    Args:
+        base_path (str): path to the file to copy.
+        target_path (str): path to the copy, replaced when it's complete.
+
+    Returns:
+        None
+    """
+    working_path = f'{target_path}_working'
+    cloned = False
+    if fcntl is not None:
+        try:
+            with open(base_path, 'rb') as base_file, \
+                    open(working_path, 'wb') as target_file:
+                fcntl.ioctl(target_file.fileno(), _FICLONE, base_file.fileno())
+            cloned = True
+        except OSError:
+            # filesystem can't share extents
+            pass
+    if not cloned:
+        shutil.copyfile(base_path, working_path)
+    os.replace(working_path, target_path)
@@ -0,0 +1,367 @@
+"""Logging of the pipeline's processes through one listener.
+
+By default every process that imports the pipeline appends to the same
+log file at DEBUG, which on a shared filesystem means lock contention and
+multi-GB logs. In listener mode records are shipped instead over a local
+socket to a listener thread of the main process, which queues them for a
+single writer:
+
+    listener = LogListener('sdrndrlog.txt', LOG_FORMAT)
+    listener.start()
+    ...
+    listener.stop()
+
+The listener's address is put in the environment so workers that import
+the pipeline later send their records to it, and forked workers find the
+handler they inherited already pointing at it.
+
+Levels are set per subsystem, by logger name, from the defaults the
+pipeline passes to ``setup`` and then ``PIPELINE_LOG_LEVELS``, a comma
+separated list such as ``ecoshard.taskgraph=DEBUG,run_ndr_sdr_pipeline=INFO``
+where ``root`` names the root logger. The root logger is at INFO unless
+it's set there, so DEBUG records of loggers without a level of their own
+aren't written at all.
+
+Two helpers keep the volume down where it's made. ``progress_due`` rate
+limits progress lines that would otherwise be logged on every job, and
+``capture_job_log`` buffers the records of a job in memory and only writes
+them to ``<job id>.log`` in ``PIPELINE_JOB_LOG_DIR`` if the job raises.
+"""
+import collections
+import contextlib
+import functools
+import inspect
+import logging
+import logging.handlers
+import os
+import pickle
+import queue
+import socketserver
+import struct
+import threading
+import time
+import traceback
+
+LOGGER = logging.getLogger(__name__)
+
+LOG_ADDRESS_ENV = 'PIPELINE_LOG_ADDRESS'
+LOG_LEVELS_ENV = 'PIPELINE_LOG_LEVELS'
+JOB_LOG_DIR_ENV = 'PIPELINE_JOB_LOG_DIR'
+DEFAULT_ROOT_LOG_LEVEL = 'INFO'
+# name of the root logger in a level list
+ROOT_LOGGER_NAME = 'root'
+DEFAULT_LOG_FORMAT = (
+    '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
+    ' [%(funcName)s:%(lineno)d] %(message)s')
+DEFAULT_PROGRESS_INTERVAL_S = 30.0
+# seconds a stopping listener waits for senders to close their connections
+LISTENER_DRAIN_TIMEOUT_S = 10.0
+# records of a job kept for its failure log, the oldest are dropped first
+JOB_LOG_MAX_RECORDS = 10000
+
+_log_format = DEFAULT_LOG_FORMAT
+_progress_lock = threading.Lock()
+_progress_time_map = {}
+
+
+class _ListenerClientHandler(logging.handlers.SocketHandler):
+    """Send records to a ``LogListener``, reconnecting in forked workers.
+
+    A forked worker inherits its parent's connection, so it opens its own
+    the first time it logs rather than interleave writes on a shared
+    socket.
+    """
+
+    def __init__(self, host, port):
+        super().__init__(host, port)
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.sock = None
+            self.retryTime = None
+        super().emit(record)
+
+
+def _parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def parse_level_list(level_list):
+    """Parse ``name=LEVEL`` strings into a dictionary of logger levels.
+
+    Args:
+        level_list (list): strings such as ``ecoshard.taskgraph=DEBUG``.
+
+    Returns:
+        dictionary mapping logger name to level name.
+
+    Raises:
+        ValueError if a string isn't ``name=LEVEL`` or the level is unknown.
+    """
+    level_map = {}
+    for level_str in level_list:
+        name, _, level = level_str.strip().partition('=')
+        level = level.strip().upper()
+        if not name or not isinstance(
+                logging.getLevelName(level), int):
+            raise ValueError(
+                f'expected a logger name=LEVEL but got "{level_str}"')
+        level_map[name.strip()] = level
+    return level_map
+
+
+def _env_level_list():
+    return [
+        level_str for level_str in os.environ.get(
+            LOG_LEVELS_ENV, '').split(',') if level_str.strip()]
+
+
+def set_levels(level_map):
+    """Set the level of each logger in ``level_map``."""
+    for name, level in level_map.items():
+        logging.getLogger(
+            None if name == ROOT_LOGGER_NAME else name).setLevel(level)
+
+
+def configure_levels(level_list):
+    """Set logger levels in this process and the workers it starts.
+
+    Args:
+        level_list (list): ``name=LEVEL`` strings, added to any already in
+            ``PIPELINE_LOG_LEVELS``.
+
+    Returns:
+        None
+    """
+    level_map = parse_level_list(level_list)
+    set_levels(level_map)
+    os.environ[LOG_LEVELS_ENV] = ','.join(
+        _env_level_list() +
+        [f'{name}={level}' for name, level in level_map.items()])
+
+
+def setup(log_path, log_format=DEFAULT_LOG_FORMAT, level_map=None):
+    """Configure the root logger of a process that imports the pipeline.
+
+    Records go to the listener in ``PIPELINE_LOG_ADDRESS`` if it's set and
+    are otherwise appended to ``log_path``.
+
+    Args:
+        log_path (str): path to the log file when there's no listener.
+        log_format (str): format of the log lines.
+        level_map (dict): default level of each subsystem's logger, those
+            in ``PIPELINE_LOG_LEVELS`` take precedence. The root logger is
+            at ``DEFAULT_ROOT_LOG_LEVEL`` unless it's in either.
+
+    Returns:
+        None
+    """
+    global _log_format
+    _log_format = log_format
+    address = os.environ.get(LOG_ADDRESS_ENV)
+    if address:
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(
+            _ListenerClientHandler(*_parse_address(address)))
+        root_logger.setLevel(DEFAULT_ROOT_LOG_LEVEL)
+    else:
+        logging.basicConfig(
+            level=DEFAULT_ROOT_LOG_LEVEL, format=log_format,
+            filename=log_path)
+    set_levels(level_map or {})
+    set_levels(parse_level_list(_env_level_list()))
+
+
+class _RecordStreamHandler(socketserver.StreamRequestHandler):
+    """Unpickle the length prefixed records of one ``SocketHandler``."""
+
+    def handle(self):
+        with self.server.connection_condition:
+            self.server.n_connections += 1
+        try:
+            while True:
+                header = self.rfile.read(4)
+                if len(header) < 4:
+                    return
+                payload = self.rfile.read(struct.unpack('>L', header)[0])
+                self.server.record_queue.put(
+                    logging.makeLogRecord(pickle.loads(payload)))
+        finally:
+            with self.server.connection_condition:
+                self.server.n_connections -= 1
+                self.server.connection_condition.notify_all()
+
+
+class _RecordServer(socketserver.ThreadingTCPServer):
+    """Local server of a ``LogListener``, a thread per sending process."""
+
+    daemon_threads = True
+
+    def __init__(self, record_queue):
+        super().__init__(('127.0.0.1', 0), _RecordStreamHandler)
+        self.record_queue = record_queue
+        self.connection_condition = threading.Condition()
+        self.n_connections = 0
+
+
+class LogListener:
+    """Receive the records of every process and write them from one thread.
+
+    ``start`` also points the root logger of this process at the listener
+    and sets ``PIPELINE_LOG_ADDRESS`` for the workers, ``stop`` writes what
+    is still queued and points the root logger back at the log file.
+    """
+
+    def __init__(self, log_path, log_format=DEFAULT_LOG_FORMAT):
+        self.log_path = log_path
+        self._file_handler = logging.FileHandler(log_path)
+        self._file_handler.setFormatter(logging.Formatter(log_format))
+        self._record_queue = queue.SimpleQueue()
+        self._queue_listener = logging.handlers.QueueListener(
+            self._record_queue, self._file_handler)
+        self._server = None
+        self._server_thread = None
+        self.address = None
+
+    def start(self):
+        """Start receiving records and send this process's to the listener."""
+        self._queue_listener.start()
+        self._server = _RecordServer(self._record_queue)
+        host, port = self._server.server_address
+        self.address = f'{host}:{port}'
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True,
+            name='log listener')
+        self._server_thread.start()
+        os.environ[LOG_ADDRESS_ENV] = self.address
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+            handler.close()
+        root_logger.addHandler(_ListenerClientHandler(host, port))
+
+    def stop(self, drain_timeout_s=LISTENER_DRAIN_TIMEOUT_S):
+        """Write the queued records and log straight to the file again.
+
+        Records are read until every sender has closed its connection, so
+        stop the workers first, or wait at most ``drain_timeout_s``.
+        """
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            root_logger.removeHandler(handler)
+            handler.close()
+        os.environ.pop(LOG_ADDRESS_ENV, None)
+        self._server.shutdown()
+        with self._server.connection_condition:
+            self._server.connection_condition.wait_for(
+                lambda: self._server.n_connections == 0, drain_timeout_s)
+        self._server.server_close()
+        self._queue_listener.stop()
+        self._file_handler.close()
+        root_logger.addHandler(logging.FileHandler(self.log_path))
+        root_logger.handlers[0].setFormatter(
+            self._file_handler.formatter)
+
+
+def progress_due(key, interval_s=DEFAULT_PROGRESS_INTERVAL_S):
+    """True at most once every ``interval_s`` seconds for ``key``.
+
+    Use it to gate a progress line logged from a loop, for example once per
+    stitched job, so it's written every ``interval_s`` seconds rather than
+    on every pass.
+    """
+    now = time.monotonic()
+    with _progress_lock:
+        last_time = _progress_time_map.get(key)
+        if last_time is not None and now - last_time < interval_s:
+            return False
+        _progress_time_map[key] = now
+        return True
+
+
+class _JobLogBuffer(logging.Handler):
+    """Keep the records logged by one thread."""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self._thread_id = threading.get_ident()
+        self.record_list = collections.deque(maxlen=JOB_LOG_MAX_RECORDS)
+
+    def emit(self, record):
+        if record.thread == self._thread_id:
+            self.record_list.append(record)
+
+
+@contextlib.contextmanager
+def captured_job_log(job_id, job_log_dir):
+    """Write the block's records to ``<job_id>.log`` only if it raises.
+
+    Args:
+        job_id (str): name of the log file.
+        job_log_dir (str): directory of failed job logs.
+
+    Returns:
+        context manager.
+    """
+    job_log_buffer = _JobLogBuffer()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(job_log_buffer)
+    try:
+        yield
+    except Exception:
+        root_logger.removeHandler(job_log_buffer)
+        # a log that can't be written shouldn't hide the job's error
+        try:
+            os.makedirs(job_log_dir, exist_ok=True)
+            formatter = logging.Formatter(_log_format)
+            job_log_path = os.path.join(
+                job_log_dir, f'{job_id.replace(os.sep, "_")}.log')
+            with open(job_log_path, 'w') as job_log_file:
+                for record in job_log_buffer.record_list:
+                    job_log_file.write(formatter.format(record) + '\n')
+                job_log_file.write(traceback.format_exc())
+            LOGGER.error(f'{job_id} failed, its log is in {job_log_path}')
+        except OSError:
+            LOGGER.exception(f'could not write the failure log of {job_id}')
+        raise
+    finally:
+        root_logger.removeHandler(job_log_buffer)
+
+
+def capture_job_log(job_id_fn):
+    """Decorate a function so each call is a ``captured_job_log``.
+
+    Logs are captured only if ``PIPELINE_JOB_LOG_DIR`` is set.
+
+    Args:
+        job_id_fn (callable): takes the dictionary of the call's arguments
+            by name and returns the call's job id.
+
+    Returns:
+        decorator.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            job_log_dir = os.environ.get(JOB_LOG_DIR_ENV)
+            if not job_log_dir:
+                return func(*args, **kwargs)
+            bound_args = signature.bind(*args, **kwargs)
+            bound_args.apply_defaults()
+            with captured_job_log(
+                    job_id_fn(bound_args.arguments), job_log_dir):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def configure_job_logs(job_log_dir):
+    """Write failed job logs to ``job_log_dir`` here and in the workers."""
+    os.environ[JOB_LOG_DIR_ENV] = job_log_dir
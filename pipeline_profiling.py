@@ -0,0 +1,253 @@
+"""Opt-in profiling of pipeline jobs, inside the taskgraph workers.
+
+Profiling is switched on by environment variables so it reaches the
+worker processes the jobs run in, set them before the task graph starts
+its workers, or call ``configure`` to:
+
+    PIPELINE_PROFILE_DIR        directory the profiles are written to
+    PIPELINE_PROFILE_JOBS       comma separated fnmatch patterns of job ids
+                                to profile deterministically with cProfile
+    PIPELINE_PROFILE_SAMPLE_S   if set, every profiled function is sampled
+                                at this interval in seconds
+
+Functions are hooked with the ``profile_job`` decorator, which names each
+call by a job id such as ``sdr_<watershed subset>_<result suffix>``. A
+selected job writes ``<job id>.prof``, for ``pstats`` or snakeviz, and
+with sampling on every job writes ``<job id>.collapsed``, the stacks seen
+by a thread that samples the job's thread. The sampler only reads one
+stack per interval, unlike cProfile's hook on every call, so it can be
+left on for a whole run. Merge the collapsed stacks of a run into one file
+for flamegraph.pl or speedscope with:
+
+    python pipeline_profiling.py merge workspace/profiles run.collapsed
+
+and list the hottest functions of the cProfile profiles with:
+
+    python pipeline_profiling.py stats workspace/profiles
+"""
+import argparse
+import collections
+import contextlib
+import cProfile
+import fnmatch
+import functools
+import glob
+import inspect
+import logging
+import os
+import pstats
+import sys
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE_DIR_ENV = 'PIPELINE_PROFILE_DIR'
+PROFILE_JOBS_ENV = 'PIPELINE_PROFILE_JOBS'
+PROFILE_SAMPLE_ENV = 'PIPELINE_PROFILE_SAMPLE_S'
+DEFAULT_PROFILE_DIR = 'profiles'
+
+
+def configure(profile_dir=None, job_pattern_list=None, sample_interval_s=None):
+    """Switch profiling on for this process and the workers it starts.
+
+    Args:
+        profile_dir (str): directory to write profiles to.
+        job_pattern_list (list): fnmatch patterns of the job ids to profile
+            with cProfile.
+        sample_interval_s (float): if not None, sample every job at this
+            interval.
+
+    Returns:
+        None
+    """
+    if profile_dir is not None:
+        os.environ[PROFILE_DIR_ENV] = profile_dir
+    if job_pattern_list:
+        os.environ[PROFILE_JOBS_ENV] = ','.join(job_pattern_list)
+    if sample_interval_s is not None:
+        os.environ[PROFILE_SAMPLE_ENV] = str(sample_interval_s)
+
+
+def _settings():
+    """(profile_dir, job_pattern_list, sample_interval_s) from the env."""
+    job_pattern_list = [
+        pattern.strip()
+        for pattern in os.environ.get(PROFILE_JOBS_ENV, '').split(',')
+        if pattern.strip()]
+    sample_interval_s = None
+    if os.environ.get(PROFILE_SAMPLE_ENV):
+        sample_interval_s = float(os.environ[PROFILE_SAMPLE_ENV])
+    return (
+        os.environ.get(PROFILE_DIR_ENV, DEFAULT_PROFILE_DIR),
+        job_pattern_list, sample_interval_s)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return (
+        f'{os.path.basename(code.co_filename)}:'
+        f'{getattr(code, "co_qualname", code.co_name)}')
+
+
+class _StackSampler(threading.Thread):
+    """Count the stacks of one thread at a fixed interval."""
+
+    def __init__(self, thread_id, interval_s):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._interval_s = interval_s
+        self._stop_event = threading.Event()
+        self.stack_count_map = collections.Counter()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval_s):
+            frame = sys._current_frames().get(self._thread_id)
+            frame_name_list = []
+            while frame is not None:
+                frame_name_list.append(_frame_name(frame))
+                frame = frame.f_back
+            if frame_name_list:
+                self.stack_count_map[
+                    ';'.join(reversed(frame_name_list))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _write_collapsed(stack_count_map, target_path):
+    working_path = f'{target_path}_working'
+    with open(working_path, 'w') as collapsed_file:
+        for stack, count in sorted(stack_count_map.items()):
+            collapsed_file.write(f'{stack} {count}\n')
+    os.replace(working_path, target_path)
+
+
+@contextlib.contextmanager
+def profiled(job_id):
+    """Profile the block as ``job_id`` if profiling is enabled for it."""
+    profile_dir, job_pattern_list, sample_interval_s = _settings()
+    profiler = None
+    sampler = None
+    if any(fnmatch.fnmatch(job_id, pattern) for pattern in job_pattern_list):
+        profiler = cProfile.Profile()
+    if sample_interval_s:
+        sampler = _StackSampler(threading.get_ident(), sample_interval_s)
+        sampler.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if sampler is not None:
+            sampler.stop()
+        if profiler is not None or sampler is not None:
+            # a profile that can't be written shouldn't fail the job
+            try:
+                os.makedirs(profile_dir, exist_ok=True)
+                base_path = os.path.join(
+                    profile_dir, job_id.replace(os.sep, '_'))
+                if profiler is not None:
+                    profiler.dump_stats(f'{base_path}.prof')
+                if sampler is not None:
+                    _write_collapsed(
+                        sampler.stack_count_map, f'{base_path}.collapsed')
+            except OSError:
+                LOGGER.exception(f'could not write the profile of {job_id}')
+
+
+def profile_job(job_id_fn):
+    """Decorate a function so each call is ``profiled``.
+
+    Args:
+        job_id_fn (callable): takes the dictionary of the call's arguments
+            by name and returns the call's job id.
+
+    Returns:
+        decorator.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (os.environ.get(PROFILE_JOBS_ENV) or
+                    os.environ.get(PROFILE_SAMPLE_ENV)):
+                return func(*args, **kwargs)
+            bound_args = signature.bind(*args, **kwargs)
+            bound_args.apply_defaults()
+            with profiled(job_id_fn(bound_args.arguments)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def merge_collapsed(profile_dir, target_path, by_job=False):
+    """Merge the collapsed stacks of every job into one file.
+
+    Args:
+        profile_dir (str): directory of ``.collapsed`` profiles.
+        target_path (str): path to the merged collapsed stack file.
+        by_job (bool): if True each stack starts with its job id so the
+            flame graph is split by job, otherwise the same stacks of
+            different jobs are added together.
+
+    Returns:
+        number of profiles merged.
+    """
+    stack_count_map = collections.Counter()
+    collapsed_path_list = sorted(
+        glob.glob(os.path.join(profile_dir, '*.collapsed')))
+    for collapsed_path in collapsed_path_list:
+        job_id = os.path.basename(os.path.splitext(collapsed_path)[0])
+        with open(collapsed_path, 'r') as collapsed_file:
+            for line in collapsed_file:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if not stack:
+                    continue
+                if by_job:
+                    stack = f'{job_id};{stack}'
+                stack_count_map[stack] += int(count)
+    _write_collapsed(stack_count_map, target_path)
+    return len(collapsed_path_list)
+
+
+def main():
+    """Merge or summarize the profiles of a run."""
+    parser = argparse.ArgumentParser(
+        description='merge and summarize pipeline job profiles')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser(
+        'merge', help='merge collapsed stacks for a flame graph')
+    merge_parser.add_argument('profile_dir')
+    merge_parser.add_argument('target_path')
+    merge_parser.add_argument(
+        '--by_job', action='store_true',
+        help='keep the stacks of each job apart')
+    stats_parser = subparsers.add_parser(
+        'stats', help='hottest functions of the cProfile profiles')
+    stats_parser.add_argument('profile_dir')
+    stats_parser.add_argument(
+        '--sort', default='cumulative', help='pstats sort key')
+    stats_parser.add_argument(
+        '--limit', type=int, default=40, help='functions to list')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        n_merged = merge_collapsed(
+            args.profile_dir, args.target_path, args.by_job)
+        print(f'merged {n_merged} profiles into {args.target_path}')
+        return
+    prof_path_list = sorted(
+        glob.glob(os.path.join(args.profile_dir, '*.prof')))
+    if not prof_path_list:
+        print(f'no .prof files in {args.profile_dir}')
+        return
+    stats = pstats.Stats(*prof_path_list)
+    stats.sort_stats(args.sort).print_stats(args.limit)
+
+
+if __name__ == '__main__':
+    main()
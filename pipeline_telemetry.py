@@ -0,0 +1,352 @@
+"""Live telemetry of a running SDR/NDR pipeline.
+
+A ``PipelineTelemetry`` object lives in the main process next to the stitch
+threads. Each model run registers an output with ``add_output`` and gets an
+``OutputTelemetry`` handle the stitcher reports finished jobs to. Compute
+workers run in other processes so they report through ``event_queue``
+using the picklable ``worker_info`` tuple of their output:
+
+    put_stitch_payload(stitch_queue, payload, worker_info)
+    report_job_failure(worker_info, job_dir)
+
+A snapshot of every output is periodically written as JSON, replaced
+atomically so it can be read at any time, and optionally served on a
+localhost HTTP port.
+"""
+import collections
+import http.server
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import pipeline_trace
+import result_channel
+import workspace_manager
+
+LOGGER = logging.getLogger(__name__)
+
+# job statuses the stitcher reports
+COMPLETED = 'completed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+_PUT_BLOCKED_EVENT = 'put_blocked'
+_FAILED_EVENT = 'failed'
+
+
+def put_stitch_payload(stitch_queue, payload, worker_info):
+    """Put ``payload`` on ``stitch_queue`` and report how long it blocked.
+
+    Args:
+        stitch_queue (queue): queue to a stitcher.
+        payload (object): passed to ``stitch_queue.put``.
+        worker_info (tuple): ``OutputTelemetry.worker_info`` of the output
+            the stitcher writes, or ``None`` to not report.
+
+    Returns:
+        None
+    """
+    start_time = time.time()
+    with pipeline_trace.span(
+            'stitch queue put', category='queue',
+            output=worker_info[1] if worker_info is not None else None):
+        stitch_queue.put(payload)
+    if worker_info is not None:
+        event_queue, output_id = worker_info
+        event_queue.put(
+            (_PUT_BLOCKED_EVENT, output_id, time.time()-start_time))
+
+
+def report_job_failure(worker_info, job_dir):
+    """Report that the job working in ``job_dir`` raised an exception."""
+    pipeline_trace.instant(
+        'job failed', category='job', job=os.path.basename(job_dir),
+        output=worker_info[1] if worker_info is not None else None)
+    if worker_info is not None:
+        event_queue, output_id = worker_info
+        event_queue.put((_FAILED_EVENT, output_id, job_dir))
+
+
+class OutputTelemetry:
+    """Counters of one stitched output."""
+
+    def __init__(
+            self, output_id, job_dir_list, stitch_queue, event_queue,
+            throughput_window_s):
+        """See ``PipelineTelemetry.add_output``."""
+        self.output_id = output_id
+        self.worker_info = (event_queue, output_id)
+        self._stitch_queue = stitch_queue
+        self._pending_job_dir_set = set(job_dir_list)
+        self._n_expected = len(self._pending_job_dir_set)
+        self._status_count = collections.Counter()
+        self._put_blocked_s = 0.0
+        self._max_put_blocked_s = 0.0
+        self._throughput_window_s = throughput_window_s
+        # time of each finished job in the throughput window
+        self._finish_time_deque = collections.deque()
+        self._start_time = time.time()
+        self._lock = threading.Lock()
+
+    def record_job(self, job_dir, status):
+        """Record that the stitcher is done with the job in ``job_dir``.
+
+        Args:
+            job_dir (str): workspace directory of the job.
+            status (str): one of ``COMPLETED``, ``SKIPPED`` or ``FAILED``.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if job_dir not in self._pending_job_dir_set:
+                # already recorded, e.g. as a failure by the worker
+                return
+            self._pending_job_dir_set.remove(job_dir)
+            self._status_count[status] += 1
+            self._finish_time_deque.append(time.time())
+
+    def _record_put_blocked(self, blocked_s):
+        with self._lock:
+            self._put_blocked_s += blocked_s
+            self._max_put_blocked_s = max(
+                self._max_put_blocked_s, blocked_s)
+
+    def pending_job_dirs(self):
+        """Workspace directories of the jobs not stitched yet."""
+        with self._lock:
+            return list(self._pending_job_dir_set)
+
+    def snapshot(self, workspace_bytes_map):
+        """Dictionary of the current state of this output.
+
+        Args:
+            workspace_bytes_map (dict): bytes used by each job workspace
+                that's in use, see ``PipelineTelemetry.snapshot``.
+
+        Returns:
+            dictionary of the output's counters.
+        """
+        now = time.time()
+        with self._lock:
+            while (self._finish_time_deque and
+                    self._finish_time_deque[0] < (
+                        now - self._throughput_window_s)):
+                self._finish_time_deque.popleft()
+            window_s = min(self._throughput_window_s, now-self._start_time)
+            jobs_per_s = (
+                len(self._finish_time_deque) / window_s
+                if window_s > 0 else 0.0)
+            n_remaining = len(self._pending_job_dir_set)
+            pending_job_dir_list = list(self._pending_job_dir_set)
+            output_snapshot = {
+                'jobs_expected': self._n_expected,
+                'jobs_completed': self._status_count[COMPLETED],
+                'jobs_skipped': self._status_count[SKIPPED],
+                'jobs_failed': self._status_count[FAILED],
+                'jobs_remaining': n_remaining,
+                'stitch_put_blocked_s': round(self._put_blocked_s, 3),
+                'stitch_put_max_blocked_s': round(
+                    self._max_put_blocked_s, 3),
+                'jobs_per_hour': round(jobs_per_s*3600, 2),
+                'eta_s': (
+                    round(n_remaining / jobs_per_s)
+                    if jobs_per_s > 0 else None),
+            }
+        try:
+            output_snapshot['stitch_queue_depth'] = self._stitch_queue.qsize()
+        except (NotImplementedError, OSError, EOFError):
+            # not all platforms support qsize, or the queue is shut down
+            output_snapshot['stitch_queue_depth'] = None
+        output_snapshot['pending_workspace_bytes'] = sum(
+            workspace_bytes_map.get(job_dir, 0)
+            for job_dir in pending_job_dir_list)
+        return output_snapshot
+
+
+class PipelineTelemetry:
+    """Collect worker events and publish snapshots of all outputs."""
+
+    def __init__(
+            self, snapshot_path, http_port=None, snapshot_interval_s=30.0,
+            throughput_window_s=3600.0, job_workspace_manager=None):
+        """Create the telemetry, call ``start`` or use ``with`` to run it.
+
+        Args:
+            snapshot_path (str): path to the JSON snapshot to rewrite every
+                ``snapshot_interval_s`` seconds.
+            http_port (int): if not None, the latest snapshot is served as
+                JSON on ``http://127.0.0.1:<http_port>/``.
+            snapshot_interval_s (float): seconds between snapshots.
+            throughput_window_s (float): throughput is the rate of jobs
+                finished over this many trailing seconds.
+            job_workspace_manager (workspace_manager.WorkspaceManager): if
+                not None, its state is in the snapshot as ``workspaces``.
+        """
+        self.snapshot_path = snapshot_path
+        self.http_port = http_port
+        self.snapshot_interval_s = snapshot_interval_s
+        self.throughput_window_s = throughput_window_s
+        self.job_workspace_manager = job_workspace_manager
+        self.event_queue = result_channel.ResultChannel()
+        self._output_map = collections.OrderedDict()
+        self._output_map_lock = threading.Lock()
+        self._latest_snapshot_bytes = b'{}'
+        self._start_time = time.time()
+        self._event_thread = None
+        self._http_server = None
+
+    def add_output(self, output_id, job_dir_list, stitch_queue):
+        """Register an output to report on.
+
+        Args:
+            output_id (str): unique name of the output in the snapshot.
+            job_dir_list (list): workspace directories of the jobs to be
+                stitched into the output.
+            stitch_queue (queue): queue the jobs send results to the
+                stitcher on.
+
+        Returns:
+            ``OutputTelemetry`` the stitcher reports finished jobs to.
+        """
+        output_telemetry = OutputTelemetry(
+            output_id, job_dir_list, stitch_queue, self.event_queue,
+            self.throughput_window_s)
+        with self._output_map_lock:
+            self._output_map[output_id] = output_telemetry
+        return output_telemetry
+
+    def _workspace_bytes_map(self, output_list):
+        """Bytes used by each workspace of a job not stitched yet.
+
+        Workspaces are shared by the outputs of every scenario so each is
+        measured once. With a ``job_workspace_manager`` only the ones it
+        has live are, not the kept workspaces of jobs that haven't started.
+        """
+        pending_job_dir_set = set()
+        for output_telemetry in output_list:
+            pending_job_dir_set.update(output_telemetry.pending_job_dirs())
+        if self.job_workspace_manager is not None:
+            pending_job_dir_set.intersection_update(
+                self.job_workspace_manager.live_workspaces())
+        return {
+            job_dir: workspace_manager.dir_size(job_dir)
+            for job_dir in pending_job_dir_set if os.path.isdir(job_dir)}
+
+    def snapshot(self):
+        """Dictionary of the current state of all outputs."""
+        with self._output_map_lock:
+            output_list = list(self._output_map.values())
+        workspace_bytes_map = self._workspace_bytes_map(output_list)
+        pipeline_snapshot = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'uptime_s': round(time.time()-self._start_time),
+            'pending_workspace_bytes': sum(workspace_bytes_map.values()),
+            'outputs': {
+                output_telemetry.output_id: output_telemetry.snapshot(
+                    workspace_bytes_map)
+                for output_telemetry in output_list},
+        }
+        if self.job_workspace_manager is not None:
+            pipeline_snapshot['workspaces'] = (
+                self.job_workspace_manager.snapshot())
+        return pipeline_snapshot
+
+    def write_snapshot(self):
+        """Write the snapshot file now."""
+        snapshot_bytes = json.dumps(self.snapshot(), indent=2).encode('utf-8')
+        self._latest_snapshot_bytes = snapshot_bytes
+        working_path = f'{self.snapshot_path}_working'
+        with open(working_path, 'wb') as snapshot_file:
+            snapshot_file.write(snapshot_bytes)
+        os.replace(working_path, self.snapshot_path)
+
+    def _handle_event(self, event):
+        event_type, output_id, value = event
+        output_telemetry = self._output_map.get(output_id)
+        if output_telemetry is None:
+            LOGGER.warning(f'telemetry event for unknown output {output_id}')
+        elif event_type == _PUT_BLOCKED_EVENT:
+            output_telemetry._record_put_blocked(value)
+        elif event_type == _FAILED_EVENT:
+            output_telemetry.record_job(value, FAILED)
+
+    def _event_worker(self):
+        """Apply worker events and write snapshots until ``None``."""
+        try:
+            last_snapshot_time = 0
+            while True:
+                try:
+                    event = self.event_queue.get(
+                        timeout=self.snapshot_interval_s)
+                except queue.Empty:
+                    event = ()
+                if event is None:
+                    return
+                if event:
+                    self._handle_event(event)
+                if (time.time() - last_snapshot_time >=
+                        self.snapshot_interval_s):
+                    self.write_snapshot()
+                    last_snapshot_time = time.time()
+        except Exception:
+            LOGGER.exception('error in telemetry worker')
+
+    def start(self):
+        """Start collecting events and writing snapshots."""
+        os.makedirs(
+            os.path.dirname(os.path.abspath(self.snapshot_path)),
+            exist_ok=True)
+        self._event_thread = threading.Thread(target=self._event_worker)
+        self._event_thread.daemon = True
+        self._event_thread.start()
+        if self.http_port is not None:
+            telemetry = self
+
+            class _SnapshotHandler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.end_headers()
+                    self.wfile.write(telemetry._latest_snapshot_bytes)
+
+                def log_message(self, *args):
+                    pass
+
+            self._http_server = http.server.ThreadingHTTPServer(
+                ('127.0.0.1', self.http_port), _SnapshotHandler)
+            http_thread = threading.Thread(
+                target=self._http_server.serve_forever)
+            http_thread.daemon = True
+            http_thread.start()
+            LOGGER.info(
+                f'serving telemetry on http://127.0.0.1:{self.http_port}/')
+
+    def stop(self):
+        """Write a final snapshot and stop."""
+        if self._event_thread is not None:
+            self.event_queue.put(None)
+            self._event_thread.join()
+            self._event_thread = None
+        # apply anything sent after the worker stopped
+        while True:
+            try:
+                self._handle_event(self.event_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.write_snapshot()
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        self.event_queue.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,232 @@
+"""Timeline of a pipeline run as Chrome trace events.
+
+Tracing is switched on by an environment variable so it reaches the
+worker processes the jobs run in, set it before the task graph starts its
+workers, or call ``configure``:
+
+    PIPELINE_TRACE_DIR      directory each process appends its spans to
+
+Stages are wrapped in spans that carry the worker's pid and thread and
+arguments such as the job, scenario and output:
+
+    with pipeline_trace.span('model execute', job=job_dir, scenario='ssp1'):
+        ...
+
+and whole functions with the ``traced`` decorator. When the variable isn't
+set ``span`` returns a shared no-op context manager and ``traced`` calls
+straight through, so the instrumentation can stay in the code.
+
+Each process writes ``trace_<pid>.jsonl`` with one trace event per line so
+a worker that dies only loses the span it was in. Merge them into one file
+for chrome://tracing or https://ui.perfetto.dev with:
+
+    python pipeline_trace.py merge workspace/traces run_trace.json
+"""
+import argparse
+import contextlib
+import functools
+import glob
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+TRACE_DIR_ENV = 'PIPELINE_TRACE_DIR'
+DEFAULT_CATEGORY = 'pipeline'
+
+_NULL_SPAN = contextlib.nullcontext()
+_WRITER_LOCK = threading.Lock()
+# (pid, open file, thread ids named so far) of this process's trace
+_writer_state = None
+
+
+def configure(trace_dir):
+    """Switch tracing on for this process and the workers it starts.
+
+    Args:
+        trace_dir (str): directory to write the per process traces to.
+
+    Returns:
+        None
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV] = trace_dir
+
+
+def _now_us():
+    # wall clock so the spans of different processes line up
+    return time.time_ns() / 1000
+
+
+def _write_events(event_list):
+    """Append ``event_list`` to this process's trace file."""
+    global _writer_state
+    pid = os.getpid()
+    thread = threading.current_thread()
+    with _WRITER_LOCK:
+        metadata_list = []
+        # a forked worker inherits the parent's state, so check the pid
+        if _writer_state is None or _writer_state[0] != pid:
+            trace_dir = os.environ[TRACE_DIR_ENV]
+            os.makedirs(trace_dir, exist_ok=True)
+            trace_file = open(
+                os.path.join(trace_dir, f'trace_{pid}.jsonl'), 'a')
+            _writer_state = (pid, trace_file, set())
+            metadata_list.append({
+                'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                'args': {'name': (
+                    f'{multiprocessing.current_process().name} {pid}')},
+            })
+        _, trace_file, named_thread_set = _writer_state
+        if thread.ident not in named_thread_set:
+            named_thread_set.add(thread.ident)
+            metadata_list.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                'tid': thread.ident, 'args': {'name': thread.name},
+            })
+        for event in metadata_list + event_list:
+            trace_file.write(json.dumps(event, default=str) + '\n')
+        trace_file.flush()
+
+
+@contextlib.contextmanager
+def _span(name, category, args):
+    start_us = _now_us()
+    try:
+        yield
+    except BaseException as error:
+        args['error'] = type(error).__name__
+        raise
+    finally:
+        try:
+            _write_events([{
+                'name': name, 'cat': category, 'ph': 'X', 'ts': start_us,
+                'dur': _now_us() - start_us, 'pid': os.getpid(),
+                'tid': threading.get_ident(), 'args': args,
+            }])
+        except OSError:
+            # a trace that can't be written shouldn't fail the pipeline
+            LOGGER.exception(f'could not write the {name} span')
+
+
+def span(name, category=DEFAULT_CATEGORY, **args):
+    """Record the block as a span named ``name`` if tracing is enabled.
+
+    Args:
+        name (str): name of the span on the timeline.
+        category (str): category the span can be filtered by.
+        **args: shown with the span, e.g. ``job``, ``scenario`` and
+            ``output``.
+
+    Returns:
+        context manager.
+    """
+    if not os.environ.get(TRACE_DIR_ENV):
+        return _NULL_SPAN
+    return _span(name, category, args)
+
+
+def instant(name, category=DEFAULT_CATEGORY, **args):
+    """Mark a point in time, such as a job being admitted or failing."""
+    if not os.environ.get(TRACE_DIR_ENV):
+        return
+    try:
+        _write_events([{
+            'name': name, 'cat': category, 'ph': 'i', 's': 't',
+            'ts': _now_us(), 'pid': os.getpid(),
+            'tid': threading.get_ident(), 'args': args,
+        }])
+    except OSError:
+        LOGGER.exception(f'could not write the {name} event')
+
+
+def traced(name, args_fn=None, category=DEFAULT_CATEGORY):
+    """Decorate a function so each call is a ``span``.
+
+    Args:
+        name (str): name of the spans.
+        args_fn (callable): if not None, takes the dictionary of the call's
+            arguments by name and returns the dictionary of span arguments.
+        category (str): category of the spans.
+
+    Returns:
+        decorator.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not os.environ.get(TRACE_DIR_ENV):
+                return func(*args, **kwargs)
+            span_args = {}
+            if args_fn is not None:
+                bound_args = signature.bind(*args, **kwargs)
+                bound_args.apply_defaults()
+                span_args = args_fn(bound_args.arguments)
+            with _span(name, category, span_args):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def merge_traces(trace_dir, target_path):
+    """Merge the per process traces into one Chrome trace event file.
+
+    Args:
+        trace_dir (str): directory of ``trace_<pid>.jsonl`` files.
+        target_path (str): path to the JSON trace to write.
+
+    Returns:
+        number of events merged.
+    """
+    metadata_list = []
+    event_list = []
+    for trace_path in sorted(
+            glob.glob(os.path.join(trace_dir, 'trace_*.jsonl'))):
+        with open(trace_path, 'r') as trace_file:
+            for line in trace_file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the last line of a killed process can be cut short
+                    LOGGER.warning(f'skipping a partial event in {trace_path}')
+                    continue
+                if event['ph'] == 'M':
+                    metadata_list.append(event)
+                else:
+                    event_list.append(event)
+    event_list.sort(key=lambda event: event['ts'])
+    working_path = f'{target_path}_working'
+    with open(working_path, 'w') as target_file:
+        json.dump(
+            {'traceEvents': metadata_list + event_list,
+             'displayTimeUnit': 'ms'}, target_file)
+    os.replace(working_path, target_path)
+    return len(event_list)
+
+
+def main():
+    """Merge the traces of a run."""
+    parser = argparse.ArgumentParser(
+        description='merge pipeline traces into a Chrome trace')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    merge_parser = subparsers.add_parser(
+        'merge', help='merge the per process traces of a run')
+    merge_parser.add_argument('trace_dir')
+    merge_parser.add_argument('target_path')
+    args = parser.parse_args()
+
+    n_merged = merge_traces(args.trace_dir, args.target_path)
+    print(
+        f'merged {n_merged} events into {args.target_path}, open it in '
+        f'chrome://tracing or https://ui.perfetto.dev')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ import logging
 import multiprocessing
 import datetime
 import subprocess
-import raster_calculations_core
+import block_raster_calculator
 from osgeo import gdal
 from osgeo import osr
 import taskgraph
@@ -33,6 +33,86 @@ logging.basicConfig(
     stream=sys.stdout)
 LOGGER = logging.getLogger(__name__)
 
+# people fed on ag, nodata off ag, and the change of it between scenarios
+# where a pixel that isn't ag feeds no one
+PEOPLE_FED_EXPRESSION = (
+    'crop_yield*poll_suff*pixel_area*(ag_mask>0)+(ag_mask<1)*-9999')
+PEOPLE_FED_DELTA_EXPRESSION = (
+    'crop_yield*pixel_area*('
+    'poll_suff*(ag_mask>0)-base_poll_suff*(base_ag_mask>0))')
+PEOPLE_FED_NODATA = -9999
+TARGET_PIXEL_SIZE = (0.0027777777777777778, -0.0027777777777777778)
+
+YIELD_PATH = "monfreda_2008_yield_poll_dep_ppl_fed_5min.tif" #https://storage.googleapis.com/critical-natural-capital-ecoshards/monfreda_2008_yield_poll_dep_ppl_fed_5min.tif
+PIXEL_AREA_PATH = "esa_pixel_area_ha_md5_1dd3298a7c4d25c891a11e01868b5db6.tif" # https://storage.googleapis.com/ecoshard-root/esa_pixel_area_ha_md5_1dd3298a7c4d25c891a11e01868b5db6.tif
+COUNTRY_VECTOR_PATH = "TM_WORLD_BORDERS-0.3_simplified_md5_47f2059be8d4016072aa6abe77762021.gpkg" # https://storage.googleapis.com/ecoshard-root/critical_natural_capital/TM_WORLD_BORDERS-0.3_simplified_md5_47f2059be8d4016072aa6abe77762021.gpkg
+COUNTRY_ID_FIELD = 'ISO3'
+
+
+def people_fed_scenario_calculation_list(
+        yield_path, pixel_area_path, scenario_list, target_pixel_size,
+        target_dir='.'):
+    """Calculations of people fed on ag for a batch of scenarios.
+
+    Every scenario shares the yield and pixel area inputs, so with inputs
+    of the same extent all of the calculations land on one grid and
+    ``block_raster_calculator.evaluate_calculation_list`` aligns the shared
+    inputs once and writes every target in one blocked pass.
+
+    Args:
+        yield_path (str): path to the pollination dependent yield in
+            people fed.
+        pixel_area_path (str): path to the pixel area in ha.
+        scenario_list (list): (scenario name, pollination sufficiency path,
+            ag mask path) tuples, the first is the baseline.
+        target_pixel_size (tuple): pixel size of the targets.
+        target_dir (str): directory of the targets.
+
+    Returns:
+        list of calculations, people fed on ag of each scenario to
+        ``pollination_ppl_fed_on_ag_10s_<scenario>.tif`` then the change
+        of each other scenario from the baseline to
+        ``pollination_ppl_fed_on_ag_10s_<scenario>_minus_<baseline>.tif``.
+    """
+    base_name, base_poll_suff_path, base_ag_mask_path = scenario_list[0]
+    calculation_list = []
+    for scenario_name, poll_suff_path, ag_mask_path in scenario_list:
+        calculation_list.append({
+            'expression': PEOPLE_FED_EXPRESSION,
+            'symbol_to_path_map': {
+                'crop_yield': yield_path,
+                'poll_suff': poll_suff_path,
+                'pixel_area': pixel_area_path,
+                'ag_mask': ag_mask_path,
+            },
+            'target_nodata': PEOPLE_FED_NODATA,
+            'target_pixel_size': target_pixel_size,
+            'resample_method': 'near',
+            'target_raster_path': os.path.join(
+                target_dir,
+                f'pollination_ppl_fed_on_ag_10s_{scenario_name}.tif'),
+        })
+    for scenario_name, poll_suff_path, ag_mask_path in scenario_list[1:]:
+        calculation_list.append({
+            'expression': PEOPLE_FED_DELTA_EXPRESSION,
+            'symbol_to_path_map': {
+                'crop_yield': yield_path,
+                'poll_suff': poll_suff_path,
+                'pixel_area': pixel_area_path,
+                'ag_mask': ag_mask_path,
+                'base_poll_suff': base_poll_suff_path,
+                'base_ag_mask': base_ag_mask_path,
+            },
+            'target_nodata': PEOPLE_FED_NODATA,
+            'target_pixel_size': target_pixel_size,
+            'resample_method': 'near',
+            'target_raster_path': os.path.join(
+                target_dir,
+                f'pollination_ppl_fed_on_ag_10s_{scenario_name}_minus_'
+                f'{base_name}.tif'),
+        })
+    return calculation_list
+
 
 def main():
     """Write your expression here."""
@@ -53,38 +133,28 @@ def main():
     #ACTUALLY, STOP USING THIS ONE GO HERE INSTEAD:
     #pollination_sufficiency/pollination_pipeline_calc_ppl_fed.py
     
-    calculation_list = [ 
-        {
-           'expression': 'raster1*raster2*raster3*(raster4>0)+(raster4<1)*-9999',
-           'symbol_to_path_map': { 
-               'raster1': "monfreda_2008_yield_poll_dep_ppl_fed_5min.tif", #https://storage.googleapis.com/critical-natural-capital-ecoshards/monfreda_2008_yield_poll_dep_ppl_fed_5min.tif
-               'raster2': r"workspace_poll_suff\churn\poll_suff_hab_ag_coverage_rasters\poll_suff_ag_coverage_prop_10s_marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-1992-v2.0.7cds_compressed_md5_83ec1b.tif",
-               'raster3': "esa_pixel_area_ha_md5_1dd3298a7c4d25c891a11e01868b5db6.tif", # https://storage.googleapis.com/ecoshard-root/esa_pixel_area_ha_md5_1dd3298a7c4d25c891a11e01868b5db6.tif
-               'raster4': r"workspace_poll_suff\churn\ag_mask\marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-1992-v2.0.7cds_compressed_md5_83ec1b_ag_mask.tif"
-            },
-            'target_nodata': -9999,
-            'target_pixel_size': (0.0027777777777777778,-0.0027777777777777778),
-            'resample_method': 'near',
-            'target_raster_path': "pollination_ppl_fed_on_ag_10s_esa2020mar.tif",
-        },
-        {
-           'expression': 'raster1*raster2*raster3*(raster4>0)+(raster4<1)*-9999',
-           'symbol_to_path_map': {
-               'raster1': "monfreda_2008_yield_poll_dep_ppl_fed_5min.tif", #https://storage.googleapis.com/critical-natural-capital-ecoshards/monfreda_2008_yield_poll_dep_ppl_fed_5min.tif
-               'raster2': r"D:\repositories\pollination_sufficiency\workspace_poll_suff\churn\poll_suff_hab_ag_coverage_rasters\poll_suff_ag_coverage_prop_10s_marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-2020-v2.1.1_md5_e6a8da.tif",
-               'raster3': "esa_pixel_area_ha_md5_1dd3298a7c4d25c891a11e01868b5db6.tif", # https://storage.googleapis.com/ecoshard-root/esa_pixel_area_ha_md5_1dd3298a7c4d25c891a11e01868b5db6.tif
-               'raster4': r"D:\repositories\pollination_sufficiency\workspace_poll_suff\churn\ag_mask\marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-2020-v2.1.1_md5_e6a8da_ag_mask.tif",
-            },
-            'target_nodata': -9999,
-            'target_pixel_size': (0.0027777777777777778,-0.0027777777777777778),
-            'resample_method': 'near',
-            'target_raster_path': "pollination_ppl_fed_on_ag_10s_esa1992mar.tif",
-        },
+    # (scenario name, pollination sufficiency, ag mask), the first is the
+    # baseline the others are compared to, add every ESA and Sc scenario
+    # here to run them in one pass
+    scenario_list = [
+        (
+            'esa1992mar',
+            r"workspace_poll_suff\churn\poll_suff_hab_ag_coverage_rasters\poll_suff_ag_coverage_prop_10s_marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-1992-v2.0.7cds_compressed_md5_83ec1b.tif",
+            r"workspace_poll_suff\churn\ag_mask\marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-1992-v2.0.7cds_compressed_md5_83ec1b_ag_mask.tif",
+        ),
+        (
+            'esa2020mar',
+            r"D:\repositories\pollination_sufficiency\workspace_poll_suff\churn\poll_suff_hab_ag_coverage_rasters\poll_suff_ag_coverage_prop_10s_marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-2020-v2.1.1_md5_e6a8da.tif",
+            r"D:\repositories\pollination_sufficiency\workspace_poll_suff\churn\ag_mask\marine_ESACCI-LC-L4-LCCS-Map-300m-P1Y-2020-v2.1.1_md5_e6a8da_ag_mask.tif",
+        ),
     ]
+    calculation_list = people_fed_scenario_calculation_list(
+        YIELD_PATH, PIXEL_AREA_PATH, scenario_list, TARGET_PIXEL_SIZE)
 
-    for calculation in calculation_list:
-        raster_calculations_core.evaluate_calculation(
-            calculation, TASK_GRAPH, WORKSPACE_DIR)
+    # the totals of each target by country are written next to it
+    block_raster_calculator.evaluate_calculation_list(
+        calculation_list, TASK_GRAPH, WORKSPACE_DIR,
+        zone_info=(COUNTRY_VECTOR_PATH, COUNTRY_ID_FIELD), n_workers=NCPUS)
 
     TASK_GRAPH.join()
     TASK_GRAPH.close()
@@ -97,5 +167,7 @@ def main():
 
 
 if __name__ == '__main__':
-    TASK_GRAPH = taskgraph.TaskGraph(WORKSPACE_DIR, NCPUS, 5.0)
+    # tasks run in this process, each calculation is split into tiles
+    # across NCPUS workers which taskgraph's daemonic workers can't start
+    TASK_GRAPH = taskgraph.TaskGraph(WORKSPACE_DIR, -1, 5.0)
     main()
@@ -0,0 +1,226 @@
+"""Bounded many-producer, single-consumer channel between processes.
+
+A lighter replacement for a ``multiprocessing.Manager().Queue(maxsize)``.
+The consumer process owns a ``ResultChannel``: a listening socket plus a
+bounded in-process ``queue.Queue``. When the channel is pickled to a worker
+process it turns into a ``ResultChannelSender`` that keeps one persistent
+connection per process. A message is one pickle over that connection, and
+the ``put`` blocks until the consumer side has placed it in the bounded
+queue and acked it. So a full channel blocks producers the same way a full
+Manager queue does, but without a round trip through a manager server
+process per ``put`` and ``get``.
+
+    with ResultChannel(maxsize=20) as channel:
+        task_graph.add_task(func=job, args=(channel,))  # job calls put
+        payload = channel.get()
+
+Run this module to benchmark the channel against a Manager queue.
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+_ACK = b'1'
+
+# (pid, address) -> (connection, lock) of this process's senders
+_SENDER_CONNECTION_MAP = {}
+_SENDER_CONNECTION_MAP_LOCK = threading.Lock()
+
+
+class ResultChannel:
+    """Consumer end of the channel, lives in the process that calls get."""
+
+    def __init__(self, maxsize=0):
+        """Start listening for producers.
+
+        Args:
+            maxsize (int): number of received messages to hold before
+                producers block on ``put``, 0 for no limit.
+        """
+        self._queue = queue.Queue(maxsize)
+        self._authkey = os.urandom(32)
+        self._listener = multiprocessing.connection.Listener(
+            authkey=self._authkey)
+        self.address = self._listener.address
+        self._closed = False
+        self._connection_list = []
+        self._connection_list_lock = threading.Lock()
+        self._accept_thread = threading.Thread(target=self._accept_worker)
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+
+    def _accept_worker(self):
+        """Start a reader thread for every producer that connects."""
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError,
+                    multiprocessing.AuthenticationError):
+                if self._closed:
+                    return
+                LOGGER.exception(f'failed connection to {self.address}')
+                continue
+            if self._closed:
+                connection.close()
+                return
+            with self._connection_list_lock:
+                self._connection_list.append(connection)
+            reader_thread = threading.Thread(
+                target=self._reader_worker, args=(connection,))
+            reader_thread.daemon = True
+            reader_thread.start()
+
+    def _reader_worker(self, connection):
+        """Move messages from ``connection`` to the queue, ack each one."""
+        try:
+            while True:
+                payload = connection.recv()
+                # blocks while the queue is full so the producer does too
+                self._queue.put(payload)
+                connection.send_bytes(_ACK)
+        except (EOFError, OSError):
+            # producer went away or the channel closed
+            pass
+        finally:
+            connection.close()
+
+    def put(self, payload, block=True, timeout=None):
+        """Put ``payload`` on the channel from the consumer's process."""
+        self._queue.put(payload, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next message, see ``queue.Queue.get``."""
+        return self._queue.get(block, timeout)
+
+    def get_nowait(self):
+        """Same as ``get(False)``."""
+        return self._queue.get_nowait()
+
+    def qsize(self):
+        """Approximate number of received messages not yet taken."""
+        return self._queue.qsize()
+
+    def close(self):
+        """Stop accepting producers and drop their connections."""
+        if self._closed:
+            return
+        self._closed = True
+        # wake up the accept so its thread exits
+        try:
+            multiprocessing.connection.Client(
+                self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+        self._accept_thread.join()
+        self._listener.close()
+        with self._connection_list_lock:
+            for connection in self._connection_list:
+                connection.close()
+            self._connection_list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def sender(self):
+        """``ResultChannelSender`` for a process not passed a pickle."""
+        return ResultChannelSender(self.address, self._authkey)
+
+    def __reduce__(self):
+        return (ResultChannelSender, (self.address, self._authkey))
+
+
+class ResultChannelSender:
+    """Producer end of a ``ResultChannel``, made by pickling the channel."""
+
+    def __init__(self, address, authkey):
+        """Connection is made on the first ``put`` in each process."""
+        self.address = address
+        self._authkey = authkey
+
+    def __reduce__(self):
+        return (ResultChannelSender, (self.address, self._authkey))
+
+    def _get_connection(self):
+        """(connection, lock) to the channel, shared by this process."""
+        key = (os.getpid(), self.address)
+        with _SENDER_CONNECTION_MAP_LOCK:
+            if key not in _SENDER_CONNECTION_MAP:
+                # channels only ack, so anything readable on an idle
+                # connection is the EOF of a channel that's been closed
+                for stale_key, (connection, _) in list(
+                        _SENDER_CONNECTION_MAP.items()):
+                    if stale_key[0] != key[0] or connection.poll():
+                        connection.close()
+                        del _SENDER_CONNECTION_MAP[stale_key]
+                _SENDER_CONNECTION_MAP[key] = (
+                    multiprocessing.connection.Client(
+                        self.address, authkey=self._authkey),
+                    threading.Lock())
+            return _SENDER_CONNECTION_MAP[key]
+
+    def put(self, payload):
+        """Send ``payload``, blocks until the channel has room for it."""
+        connection, lock = self._get_connection()
+        with lock:
+            connection.send(payload)
+            connection.recv_bytes()
+
+
+def _benchmark_producer(target_queue, n_messages):
+    """Put ``n_messages`` stitch-like payloads on ``target_queue``."""
+    for index in range(n_messages):
+        target_queue.put((
+            f'workspace/sdr_workspace/global_dem/job_{index}/'
+            'global_grid_piece.tif', f'workspace/sdr_workspace/job_{index}'))
+
+
+def _benchmark(target_queue, producer_queue, n_producers, n_messages):
+    """Messages per second from ``n_producers`` processes to this one."""
+    process_list = [
+        multiprocessing.Process(
+            target=_benchmark_producer, args=(producer_queue, n_messages))
+        for _ in range(n_producers)]
+    start_time = time.time()
+    for process in process_list:
+        process.start()
+    for _ in range(n_producers*n_messages):
+        target_queue.get()
+    elapsed_s = time.time() - start_time
+    for process in process_list:
+        process.join()
+    return n_producers*n_messages / elapsed_s
+
+
+def main():
+    """Compare messages per second of a channel and a Manager queue."""
+    n_messages = 5000
+    maxsize = 20
+    for n_producers in sorted({1, 4, multiprocessing.cpu_count()}):
+        manager = multiprocessing.Manager()
+        manager_queue = manager.Queue(maxsize)
+        manager_rate = _benchmark(
+            manager_queue, manager_queue, n_producers, n_messages)
+        manager.shutdown()
+        with ResultChannel(maxsize) as channel:
+            # forked processes aren't passed a pickle of the channel
+            channel_rate = _benchmark(
+                channel, channel.sender, n_producers, n_messages)
+        print(
+            f'{n_producers:3d} producers: '
+            f'Manager queue {manager_rate:10.0f} msg/s, '
+            f'ResultChannel {channel_rate:10.0f} msg/s '
+            f'({channel_rate/manager_rate:.1f}x)', flush=True)
+
+
+if __name__ == '__main__':
+    main()
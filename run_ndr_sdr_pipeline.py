@@ -1,12 +1,17 @@
 """Entry point to manage data and run pipeline."""
 from datetime import datetime
+import argparse
 import collections
+import concurrent.futures
+import functools
 import glob
 import gzip
 import itertools
+import json
 import logging
 import multiprocessing
 import os
+import queue
 import shutil
 import sys
 import threading
@@ -20,27 +25,37 @@ from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 import ecoshard
+import numpy
 import requests
 
+import change_detection
+import pipeline_logging
+import pipeline_profiling
+import pipeline_telemetry
+import pipeline_trace
+import result_channel
+import run_plan
+import workspace_manager
+import zone_mosaics
+
 
 gdal.SetCacheMax(2**26)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format=(
-        '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
-        ' [%(funcName)s:%(lineno)d] %(message)s'),
-    filename='sdrndrlog.txt')
-logging.getLogger('ecoshard.taskgraph').setLevel(logging.INFO)
-logging.getLogger('ecoshard.ecoshard').setLevel(logging.INFO)
-logging.getLogger('urllib3.connectionpool').setLevel(logging.INFO)
-logging.getLogger('ecoshard.geoprocessing.geoprocessing').setLevel(
-    logging.ERROR)
-logging.getLogger('ecoshard.geoprocessing.routing.routing').setLevel(
-    logging.WARNING)
-logging.getLogger('ecoshard.geoprocessing.geoprocessing_core').setLevel(
-    logging.ERROR)
-logging.getLogger('inspring.sdr_c_factor').setLevel(logging.WARNING)
-logging.getLogger('inspring.ndr_mfd_plus').setLevel(logging.WARNING)
+LOG_PATH = 'sdrndrlog.txt'
+# per subsystem levels, --log_level overrides them in every process
+DEFAULT_LOG_LEVEL_MAP = {
+    pipeline_logging.ROOT_LOGGER_NAME: 'INFO',
+    __name__: 'INFO',
+    'ecoshard.taskgraph': 'INFO',
+    'ecoshard.ecoshard': 'INFO',
+    'urllib3.connectionpool': 'INFO',
+    'ecoshard.geoprocessing.geoprocessing': 'ERROR',
+    'ecoshard.geoprocessing.routing.routing': 'WARNING',
+    'ecoshard.geoprocessing.geoprocessing_core': 'ERROR',
+    'inspring.sdr_c_factor': 'WARNING',
+    'inspring.ndr_mfd_plus': 'WARNING',
+}
+pipeline_logging.setup(
+    LOG_PATH, pipeline_logging.DEFAULT_LOG_FORMAT, DEFAULT_LOG_LEVEL_MAP)
 
 LOGGER = logging.getLogger(__name__)
 
@@ -49,9 +64,63 @@ SDR_WORKSPACE_DIR = os.path.join(WORKSPACE_DIR, 'sdr_workspace')
 NDR_WORKSPACE_DIR = os.path.join(WORKSPACE_DIR, 'ndr_workspace')
 WATERSHED_SUBSET_TOKEN_PATH = os.path.join(
     WORKSPACE_DIR, 'watershed_partition.token')
+# block hashes of the inputs incremental runs are compared by
+CHANGE_DETECTION_DIR = os.path.join(WORKSPACE_DIR, 'change_detection')
+# inputs warped once per UTM zone with --zone_mosaics, see zone_mosaics.py
+ZONE_MOSAIC_DIR = os.path.join(WORKSPACE_DIR, 'zone_mosaics')
+
+# queue depths, throughput and ETA of every output are rewritten here, set
+# the port to also serve them on http://127.0.0.1:<port>/
+TELEMETRY_SNAPSHOT_PATH = os.path.join(WORKSPACE_DIR, 'telemetry.json')
+TELEMETRY_HTTP_PORT = None
+# job profiles of --profile_jobs and --profile_sample_s go next to it
+PROFILE_DIR = os.path.join(WORKSPACE_DIR, 'profiles')
+# per process spans of --trace, merge them with pipeline_trace.py
+TRACE_DIR = os.path.join(WORKSPACE_DIR, 'traces')
+# the records of a job that raised are written to <job id>.log here
+FAILED_JOB_LOG_DIR = os.path.join(WORKSPACE_DIR, 'failed_job_logs')
+# seconds between the progress lines of each stitcher
+STITCH_PROGRESS_INTERVAL_S = 30.0
+# job workspaces wait to be scheduled rather than grow past this many bytes
+# or leave less than WORKSPACE_MIN_FREE_BYTES on the disk, kept workspaces
+# are evicted least recently used first to make room
+WORKSPACE_BYTE_BUDGET = 500 * 2**30
+WORKSPACE_MIN_FREE_BYTES = 20 * 2**30
+# scenarios to run when no --run_plan is given, see run_plan.py
+DEFAULT_RUN_PLAN_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'run_plans',
+    'nlcd_cotton.json')
 
 # how many jobs to hold back before calling stitcher
 N_TO_BUFFER_STITCH = 10
+# put on a stitch queue when a job is waiting to be admitted, so cached tiles
+# holding the data of stitched jobs are written and their workspaces released
+_FLUSH_TILES = 'flush tiles'
+
+# global stitch rasters are tiled in these blocks, the stitcher holds up to
+# N_STITCH_TILES_TO_CACHE of them in memory (256KB each per band) and only
+# writes a tile once every job that overlaps it has reported or it's evicted
+STITCH_TILE_SIZE = 256
+N_STITCH_TILES_TO_CACHE = 2048
+GLOBAL_NODATA = -9999
+GLOBAL_RASTER_CREATION_OPTIONS = (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'SPARSE_OK=TRUE',
+    f'BLOCKXSIZE={STITCH_TILE_SIZE}', f'BLOCKYSIZE={STITCH_TILE_SIZE}')
+# overview levels made empty with the global rasters and updated from each
+# tile as it's written, must be successive powers of 2 that divide
+# STITCH_TILE_SIZE so a tile covers whole overview pixels at every level
+GLOBAL_OVERVIEW_FACTOR_LIST = [2**level for level in range(1, 9)]
+# a global output is only rewritten to pack it once blocks that in-place
+# updates left unused are at least this fraction of its file
+COMPACT_MIN_UNUSED_FRACTION = 0.25
+
+# sharded global outputs are split into GeoTIFFs of this many stitch tiles on
+# a side, 14*256 10s pixels is just under 10 degrees, so a stitch tile never
+# straddles two shards; up to N_SHARD_WRITERS shards are written at once
+GLOBAL_SHARD_SIZE_TILES = 14
+N_SHARD_WRITERS = 4
+# pieces read ahead by the stitcher when job order doesn't matter
+N_STITCH_PIECE_READERS = 4
 
 TARGET_PIXEL_SIZE_M = 300  # pixel size in m when operating on projected data
 GLOBAL_PIXEL_SIZE_DEG = 10/3600  # 10s resolution
@@ -111,6 +180,14 @@ NLCD_BIOPHYSICAL_TABLE_KEY = 'nlcd_biophysical'
 NLCD_COTTON_TO_83_KEY = 'nlcd2016_cotton_to_83'
 BASE_NLCD_KEY = 'nlcd2016'
 NLCD_LUCODE = 'lulc'
+WORLD_BORDERS_KEY = 'World borders'
+
+# zonal aggregates are kept per basin, identified by BASIN_ID_FIELD of the
+# watershed subsets, and per country, identified by COUNTRY_ID_FIELD
+BASIN_ID_FIELD = 'basin_id'
+COUNTRY_ID_FIELD = 'ISO3'
+BASIN_ZONE = 'basin'
+COUNTRY_ZONE = 'country'
 
 ECOSHARD_MAP = {
     ESAMOD2_LULC_KEY: 'https://storage.googleapis.com/ecoshard-root/ci_global_restoration/ESAmodVCFv2_md5_05407ed305c24604eb5a38551cddb031.tif',
@@ -166,7 +243,7 @@ ECOSHARD_MAP = {
     'Pollination-dependent yield': 'https://storage.googleapis.com/critical-natural-capital-ecoshards/monfreda_2008_yield_poll_dep_ppl_fed_5min.tif',
     'Population': 'https://storage.googleapis.com/ecoshard-root/population/lspop2019_compressed_md5_d0bf03bd0a2378196327bbe6e898b70c.tif',
     'Friction surface': 'https://storage.googleapis.com/ecoshard-root/critical_natural_capital/friction_surface_2015_v1.0-002_md5_166d17746f5dd49cfb2653d721c2267c.tif',
-    'World borders': 'https://storage.googleapis.com/ecoshard-root/critical_natural_capital/TM_WORLD_BORDERS-0.3_simplified_md5_47f2059be8d4016072aa6abe77762021.gpkg',
+    WORLD_BORDERS_KEY: 'https://storage.googleapis.com/ecoshard-root/critical_natural_capital/TM_WORLD_BORDERS-0.3_simplified_md5_47f2059be8d4016072aa6abe77762021.gpkg',
     #'Habitat mask ESA': '(need to make from LULC above)',
     #'Habitat mask Scenario1': '(need to make from LULC above)',
     #'Coastal population': '(need to make from population above and this mask: https://storage.googleapis.com/ecoshard-root/ipbes-cv/total_pop_masked_by_10m_md5_ef02b7ee48fa100f877e3a1671564be2.tif)',
@@ -211,6 +288,8 @@ def _unpack_and_vrt_tiles(
                 f"didn't make VRT at {target_vrt_path} on: {zip_path}")
 
 
+@pipeline_trace.traced(
+    'download', lambda args: {'url': args['url']}, category='fetch')
 def _download_and_validate(url, target_path):
     """Download an ecoshard and validate its hash."""
     ecoshard.download_url(url, target_path)
@@ -218,6 +297,8 @@ def _download_and_validate(url, target_path):
         raise ValueError(f'{target_path} did not validate on its hash')
 
 
+@pipeline_trace.traced(
+    'download', lambda args: {'url': args['url']}, category='fetch')
 def _download_and_set_nodata(url, nodata, target_path):
     """Download and set nodata value if needed."""
     ecoshard.download_url(url, target_path)
@@ -334,6 +415,8 @@ def fetch_and_unpack_data(task_graph):
     return file_map
 
 
+@pipeline_profiling.profile_job(lambda args: 'batch_watershed_subsets')
+@pipeline_trace.traced('batch watershed subsets', category='batch')
 def _batch_into_watershed_subsets(
         watershed_root_dir, degree_separation, done_token_path,
         watershed_subset=None):
@@ -475,9 +558,17 @@ def _batch_into_watershed_subsets(
     return sorted_watershed_path_list
 
 
+@pipeline_trace.traced(
+    'create fid subset', lambda args: {
+        'output': os.path.basename(args['target_vector_path'])},
+    category='batch')
 def _create_fid_subset(
         base_vector_path, fid_list, target_epsg, target_vector_path):
-    """Create subset of vector that matches fid list, projected into epsg."""
+    """Create subset of vector that matches fid list, projected into epsg.
+
+    Each feature gets a ``BASIN_ID_FIELD`` of
+    ``<base vector basename>_<fid>`` to aggregate results by basin.
+    """
     vector = gdal.OpenEx(base_vector_path, gdal.OF_VECTOR)
     layer = vector.GetLayer()
     srs = osr.SpatialReference()
@@ -489,13 +580,27 @@ def _create_fid_subset(
     gpkg_driver = ogr.GetDriverByName('gpkg')
     unprojected_vector_path = '%s_wgs84%s' % os.path.splitext(
         target_vector_path)
+    base_basename = os.path.basename(os.path.splitext(base_vector_path)[0])
     subset_vector = gpkg_driver.CreateDataSource(unprojected_vector_path)
-    subset_vector.CopyLayer(
-        layer, os.path.basename(os.path.splitext(target_vector_path)[0]))
+    subset_layer = subset_vector.CreateLayer(
+        os.path.basename(os.path.splitext(target_vector_path)[0]),
+        layer.GetSpatialRef(), layer.GetGeomType())
+    subset_layer.CreateField(ogr.FieldDefn(BASIN_ID_FIELD, ogr.OFTString))
+    subset_layer.StartTransaction()
+    for feature in layer:
+        subset_feature = ogr.Feature(subset_layer.GetLayerDefn())
+        subset_feature.SetGeometry(feature.GetGeometryRef().Clone())
+        subset_feature.SetField(
+            BASIN_ID_FIELD, f'{base_basename}_{feature.GetFID()}')
+        subset_layer.CreateFeature(subset_feature)
+    subset_layer.CommitTransaction()
+    subset_feature = None
+    feature = None
+    subset_layer = None
+    subset_vector = None
     geoprocessing.reproject_vector(
         unprojected_vector_path, srs.ExportToWkt(), target_vector_path,
-        driver_name='gpkg', copy_fields=False)
-    subset_vector = None
+        driver_name='gpkg', copy_fields=[BASIN_ID_FIELD])
     layer = None
     vector = None
     gpkg_driver.DeleteDataSource(unprojected_vector_path)
@@ -507,6 +612,494 @@ def _create_fid_subset(
             f'{target_layer.GetFeatureCount()}')
 
 
+def _global_stitch_raster_paths(
+        target_stitch_raster_map, result_suffix, multiband_stitch_raster_path,
+        sharded_output):
+    """Name the global rasters of a model run.
+
+    Args:
+        same as for ``_create_global_stitch_rasters``.
+
+    Returns:
+        (local_result_path_list, global_stitch_raster_path_list,
+        band_name_list_per_raster) tuple.
+    """
+    local_result_path_list = []
+    global_stitch_raster_path_list = []
+    for local_result_path, global_stitch_raster_path in \
+            target_stitch_raster_map.items():
+        if result_suffix is not None:
+            global_stitch_raster_path = (
+                f'%s_{result_suffix}%s' % os.path.splitext(
+                    global_stitch_raster_path))
+            local_result_path = (
+                f'%s_{result_suffix}%s' % os.path.splitext(
+                    local_result_path))
+        local_result_path_list.append(local_result_path)
+        global_stitch_raster_path_list.append(global_stitch_raster_path)
+
+    if multiband_stitch_raster_path is not None:
+        if result_suffix is not None:
+            multiband_stitch_raster_path = (
+                f'%s_{result_suffix}%s' % os.path.splitext(
+                    multiband_stitch_raster_path))
+        global_stitch_raster_path_list = [multiband_stitch_raster_path]
+        band_name_list_per_raster = [[
+            os.path.basename(os.path.splitext(path)[0])
+            for path in local_result_path_list]]
+    else:
+        band_name_list_per_raster = [
+            [os.path.basename(os.path.splitext(path)[0])]
+            for path in local_result_path_list]
+    if sharded_output:
+        global_stitch_raster_path_list = [
+            f'{os.path.splitext(path)[0]}.vrt'
+            for path in global_stitch_raster_path_list]
+    return (
+        local_result_path_list, global_stitch_raster_path_list,
+        band_name_list_per_raster)
+
+
+def _create_global_stitch_rasters(
+        target_stitch_raster_map, global_wgs84_bb, result_suffix,
+        multiband_stitch_raster_path, sharded_output=False):
+    """Create the global rasters a model run stitches into.
+
+    Args:
+        target_stitch_raster_map (dict): maps the local path of an output
+            raster of the model to a global raster to stitch into.
+        global_wgs84_bb (list): lat/lng bounding box of the global rasters.
+        result_suffix (str): if not None, appended to local and global
+            raster paths.
+        multiband_stitch_raster_path (str): if not None, all outputs are
+            stitched as bands of this raster instead of the separate global
+            rasters in ``target_stitch_raster_map``.
+        sharded_output (bool): if True each global raster is a ``.vrt``
+            describing the global grid whose data are written to shard
+            GeoTIFFs next to it, see ``_ShardedTileStore``.
+
+    Returns:
+        (local_result_path_list, global_stitch_raster_path_list) tuple where
+        the bands of the global rasters, in order, line up with the local
+        result paths.
+    """
+    (local_result_path_list, global_stitch_raster_path_list,
+     band_name_list_per_raster) = _global_stitch_raster_paths(
+        target_stitch_raster_map, result_suffix, multiband_stitch_raster_path,
+        sharded_output)
+    for global_stitch_raster_path, band_name_list in zip(
+            global_stitch_raster_path_list, band_name_list_per_raster):
+        if os.path.exists(global_stitch_raster_path):
+            continue
+        LOGGER.info(f'creating {global_stitch_raster_path}')
+        if sharded_output:
+            # empty VRT that only holds the grid, shards are added as
+            # they're written
+            driver = gdal.GetDriverByName('VRT')
+            creation_options = []
+        else:
+            driver = gdal.GetDriverByName('GTiff')
+            creation_options = GLOBAL_RASTER_CREATION_OPTIONS
+        n_cols = int((global_wgs84_bb[2]-global_wgs84_bb[0])/GLOBAL_PIXEL_SIZE_DEG)
+        n_rows = int((global_wgs84_bb[3]-global_wgs84_bb[1])/GLOBAL_PIXEL_SIZE_DEG)
+        LOGGER.info(
+            f'**** creating raster of size {n_cols} by {n_rows} by '
+            f'{len(band_name_list)}')
+        target_raster = driver.Create(
+            global_stitch_raster_path,
+            n_cols, n_rows, len(band_name_list),
+            gdal.GDT_Float32,
+            options=creation_options)
+        wgs84_srs = osr.SpatialReference()
+        wgs84_srs.ImportFromEPSG(4326)
+        target_raster.SetProjection(wgs84_srs.ExportToWkt())
+        target_raster.SetGeoTransform(
+            [global_wgs84_bb[0], GLOBAL_PIXEL_SIZE_DEG, 0,
+             global_wgs84_bb[3], 0, -GLOBAL_PIXEL_SIZE_DEG])
+        for band_index, band_name in enumerate(band_name_list):
+            target_band = target_raster.GetRasterBand(band_index+1)
+            target_band.SetNoDataValue(GLOBAL_NODATA)
+            target_band.SetDescription(band_name)
+        target_band = None
+        if not sharded_output:
+            # empty overviews, the stitcher fills them in tile by tile
+            target_raster.BuildOverviews('NONE', GLOBAL_OVERVIEW_FACTOR_LIST)
+        target_raster = None
+    return local_result_path_list, global_stitch_raster_path_list
+
+
+def _create_global_delta_rasters(
+        target_stitch_raster_map, global_wgs84_bb, result_suffix,
+        baseline_suffix, multiband_stitch_raster_path, sharded_output,
+        start_at_zero=False):
+    """Create the global rasters of scenario-minus-baseline deltas.
+
+    Each ``global_<name>.tif`` gets a
+    ``global_<name>_delta_<result_suffix>_vs_<baseline_suffix>.tif``.
+
+    Args:
+        target_stitch_raster_map (dict): same as for
+            ``_create_global_stitch_rasters``.
+        global_wgs84_bb (list): lat/lng bounding box of the global rasters.
+        result_suffix (str): suffix of the scenario outputs.
+        baseline_suffix (str): suffix of the baseline outputs.
+        multiband_stitch_raster_path (str): if not None, the deltas are
+            stitched as bands of ``<path>_delta_...`` instead.
+        sharded_output (bool): same as for ``_create_global_stitch_rasters``.
+        start_at_zero (bool): if True, the delta rasters created now are
+            set to 0 wherever the baseline's global output has data, for
+            an incremental run that only stitches the jobs it reruns.
+
+    Returns:
+        (baseline_delta_info, global_delta_raster_path_list) where
+        ``baseline_delta_info`` is the
+        (baseline_result_path_list, delta_result_path_list) tuple for
+        ``_job_stitch_path_list``.
+    """
+    delta_stitch_raster_map = {
+        '%s_delta%s' % os.path.splitext(local_path):
+            '%s_delta%s' % os.path.splitext(global_path)
+        for local_path, global_path in target_stitch_raster_map.items()}
+    _, baseline_raster_path_list, _ = _global_stitch_raster_paths(
+        target_stitch_raster_map, baseline_suffix,
+        multiband_stitch_raster_path, sharded_output)
+    if multiband_stitch_raster_path is not None:
+        multiband_stitch_raster_path = '%s_delta%s' % os.path.splitext(
+            multiband_stitch_raster_path)
+    delta_suffix = f'{result_suffix}_vs_{baseline_suffix}'
+    zero_fill_path_list = []
+    if start_at_zero:
+        # the token outlives an interrupted fill so it's redone
+        for delta_raster_path in _global_stitch_raster_paths(
+                delta_stitch_raster_map, delta_suffix,
+                multiband_stitch_raster_path, sharded_output)[1]:
+            token_path = f'{delta_raster_path}_zero_fill'
+            if not os.path.exists(delta_raster_path) or os.path.exists(
+                    token_path):
+                with open(token_path, 'w'):
+                    pass
+                zero_fill_path_list.append(delta_raster_path)
+    delta_result_path_list, global_delta_raster_path_list = (
+        _create_global_stitch_rasters(
+            delta_stitch_raster_map, global_wgs84_bb, delta_suffix,
+            multiband_stitch_raster_path, sharded_output))
+    for baseline_raster_path, delta_raster_path in zip(
+            baseline_raster_path_list, global_delta_raster_path_list):
+        if delta_raster_path in zero_fill_path_list:
+            _zero_fill_delta_raster(baseline_raster_path, delta_raster_path)
+            os.remove(f'{delta_raster_path}_zero_fill')
+    baseline_result_path_list = [
+        f'%s_{baseline_suffix}%s' % os.path.splitext(local_path)
+        for local_path in target_stitch_raster_map]
+    return (
+        (baseline_result_path_list, delta_result_path_list),
+        global_delta_raster_path_list)
+
+
+def _zero_fill_delta_raster(baseline_raster_path, delta_raster_path):
+    """Set a delta raster to 0 wherever its baseline output has data.
+
+    A scenario run incrementally equals its baseline outside the jobs it
+    reruns, so its delta there is 0 rather than nodata. Tiles with no
+    baseline data are left unwritten.
+    """
+    if not os.path.exists(baseline_raster_path):
+        LOGGER.warning(
+            f'no baseline {baseline_raster_path} to start '
+            f'{delta_raster_path} from')
+        return
+    LOGGER.info(
+        f'setting {delta_raster_path} to 0 where {baseline_raster_path} '
+        f'has data')
+    baseline_store = _open_global_tile_store(baseline_raster_path)
+    delta_store = _open_global_tile_store(delta_raster_path)
+    n_tiles_x = -(-delta_store.raster_size[0] // STITCH_TILE_SIZE)
+    n_tiles_y = -(-delta_store.raster_size[1] // STITCH_TILE_SIZE)
+    tile_list = []
+    for tile_y in range(n_tiles_y):
+        for tile_x in range(n_tiles_x):
+            baseline_array = baseline_store.read_tile((tile_x, tile_y))
+            valid_mask = ~numpy.isclose(
+                baseline_array, baseline_store.nodata)
+            if not valid_mask.any():
+                continue
+            tile_list.append(((tile_x, tile_y), numpy.where(
+                valid_mask, 0, delta_store.nodata).astype(numpy.float32)))
+            if len(tile_list) >= N_STITCH_TILES_TO_CACHE:
+                delta_store.write_tiles(tile_list)
+                tile_list = []
+    if tile_list:
+        delta_store.write_tiles(tile_list)
+    baseline_store.close()
+    delta_store.close()
+
+
+def _start_from_baseline_outputs(
+        target_stitch_raster_map, result_suffix, baseline_suffix,
+        multiband_stitch_raster_path, sharded_output):
+    """Copy a baseline run's global outputs to start a scenario's from.
+
+    Each global raster, or each shard of a sharded one, is cloned, copy on
+    write where the filesystem supports it, and its bands are renamed to
+    the scenario's. The baseline's zonal partials are copied too so the
+    scenario's tables count the watersheds that aren't rerun. Outputs the
+    scenario already has are left alone so an interrupted run resumes.
+
+    Args:
+        target_stitch_raster_map (dict): same as for
+            ``_create_global_stitch_rasters``.
+        result_suffix (str): suffix of the scenario outputs.
+        baseline_suffix (str): suffix of the finished baseline outputs.
+        multiband_stitch_raster_path (str): same as for
+            ``_create_global_stitch_rasters``.
+        sharded_output (bool): same as for ``_create_global_stitch_rasters``.
+
+    Returns:
+        None
+    """
+    _, baseline_raster_path_list, _ = _global_stitch_raster_paths(
+        target_stitch_raster_map, baseline_suffix,
+        multiband_stitch_raster_path, sharded_output)
+    _, global_stitch_raster_path_list, band_name_list_per_raster = (
+        _global_stitch_raster_paths(
+            target_stitch_raster_map, result_suffix,
+            multiband_stitch_raster_path, sharded_output))
+    for baseline_raster_path, global_stitch_raster_path, band_name_list in \
+            zip(baseline_raster_path_list, global_stitch_raster_path_list,
+                band_name_list_per_raster):
+        if os.path.exists(global_stitch_raster_path):
+            continue
+        if not os.path.exists(baseline_raster_path):
+            LOGGER.warning(
+                f'no baseline {baseline_raster_path} to start '
+                f'{global_stitch_raster_path} from')
+            continue
+        LOGGER.info(
+            f'starting {global_stitch_raster_path} from '
+            f'{baseline_raster_path}')
+        baseline_raster = gdal.OpenEx(baseline_raster_path, gdal.OF_RASTER)
+        baseline_band_name_list = [
+            baseline_raster.GetRasterBand(band_id+1).GetDescription()
+            for band_id in range(baseline_raster.RasterCount)]
+        baseline_raster = None
+
+        # the partials are copied before the raster is in place so a run
+        # interrupted in between copies them again
+        baseline_partials_path = (
+            f'{os.path.splitext(baseline_raster_path)[0]}'
+            f'_zonal_partials.jsonl')
+        if os.path.exists(baseline_partials_path):
+            band_name_map = dict(zip(baseline_band_name_list, band_name_list))
+            partials_path = (
+                f'{os.path.splitext(global_stitch_raster_path)[0]}'
+                f'_zonal_partials.jsonl')
+            working_partials_path = f'{partials_path}_working'
+            with open(baseline_partials_path, 'r') as baseline_file, \
+                    open(working_partials_path, 'w') as partials_file:
+                for line in baseline_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    record['partial'] = {
+                        band_name_map.get(band_name, band_name): band_partial
+                        for band_name, band_partial in
+                        record['partial'].items()}
+                    partials_file.write(json.dumps(record) + '\n')
+            os.replace(working_partials_path, partials_path)
+
+        working_raster_path = '%s_working%s' % os.path.splitext(
+            global_stitch_raster_path)
+        if sharded_output:
+            shard_dir = _shard_dir(global_stitch_raster_path)
+            os.makedirs(shard_dir, exist_ok=True)
+            for shard_path in glob.glob(os.path.join(
+                    _shard_dir(baseline_raster_path), '*.tif')):
+                change_detection.clone_file(
+                    shard_path,
+                    os.path.join(shard_dir, os.path.basename(shard_path)))
+        change_detection.clone_file(baseline_raster_path, working_raster_path)
+        working_raster = gdal.OpenEx(
+            working_raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        for band_id, band_name in enumerate(band_name_list):
+            working_raster.GetRasterBand(band_id+1).SetDescription(band_name)
+        working_raster = None
+        os.replace(working_raster_path, global_stitch_raster_path)
+        if sharded_output:
+            # the cloned VRT still points at the baseline's shards
+            _build_shard_mosaic(global_stitch_raster_path)
+
+
+def _job_workspace_dir(workspace_dir, watershed_path):
+    """Workspace of the job of ``watershed_path`` in a model's workspace."""
+    return os.path.join(
+        workspace_dir, os.path.splitext(os.path.basename(watershed_path))[0])
+
+
+def _incremental_job_list(job_list, job_footprint_map, input_pair_list):
+    """Jobs of ``job_list`` whose watersheds cover changed input pixels.
+
+    Args:
+        job_list (list): (index, watershed_path, local_workspace_dir) tuples.
+        job_footprint_map (dict): maps each job's workspace dir to the
+            wgs84 bounding box of its watersheds.
+        input_pair_list (list): (baseline_path, scenario_path) tuples of the
+            inputs that may differ.
+
+    Returns:
+        the jobs of ``job_list`` to rerun.
+    """
+    changed_job_set = change_detection.changed_job_set(
+        job_footprint_map, change_detection.changed_wgs84_bb_array(
+            input_pair_list, CHANGE_DETECTION_DIR))
+    LOGGER.info(
+        f'{len(changed_job_set)} of {len(job_list)} jobs have changed inputs')
+    return [
+        job for job in job_list if job[2] in changed_job_set]
+
+
+def _run_input_record(input_path_list, parameter_map):
+    """Stat of a run's inputs other than its table, and its parameters.
+
+    Args:
+        input_path_list (list): paths of the rasters and vectors the run
+            reads, not its biophysical table.
+        parameter_map (dict): model parameters of the run, json values.
+
+    Returns:
+        dictionary that compares equal to the one of another run only if
+        it has the same parameters and the same files, unmodified.
+    """
+    input_stat_map = {}
+    for path in input_path_list:
+        path_stat = os.stat(path)
+        input_stat_map[os.path.abspath(path)] = [
+            path_stat.st_size, path_stat.st_mtime_ns]
+    # as it reads back from the table record
+    return json.loads(json.dumps({
+        'inputs': input_stat_map,
+        'parameters': parameter_map,
+    }))
+
+
+def _table_edit_job_list(
+        job_list, job_footprint_map, table_record_path, run_input_record,
+        lulc_path, biophysical_table_path, lucode_field,
+        global_raster_path_list):
+    """Jobs of ``job_list`` that a biophysical table revision changes.
+
+    Args:
+        job_list (list): (index, watershed_path, local_workspace_dir) tuples.
+        job_footprint_map (dict): maps each job's workspace dir to the
+            wgs84 bounding box of its watersheds.
+        table_record_path (str): path to the record ``_write_table_record``
+            left when the run last finished.
+        run_input_record (dict): ``_run_input_record`` of the run now.
+        lulc_path (str): path to the land cover raster of the run.
+        biophysical_table_path (str): path to the table the run uses now.
+        lucode_field (str): land cover code column of the table.
+        global_raster_path_list (list): global outputs of the run.
+
+    Returns:
+        the jobs of ``job_list`` whose watersheds contain codes whose rows
+        differ from the recorded table, or all of them if the run hasn't
+        finished before with the same inputs and parameters.
+    """
+    if not os.path.exists(table_record_path) or not all(
+            os.path.exists(path) for path in global_raster_path_list):
+        return job_list
+    with open(table_record_path, 'r') as table_record_file:
+        table_record = json.load(table_record_file)
+    if (table_record.get('run_inputs') != run_input_record or
+            table_record['lucode_field'] != lucode_field):
+        LOGGER.info(
+            f'{table_record_path} is of other inputs or parameters, running '
+            f'all jobs')
+        return job_list
+    lucode_set = change_detection.changed_lucode_set(
+        table_record['lucode_rows'], change_detection.read_lucode_table(
+            biophysical_table_path, lucode_field))
+    if not lucode_set:
+        LOGGER.info(f'no lucodes changed in {biophysical_table_path}')
+        return []
+    changed_job_set = change_detection.lucode_job_set(
+        change_detection.lucode_histogram_index(
+            lulc_path, job_footprint_map, CHANGE_DETECTION_DIR),
+        lucode_set)
+    LOGGER.info(
+        f'lucodes {sorted(lucode_set, key=int)} changed in '
+        f'{biophysical_table_path}, {len(changed_job_set)} of '
+        f'{len(job_list)} jobs contain them')
+    return [job for job in job_list if job[2] in changed_job_set]
+
+
+def _write_table_record(
+        table_record_path, run_input_record, biophysical_table_path,
+        lucode_field):
+    """Record the table a run finished with for ``_table_edit_job_list``."""
+    working_record_path = f'{table_record_path}_working'
+    with open(working_record_path, 'w') as table_record_file:
+        json.dump({
+            'run_inputs': run_input_record,
+            'lucode_field': lucode_field,
+            'biophysical_table_path': os.path.abspath(biophysical_table_path),
+            'lucode_rows': change_detection.read_lucode_table(
+                biophysical_table_path, lucode_field),
+        }, table_record_file)
+    os.replace(working_record_path, table_record_path)
+
+
+def _request_stitch_flush(stitch_queue):
+    """Ask a stitcher to write its cached tiles, unless it's busy."""
+    try:
+        stitch_queue.put(_FLUSH_TILES, block=False)
+    except queue.Full:
+        # a full stitcher releases workspaces as it works through its queue
+        pass
+
+
+class _PendingRun:
+    """Stitcher and cleaner of a run whose jobs have been submitted."""
+
+    def __init__(
+            self, run_id, stitch_queue, stitch_thread, signal_done_queue,
+            clean_workspace_thread, finish_callback=None,
+            job_workspace_manager=None, flush_callback=None):
+        """See ``_run_sdr``.
+
+        ``finish_callback`` is called with no arguments once the run's
+        results are stitched. ``flush_callback`` is removed from
+        ``job_workspace_manager`` before the stitcher is stopped.
+        """
+        self.run_id = run_id
+        self._stitch_queue = stitch_queue
+        self._stitch_thread = stitch_thread
+        self._signal_done_queue = signal_done_queue
+        self._clean_workspace_thread = clean_workspace_thread
+        self._finish_callback = finish_callback
+        self._job_workspace_manager = job_workspace_manager
+        self._flush_callback = flush_callback
+
+    def finish(self):
+        """Stitch the last results and stop, call after the jobs are done."""
+        if self._flush_callback is not None:
+            self._job_workspace_manager.remove_flush_callback(
+                self._flush_callback)
+        self._stitch_queue.put(None)
+        LOGGER.info(
+            f'all done with {self.run_id}, waiting for stitcher to terminate')
+        self._stitch_thread.join()
+        self._stitch_queue.close()
+        LOGGER.info(
+            f'all done with stitching {self.run_id}, waiting for workspace '
+            f'worker to terminate')
+        self._signal_done_queue.put(None)
+        self._clean_workspace_thread.join()
+        if self._finish_callback is not None:
+            self._finish_callback()
+        LOGGER.info(f'all done with {self.run_id} -- stitcher terminated')
+
+
 def _run_sdr(
         task_graph,
         workspace_dir,
@@ -527,6 +1120,22 @@ def _run_sdr(
         keep_intermediate_files=False,
         c_factor_path=None,
         result_suffix=None,
+        multiband_stitch_raster_path=None,
+        sharded_output=False,
+        build_shard_cogs=False,
+        telemetry=None,
+        aggregate_zones=False,
+        country_vector_path=None,
+        baseline_suffix=None,
+        mask_to_watersheds=False,
+        job_workspace_manager=None,
+        priority_offset=0,
+        workspace_task_map=None,
+        wait=True,
+        incremental_input_pair_list=None,
+        scope_table_edits=False,
+        zone_mosaic_dir=None,
+        zone_mosaic_task_map=None,
         ):
     """Run SDR component of the pipeline.
 
@@ -559,111 +1168,359 @@ def _run_sdr(
         c_factor_path (str): optional, path to c factor that's used for lucodes
             that use the raster
         result_suffix (str): optional, prepended to the global stitch results.
+        multiband_stitch_raster_path (str): optional, if set all the outputs
+            in ``target_stitch_raster_map`` are stitched as bands of this one
+            global raster, in map order, instead of into separate rasters.
+        sharded_output (bool): optional, if True the global outputs are
+            written as ~10 degree shard GeoTIFFs under a ``.vrt`` mosaic
+            so shards can be written concurrently, and a rerun only
+            rewrites and compacts the shards its jobs touch.
+        build_shard_cogs (bool): optional, if True and ``sharded_output``
+            build a cloud optimized GeoTIFF of each shard when done.
+        telemetry (pipeline_telemetry.PipelineTelemetry): optional, if set
+            the stitch queue, job outcomes and throughput of this run are
+            reported to it.
+        aggregate_zones (bool): optional, if True the stitcher keeps per
+            basin totals of every output, and per country totals if
+            ``country_vector_path`` is set, and writes them as csv tables
+            next to the global rasters.
+        country_vector_path (str): optional, path to country polygons with
+            a ``COUNTRY_ID_FIELD``.
+        baseline_suffix (str): optional, the ``result_suffix`` of a baseline
+            run into the same ``workspace_dir``. Where a watershed's baseline
+            outputs are still in its workspace the scenario-minus-baseline
+            delta is calculated locally and stitched into a
+            ``global_*_delta_<result_suffix>_vs_<baseline_suffix>.tif``.
+        mask_to_watersheds (bool): optional, if True each job only writes
+            the global pixels whose centers are inside its watersheds.
+            Jobs then never write the same pixel so the stitcher reads
+            pieces concurrently and stitches them in any order.
+        job_workspace_manager (workspace_manager.WorkspaceManager):
+            optional, if not None each job waits to be scheduled until its
+            workspace fits in the manager's disk budget. Workspaces left by
+            earlier runs count towards it and are evicted first when
+            ``keep_intermediate_files`` is True.
+        priority_offset (int): optional, added to the task priority of
+            every job so the jobs of several runs in one ``task_graph`` run
+            in the order of their offsets.
+        workspace_task_map (dict): optional, maps a job workspace directory
+            to the last task submitted to work in it and is updated with
+            this run's jobs. Each job depends on the previous one in its
+            workspace, so the runs sharing a workspace, such as a baseline
+            and its scenarios, never run in it at once and a scenario job
+            finds the baseline outputs it makes deltas against.
+        wait (bool): optional, if True wait for the jobs and stitcher to
+            finish, otherwise return as soon as the jobs are submitted.
+        incremental_input_pair_list (list): optional, with
+            ``baseline_suffix`` a list of (baseline_path, scenario_path)
+            tuples of the inputs this run differs from the baseline run in.
+            Only the jobs whose watersheds overlap blocks where the inputs
+            differ are run, into global outputs and zonal tables that start
+            as copies of the finished baseline's. Delta outputs are only
+            stitched where jobs are rerun, elsewhere they're 0 where the
+            baseline has data.
+        scope_table_edits (bool): optional, if True and this run last
+            finished with another version of ``biophysical_table_path`` and
+            otherwise the same inputs and parameters, only the jobs whose
+            watersheds contain land cover codes whose table rows changed
+            are run. The table, the stat of every other input and the
+            parameters are recorded in ``workspace_dir`` when the run
+            finishes.
+        zone_mosaic_dir (str): optional, if not None each input is warped
+            once per UTM zone into a mosaic in this directory, covering the
+            zone's watersheds, and jobs cut their inputs out of their
+            zone's mosaics instead of warping them.
+        zone_mosaic_task_map (dict): optional, maps a zone mosaic path to
+            the task that builds it, pass the same dictionary to each run
+            so the mosaics of the inputs they share are built once.
 
     Returns:
-        None.
+        None if ``wait``, otherwise the ``_PendingRun`` to ``finish`` once
+        ``task_graph`` has been joined.
     """
     # create intersecting bounding box of input data
     global_wgs84_bb = _calculate_intersecting_bounding_box(
         [dem_path, erosivity_path, erodibility_path, lulc_path])
 
-    # create global stitch rasters and start workers
-    stitch_raster_queue_map = {}
-    stitch_worker_list = []
-    multiprocessing_manager = multiprocessing.Manager()
-    signal_done_queue = multiprocessing_manager.Queue()
-    for local_result_path, global_stitch_raster_path in \
-            target_stitch_raster_map.items():
-        if result_suffix is not None:
-            global_stitch_raster_path = (
-                f'%s_{result_suffix}%s' % os.path.splitext(
-                    global_stitch_raster_path))
-            local_result_path = (
-                f'%s_{result_suffix}%s' % os.path.splitext(
-                    local_result_path))
-        if not os.path.exists(global_stitch_raster_path):
-            LOGGER.info(f'creating {global_stitch_raster_path}')
-            driver = gdal.GetDriverByName('GTiff')
-            n_cols = int((global_wgs84_bb[2]-global_wgs84_bb[0])/GLOBAL_PIXEL_SIZE_DEG)
-            n_rows = int((global_wgs84_bb[3]-global_wgs84_bb[1])/GLOBAL_PIXEL_SIZE_DEG)
-            LOGGER.info(f'**** creating raster of size {n_cols} by {n_rows}')
-            target_raster = driver.Create(
-                global_stitch_raster_path,
-                n_cols, n_rows, 1,
-                gdal.GDT_Float32,
-                options=(
-                    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW',
-                    'SPARSE_OK=TRUE', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'))
-            wgs84_srs = osr.SpatialReference()
-            wgs84_srs.ImportFromEPSG(4326)
-            target_raster.SetProjection(wgs84_srs.ExportToWkt())
-            target_raster.SetGeoTransform(
-                [global_wgs84_bb[0], GLOBAL_PIXEL_SIZE_DEG, 0,
-                 global_wgs84_bb[3], 0, -GLOBAL_PIXEL_SIZE_DEG])
-            target_band = target_raster.GetRasterBand(1)
-            target_band.SetNoDataValue(-9999)
-            target_raster = None
-        stitch_queue = multiprocessing_manager.Queue(N_TO_BUFFER_STITCH*2)
-        stitch_thread = threading.Thread(
-            target=stitch_worker,
-            args=(
-                stitch_queue, global_stitch_raster_path,
-                len(watershed_path_list),
-                signal_done_queue))
-        stitch_thread.start()
-        stitch_raster_queue_map[local_result_path] = stitch_queue
-        stitch_worker_list.append(stitch_thread)
+    # figure out the jobs first so the stitchers know which global tiles
+    # each job is expected to touch
+    job_list = []
+    for index, watershed_path in enumerate(watershed_path_list):
+        local_workspace_dir = _job_workspace_dir(
+            workspace_dir, watershed_path)
+        task_name = f'sdr {os.path.basename(local_workspace_dir)}'
+        if any([sub in task_name for sub in SKIP_TASK_SET]):
+            continue
+        job_list.append((index, watershed_path, local_workspace_dir))
+    job_footprint_map = {
+        local_workspace_dir: _watershed_wgs84_bb(watershed_path)
+        for _, watershed_path, local_workspace_dir in job_list}
+    if incremental_input_pair_list is not None and (
+            baseline_suffix is not None):
+        job_list = _incremental_job_list(
+            job_list, job_footprint_map, incremental_input_pair_list)
+        job_footprint_map = {
+            local_workspace_dir: job_footprint_map[local_workspace_dir]
+            for _, _, local_workspace_dir in job_list}
+        _start_from_baseline_outputs(
+            target_stitch_raster_map, result_suffix, baseline_suffix,
+            multiband_stitch_raster_path, sharded_output)
+    finish_callback = None
+    if scope_table_edits:
+        table_record_path = os.path.join(
+            workspace_dir, f'biophysical_table_{result_suffix}.json')
+        # stat the inputs now, the record is of what the run started with
+        run_input_record = _run_input_record(
+            [dem_path, erosivity_path, erodibility_path, lulc_path] +
+            ([c_factor_path] if c_factor_path is not None else []) +
+            [watershed_path for _, watershed_path, _ in job_list], {
+                'threshold_flow_accumulation': threshold_flow_accumulation,
+                'l_cap': l_cap,
+                'k_param': k_param,
+                'sdr_max': sdr_max,
+                'ic_0_param': ic_0_param,
+                'target_pixel_size': target_pixel_size,
+                'mask_to_watersheds': mask_to_watersheds,
+                'target_stitch_raster_map': target_stitch_raster_map,
+                'multiband_stitch_raster_path': multiband_stitch_raster_path,
+                'baseline_suffix': baseline_suffix,
+            })
+        job_list = _table_edit_job_list(
+            job_list, job_footprint_map, table_record_path, run_input_record,
+            lulc_path, biophysical_table_path, biophysical_table_lucode_field,
+            _global_stitch_raster_paths(
+                target_stitch_raster_map, result_suffix,
+                multiband_stitch_raster_path, sharded_output)[1])
+        job_footprint_map = {
+            local_workspace_dir: job_footprint_map[local_workspace_dir]
+            for _, _, local_workspace_dir in job_list}
+        finish_callback = functools.partial(
+            _write_table_record, table_record_path, run_input_record,
+            biophysical_table_path, biophysical_table_lucode_field)
+
+    # create global stitch rasters and start the stitcher, all of a job's
+    # outputs are stitched together in one pass
+    local_result_path_list, global_stitch_raster_path_list = (
+        _create_global_stitch_rasters(
+            target_stitch_raster_map, global_wgs84_bb, result_suffix,
+            multiband_stitch_raster_path, sharded_output))
+    baseline_delta_info = None
+    if baseline_suffix is not None:
+        # deltas are stitched as the bands after the scenario outputs
+        baseline_delta_info, global_delta_raster_path_list = (
+            _create_global_delta_rasters(
+                target_stitch_raster_map, global_wgs84_bb, result_suffix,
+                baseline_suffix, multiband_stitch_raster_path,
+                sharded_output, start_at_zero=(
+                    incremental_input_pair_list is not None)))
+        global_stitch_raster_path_list += global_delta_raster_path_list
+    global_raster_info = geoprocessing.get_raster_info(
+        global_stitch_raster_path_list[0])
+    global_grid_info = (
+        global_raster_info['geotransform'], global_raster_info['raster_size'],
+        mask_to_watersheds)
+    zone_info = None
+    if aggregate_zones:
+        zone_info = (country_vector_path, COUNTRY_ID_FIELD)
+    # stitcher and cleaner are threads here, only the jobs are in other
+    # processes
+    signal_done_queue = queue.Queue()
+    stitch_queue = result_channel.ResultChannel(N_TO_BUFFER_STITCH*2)
+    output_telemetry = None
+    telemetry_info = None
+    if telemetry is not None:
+        output_telemetry = telemetry.add_output(
+            f'sdr_{result_suffix}',
+            [local_workspace_dir for _, _, local_workspace_dir in job_list],
+            stitch_queue)
+        telemetry_info = output_telemetry.worker_info
+    flush_callback = None
+    if job_workspace_manager is not None:
+        # main planned a use of every watershed's workspace
+        job_dir_set = set(
+            local_workspace_dir for _, _, local_workspace_dir in job_list)
+        job_workspace_manager.cancel_planned_uses([
+            local_workspace_dir for local_workspace_dir in [
+                _job_workspace_dir(workspace_dir, watershed_path)
+                for watershed_path in watershed_path_list]
+            if local_workspace_dir not in job_dir_set])
+        job_workspace_manager.add_existing(
+            [local_workspace_dir for _, _, local_workspace_dir in job_list])
+        # cached tiles hold on to the workspaces of stitched jobs until the
+        # last job overlapping them is stitched, which may be one that's
+        # waiting for a workspace to be released
+        flush_callback = functools.partial(
+            _request_stitch_flush, stitch_queue)
+        job_workspace_manager.add_flush_callback(flush_callback)
+    stitch_thread = threading.Thread(
+        target=stitch_worker,
+        args=(
+            stitch_queue, global_stitch_raster_path_list, len(job_list),
+            signal_done_queue, job_footprint_map, build_shard_cogs,
+            output_telemetry, aggregate_zones, mask_to_watersheds))
+    stitch_thread.start()
 
     clean_workspace_worker = threading.Thread(
         target=_clean_workspace_worker,
-        args=(len(target_stitch_raster_map), signal_done_queue,
-              keep_intermediate_files))
+        args=(
+            1, signal_done_queue, keep_intermediate_files,
+            job_workspace_manager))
     clean_workspace_worker.daemon = True
     clean_workspace_worker.start()
 
+    watershed_mosaic_map = {}
+    if zone_mosaic_dir is not None:
+        # same order as the inputs are warped in _execute_sdr_job
+        watershed_mosaic_map = _add_zone_mosaic_tasks(
+            task_graph,
+            [dem_path, erosivity_path, erodibility_path, lulc_path],
+            ['bilinear', 'bilinear', 'bilinear', 'mode'],
+            watershed_path_list, target_pixel_size, zone_mosaic_dir,
+            {} if zone_mosaic_task_map is None else zone_mosaic_task_map,
+            priority_offset+1)
+
     # Iterate through each watershed subset and run SDR
     # stitch the results of whatever outputs to whatever global output raster.
-    for index, watershed_path in enumerate(watershed_path_list):
-        local_workspace_dir = os.path.join(
-            workspace_dir, os.path.splitext(
-                os.path.basename(watershed_path))[0])
-        task_name = f'sdr {os.path.basename(local_workspace_dir)}'
-        if any([sub in task_name for sub in SKIP_TASK_SET]):
-            continue
-        task_graph.add_task(
+    for index, watershed_path, local_workspace_dir in job_list:
+        if job_workspace_manager is not None:
+            with pipeline_trace.span(
+                    'admit workspace', category='schedule',
+                    job=os.path.basename(local_workspace_dir)):
+                job_workspace_manager.admit(local_workspace_dir)
+        dependent_task_list = []
+        if workspace_task_map is not None and (
+                local_workspace_dir in workspace_task_map):
+            dependent_task_list.append(
+                workspace_task_map[local_workspace_dir])
+        zone_mosaic_path_list = None
+        if watershed_path in watershed_mosaic_map:
+            zone_mosaic_path_list, zone_mosaic_task_list = (
+                watershed_mosaic_map[watershed_path])
+            dependent_task_list += zone_mosaic_task_list
+        job_task = task_graph.add_task(
             func=_execute_sdr_job,
             args=(
                 global_wgs84_bb, watershed_path, local_workspace_dir,
                 dem_path, erosivity_path, erodibility_path, lulc_path,
                 biophysical_table_path, threshold_flow_accumulation, k_param,
                 sdr_max, ic_0_param, target_pixel_size,
-                biophysical_table_lucode_field, stitch_raster_queue_map,
-                result_suffix),
+                biophysical_table_lucode_field, global_grid_info, zone_info,
+                stitch_queue, telemetry_info, local_result_path_list,
+                result_suffix, baseline_delta_info, zone_mosaic_path_list),
+            dependent_task_list=dependent_task_list,
             transient_run=False,
-            priority=-index,  # priority in insert order
-            task_name=task_name)
-
+            # priority in insert order
+            priority=priority_offset-index,
+            task_name=f'sdr {os.path.basename(local_workspace_dir)}')
+        if workspace_task_map is not None:
+            workspace_task_map[local_workspace_dir] = job_task
+
+    pending_run = _PendingRun(
+        f'SDR {result_suffix}', stitch_queue, stitch_thread,
+        signal_done_queue, clean_workspace_worker, finish_callback,
+        job_workspace_manager, flush_callback)
+    if not wait:
+        return pending_run
     LOGGER.info('wait for SDR jobs to complete')
     task_graph.join()
-    for local_result_path, stitch_queue in stitch_raster_queue_map.items():
-        stitch_queue.put(None)
-    LOGGER.info('all done with SDR, waiting for stitcher to terminate')
-    for stitch_thread in stitch_worker_list:
-        stitch_thread.join()
-    LOGGER.info(
-        'all done with stitching, waiting for workspace worker to terminate')
-    signal_done_queue.put(None)
-    clean_workspace_worker.join()
+    pending_run.finish()
+
 
-    LOGGER.info('all done with SDR -- stitcher terminated')
+def _delta_op(
+        scenario_array, baseline_array, scenario_nodata, baseline_nodata):
+    """Scenario minus baseline where both are defined."""
+    result = numpy.full(
+        scenario_array.shape, GLOBAL_NODATA, dtype=numpy.float32)
+    valid_mask = numpy.ones(scenario_array.shape, dtype=bool)
+    if scenario_nodata is not None:
+        valid_mask &= ~numpy.isclose(scenario_array, scenario_nodata)
+    if baseline_nodata is not None:
+        valid_mask &= ~numpy.isclose(baseline_array, baseline_nodata)
+    result[valid_mask] = (
+        scenario_array[valid_mask] - baseline_array[valid_mask])
+    return result
 
 
+def _job_stitch_path_list(
+        local_workspace_dir, local_result_path_list, baseline_delta_info):
+    """Paths of a job's rasters to stitch, with baseline deltas if possible.
+
+    Args:
+        local_workspace_dir (str): workspace of the job.
+        local_result_path_list (list): paths of the scenario outputs,
+            relative to ``local_workspace_dir``.
+        baseline_delta_info (tuple): if not None,
+            (baseline_result_path_list, delta_result_path_list) of relative
+            paths to the baseline scenario's outputs, in the same order as
+            ``local_result_path_list``, and to the deltas to create.
+
+    Returns:
+        (stitch_path_list, deltas_missing) tuple. ``stitch_path_list`` is
+        the scenario output paths followed by the scenario-minus-baseline
+        delta paths when the baseline outputs of this job exist on the same
+        grid. Otherwise it's just the scenario output paths and
+        ``deltas_missing`` is True so the job is reported as failed, and
+        the stitcher writes nodata to the deltas where the job has results.
+    """
+    result_path_list = [
+        os.path.join(local_workspace_dir, path)
+        for path in local_result_path_list]
+    if baseline_delta_info is None:
+        return result_path_list, False
+    baseline_path_list, delta_path_list = [
+        [os.path.join(local_workspace_dir, path) for path in path_list]
+        for path_list in baseline_delta_info]
+    missing_path_list = [
+        path for path in baseline_path_list if not os.path.exists(path)]
+    if missing_path_list:
+        LOGGER.error(
+            f'no baseline outputs {missing_path_list} so not calculating '
+            f'deltas for {local_workspace_dir}')
+        return result_path_list, True
+    for scenario_path, baseline_path, delta_path in zip(
+            result_path_list, baseline_path_list, delta_path_list):
+        scenario_info = geoprocessing.get_raster_info(scenario_path)
+        baseline_info = geoprocessing.get_raster_info(baseline_path)
+        if (scenario_info['raster_size'] != baseline_info['raster_size'] or
+                scenario_info['geotransform'] !=
+                baseline_info['geotransform']):
+            LOGGER.error(
+                f'{scenario_path} and {baseline_path} are not on the same '
+                f'grid so not calculating deltas for {local_workspace_dir}')
+            return result_path_list, True
+        geoprocessing.raster_calculator(
+            [(scenario_path, 1), (baseline_path, 1),
+             (scenario_info['nodata'][0], 'raw'),
+             (baseline_info['nodata'][0], 'raw')],
+            _delta_op, delta_path, gdal.GDT_Float32, GLOBAL_NODATA)
+    return result_path_list + delta_path_list, False
+
+
+def _job_span_args(args):
+    """Trace span arguments of a ``_execute_*_job`` call."""
+    telemetry_info = args['telemetry_info']
+    return {
+        'job': os.path.basename(args['local_workspace_dir']),
+        'scenario': args['result_suffix'],
+        'output': telemetry_info[1] if telemetry_info is not None else None,
+    }
+
+
+@pipeline_profiling.profile_job(lambda args: (
+    f'sdr_{os.path.basename(args["local_workspace_dir"])}_'
+    f'{args["result_suffix"]}'))
+@pipeline_trace.traced('sdr job', _job_span_args, category='job')
+@pipeline_logging.capture_job_log(lambda args: (
+    f'sdr_{os.path.basename(args["local_workspace_dir"])}_'
+    f'{args["result_suffix"]}'))
 def _execute_sdr_job(
         global_wgs84_bb, watersheds_path, local_workspace_dir, dem_path,
         erosivity_path, erodibility_path, lulc_path, biophysical_table_path,
         threshold_flow_accumulation, k_param, sdr_max, ic_0_param,
         target_pixel_size, biophysical_table_lucode_field,
-        stitch_raster_queue_map, result_suffix):
+        global_grid_info, zone_info, stitch_queue, telemetry_info,
+        local_result_path_list, result_suffix, baseline_delta_info=None,
+        zone_mosaic_path_list=None):
     """Worker to execute sdr and send signals to stitcher.
 
     Args:
@@ -686,80 +1543,159 @@ def _execute_sdr_job(
             biophysical_table_lucode_field
             result_suffix
 
-        stitch_raster_queue_map (dict): map of local result path to
-            the stitch queue to signal when job is done.
+        global_grid_info (tuple): (geotransform, (n_cols, n_rows),
+            mask_to_watersheds) of the global rasters, results are warped
+            onto this grid before they are sent to the stitcher and, if
+            ``mask_to_watersheds``, masked to ``watersheds_path``.
+        zone_info (tuple): if not None, (country_vector_path,
+            country_id_field) to rasterize basin and country zones next to
+            the results for the stitcher to aggregate by.
+        stitch_queue (queue): stitch queue to signal when the job is done.
+            Gets a ``(piece_path, local_workspace_dir, status)`` tuple,
+            see ``stitch_worker``.
+        telemetry_info (tuple): ``OutputTelemetry.worker_info`` to report
+            stitch backpressure and failures to, or ``None``.
+        local_result_path_list (list): paths of the outputs to stitch,
+            relative to ``local_workspace_dir``.
+        baseline_delta_info (tuple): if not None, deltas to stitch after
+            the outputs, see ``_job_stitch_path_list``.
+        zone_mosaic_path_list (list): if not None, mosaics of the inputs
+            in the job's UTM zone, in the order they're warped. The inputs
+            are cut out of them instead of warped.
 
     Returns:
         None.
     """
-    if not _watersheds_intersect(global_wgs84_bb, watersheds_path):
-        LOGGER.debug(f'{watersheds_path} does not overlap {global_wgs84_bb}')
-        for local_result_path, stitch_queue in stitch_raster_queue_map.items():
+    try:
+        if not _watersheds_intersect(global_wgs84_bb, watersheds_path):
+            LOGGER.debug(
+                f'{watersheds_path} does not overlap {global_wgs84_bb}')
             # indicate skipping
-            stitch_queue.put((None, 1))
-
-        return
-
-    local_sdr_taskgraph = taskgraph.TaskGraph(local_workspace_dir, -1)
-    dem_pixel_size = geoprocessing.get_raster_info(dem_path)['pixel_size']
-    base_raster_path_list = [
-        dem_path, erosivity_path, erodibility_path, lulc_path]
-    resample_method_list = ['bilinear', 'bilinear', 'bilinear', 'mode']
-
-    clipped_data_dir = os.path.join(local_workspace_dir, 'data')
-    os.makedirs(clipped_data_dir, exist_ok=True)
-    watershed_info = geoprocessing.get_vector_info(watersheds_path)
-    target_projection_wkt = watershed_info['projection_wkt']
-    watershed_bb = watershed_info['bounding_box']
-    lat_lng_bb = geoprocessing.transform_bounding_box(
-        watershed_bb, target_projection_wkt, osr.SRS_WKT_WGS84_LAT_LONG)
-
-    warped_raster_path_list = [
-        os.path.join(clipped_data_dir, os.path.basename(path))
-        for path in base_raster_path_list]
-
-    # TODO: figure out bounding box then individually warp so we don't
-    # re-warp stuff we already did
-    _warp_raster_stack(
-        local_sdr_taskgraph, base_raster_path_list, warped_raster_path_list,
-        resample_method_list, dem_pixel_size, target_pixel_size,
-        lat_lng_bb, osr.SRS_WKT_WGS84_LAT_LONG, watersheds_path)
-    local_sdr_taskgraph.join()
-
-    # clip to lat/lng bounding boxes
-    args = {
-        'workspace_dir': local_workspace_dir,
-        'dem_path': warped_raster_path_list[0],
-        'erosivity_path': warped_raster_path_list[1],
-        'erodibility_path': warped_raster_path_list[2],
-        'lulc_path': warped_raster_path_list[3],
-        'prealigned': True,
-        'watersheds_path': watersheds_path,
-        'biophysical_table_path': biophysical_table_path,
-        'threshold_flow_accumulation': threshold_flow_accumulation,
-        'k_param': k_param,
-        'sdr_max': sdr_max,
-        'ic_0_param': ic_0_param,
-        'results_suffix': result_suffix,
-        'biophysical_table_lucode_field': biophysical_table_lucode_field,
-        'single_outlet': geoprocessing.get_vector_info(
-            watersheds_path)['feature_count'] == 1,
-        'prealigned': True,
-        'reuse_dem': True,
-    }
-    sdr_c_factor.execute(args)
-    for local_result_path, stitch_queue in stitch_raster_queue_map.items():
-        stitch_queue.put(
-            (os.path.join(args['workspace_dir'], local_result_path), 1))
+            pipeline_telemetry.put_stitch_payload(
+                stitch_queue,
+                (None, local_workspace_dir, pipeline_telemetry.SKIPPED),
+                telemetry_info)
+            return
+
+        local_sdr_taskgraph = taskgraph.TaskGraph(local_workspace_dir, -1)
+        dem_pixel_size = geoprocessing.get_raster_info(dem_path)['pixel_size']
+        base_raster_path_list = [
+            dem_path, erosivity_path, erodibility_path, lulc_path]
+        resample_method_list = ['bilinear', 'bilinear', 'bilinear', 'mode']
+
+        clipped_data_dir = os.path.join(local_workspace_dir, 'data')
+        os.makedirs(clipped_data_dir, exist_ok=True)
+        watershed_info = geoprocessing.get_vector_info(watersheds_path)
+        target_projection_wkt = watershed_info['projection_wkt']
+        watershed_bb = watershed_info['bounding_box']
+        lat_lng_bb = geoprocessing.transform_bounding_box(
+            watershed_bb, target_projection_wkt, osr.SRS_WKT_WGS84_LAT_LONG)
+
+        warped_raster_path_list = [
+            os.path.join(clipped_data_dir, os.path.basename(path))
+            for path in base_raster_path_list]
+
+        job_id = os.path.basename(local_workspace_dir)
+        if zone_mosaic_path_list is not None:
+            with pipeline_trace.span(
+                    'extract zone windows', category='job', job=job_id,
+                    scenario=result_suffix):
+                _extract_zone_windows(
+                    zone_mosaic_path_list, warped_raster_path_list,
+                    watersheds_path)
+        else:
+            with pipeline_trace.span(
+                    'warp inputs', category='job', job=job_id,
+                    scenario=result_suffix):
+                _warp_raster_stack(
+                    local_sdr_taskgraph, base_raster_path_list,
+                    warped_raster_path_list, resample_method_list,
+                    dem_pixel_size, target_pixel_size, lat_lng_bb,
+                    osr.SRS_WKT_WGS84_LAT_LONG, watersheds_path)
+                local_sdr_taskgraph.join()
+
+        # clip to lat/lng bounding boxes
+        args = {
+            'workspace_dir': local_workspace_dir,
+            'dem_path': warped_raster_path_list[0],
+            'erosivity_path': warped_raster_path_list[1],
+            'erodibility_path': warped_raster_path_list[2],
+            'lulc_path': warped_raster_path_list[3],
+            'prealigned': True,
+            'watersheds_path': watersheds_path,
+            'biophysical_table_path': biophysical_table_path,
+            'threshold_flow_accumulation': threshold_flow_accumulation,
+            'k_param': k_param,
+            'sdr_max': sdr_max,
+            'ic_0_param': ic_0_param,
+            'results_suffix': result_suffix,
+            'biophysical_table_lucode_field': biophysical_table_lucode_field,
+            'single_outlet': geoprocessing.get_vector_info(
+                watersheds_path)['feature_count'] == 1,
+            'prealigned': True,
+            'reuse_dem': True,
+        }
+        with pipeline_trace.span(
+                'model execute', category='job', job=job_id,
+                scenario=result_suffix):
+            sdr_c_factor.execute(args)
+        # reproject here rather than in the stitcher so it runs in parallel
+        global_grid_piece_path = _global_grid_piece_path(
+            local_workspace_dir, result_suffix)
+        global_geotransform, global_raster_size, mask_to_watersheds = (
+            global_grid_info)
+        with pipeline_trace.span(
+                'global grid piece', category='job', job=job_id,
+                scenario=result_suffix):
+            stitch_path_list, deltas_missing = _job_stitch_path_list(
+                local_workspace_dir, local_result_path_list,
+                baseline_delta_info)
+            piece_written = _write_global_grid_piece(
+                stitch_path_list, global_geotransform, global_raster_size,
+                global_grid_piece_path,
+                mask_vector_path=(
+                    watersheds_path if mask_to_watersheds else None))
+            if piece_written and zone_info is not None:
+                _write_global_grid_zone_piece(
+                    global_grid_piece_path, watersheds_path, zone_info)
+        job_status = pipeline_telemetry.COMPLETED
+        if deltas_missing:
+            # the scenario outputs are still stitched, but an output with
+            # holes in its deltas has to show up as a failure
+            pipeline_telemetry.report_job_failure(
+                telemetry_info, local_workspace_dir)
+            job_status = pipeline_telemetry.FAILED
+        pipeline_telemetry.put_stitch_payload(
+            stitch_queue,
+            (global_grid_piece_path if piece_written else None,
+             local_workspace_dir, job_status),
+            telemetry_info)
+    except Exception:
+        pipeline_telemetry.report_job_failure(
+            telemetry_info, local_workspace_dir)
+        # so the stitcher releases the workspace
+        pipeline_telemetry.put_stitch_payload(
+            stitch_queue,
+            (None, local_workspace_dir, pipeline_telemetry.FAILED),
+            telemetry_info)
+        raise
 
 
+@pipeline_profiling.profile_job(lambda args: (
+    f'ndr_{os.path.basename(args["local_workspace_dir"])}_'
+    f'{args["result_suffix"]}'))
+@pipeline_trace.traced('ndr job', _job_span_args, category='job')
+@pipeline_logging.capture_job_log(lambda args: (
+    f'ndr_{os.path.basename(args["local_workspace_dir"])}_'
+    f'{args["result_suffix"]}'))
 def _execute_ndr_job(
         global_wgs84_bb, watersheds_path, local_workspace_dir, dem_path,
         lulc_path,
         runoff_proxy_path, fertilizer_path, biophysical_table_path,
         threshold_flow_accumulation, k_param, target_pixel_size,
-        biophysical_table_lucode_field, stitch_raster_queue_map,
-        result_suffix):
+        biophysical_table_lucode_field, global_grid_info, zone_info,
+        stitch_queue, telemetry_info, local_result_path_list, result_suffix,
+        baseline_delta_info=None, zone_mosaic_path_list=None):
     """Execute NDR for watershed and push to stitch raster.
 
         Args:
@@ -796,66 +1732,140 @@ def _execute_ndr_job(
             projection.
         args['single_outlet'] (str): if True only one drain is modeled, either
             a large sink or the lowest pixel on the edge of the dem.
+        global_grid_info (tuple): (geotransform, (n_cols, n_rows),
+            mask_to_watersheds) of the global rasters, results are warped
+            onto this grid before they are sent to the stitcher and, if
+            ``mask_to_watersheds``, masked to ``watersheds_path``.
+        zone_info (tuple): if not None, (country_vector_path,
+            country_id_field) to rasterize basin and country zones next to
+            the results for the stitcher to aggregate by.
+        stitch_queue (queue): stitch queue to signal when the job is done.
+        telemetry_info (tuple): ``OutputTelemetry.worker_info`` to report
+            stitch backpressure and failures to, or ``None``.
+        local_result_path_list (list): paths of the outputs to stitch,
+            relative to ``local_workspace_dir``.
         result_suffix (str): string to append to NDR files.
+        baseline_delta_info (tuple): if not None, deltas to stitch after
+            the outputs, see ``_job_stitch_path_list``.
+        zone_mosaic_path_list (list): if not None, mosaics of the inputs
+            in the job's UTM zone, in the order they're warped. The inputs
+            are cut out of them instead of warped.
     """
-    if not _watersheds_intersect(global_wgs84_bb, watersheds_path):
-        for local_result_path, stitch_queue in stitch_raster_queue_map.items():
+    try:
+        if not _watersheds_intersect(global_wgs84_bb, watersheds_path):
             # indicate skipping
-            stitch_queue.put((None, 1))
-        return
-
-    local_ndr_taskgraph = taskgraph.TaskGraph(local_workspace_dir, -1)
-    dem_pixel_size = geoprocessing.get_raster_info(dem_path)['pixel_size']
-    base_raster_path_list = [
-        dem_path, runoff_proxy_path, lulc_path, fertilizer_path]
-    resample_method_list = ['bilinear', 'bilinear', 'mode', 'bilinear']
-
-    clipped_data_dir = os.path.join(local_workspace_dir, 'data')
-    os.makedirs(clipped_data_dir, exist_ok=True)
-    watershed_info = geoprocessing.get_vector_info(watersheds_path)
-    target_projection_wkt = watershed_info['projection_wkt']
-    watershed_bb = watershed_info['bounding_box']
-    lat_lng_bb = geoprocessing.transform_bounding_box(
-        watershed_bb, target_projection_wkt, osr.SRS_WKT_WGS84_LAT_LONG)
-
-    warped_raster_path_list = [
-        os.path.join(clipped_data_dir, os.path.basename(path))
-        for path in base_raster_path_list]
-
-    _warp_raster_stack(
-        local_ndr_taskgraph, base_raster_path_list, warped_raster_path_list,
-        resample_method_list, dem_pixel_size, target_pixel_size,
-        lat_lng_bb, osr.SRS_WKT_WGS84_LAT_LONG, watersheds_path)
-    local_ndr_taskgraph.join()
-
-    args = {
-        'workspace_dir': local_workspace_dir,
-        'dem_path': warped_raster_path_list[0],
-        'runoff_proxy_path': warped_raster_path_list[1],
-        'lulc_path': warped_raster_path_list[2],
-        'fertilizer_path': warped_raster_path_list[3],
-        'watersheds_path': watersheds_path,
-        'biophysical_table_path': biophysical_table_path,
-        'threshold_flow_accumulation': threshold_flow_accumulation,
-        'k_param': k_param,
-        'target_pixel_size': (target_pixel_size, -target_pixel_size),
-        'target_projection_wkt': target_projection_wkt,
-        'single_outlet': geoprocessing.get_vector_info(
-            watersheds_path)['feature_count'] == 1,
-        'biophyisical_lucode_fieldname': biophysical_table_lucode_field,
-        'crit_len_n': 150.0,
-        'prealigned': True,
-        'reuse_dem': True,
-        'results_suffix': result_suffix,
-    }
-    ndr_mfd_plus.execute(args)
-    for local_result_path, stitch_queue in stitch_raster_queue_map.items():
-        stitch_queue.put(
-            (os.path.join(args['workspace_dir'], local_result_path), 1))
+            pipeline_telemetry.put_stitch_payload(
+                stitch_queue,
+                (None, local_workspace_dir, pipeline_telemetry.SKIPPED),
+                telemetry_info)
+            return
+
+        local_ndr_taskgraph = taskgraph.TaskGraph(local_workspace_dir, -1)
+        dem_pixel_size = geoprocessing.get_raster_info(dem_path)['pixel_size']
+        base_raster_path_list = [
+            dem_path, runoff_proxy_path, lulc_path, fertilizer_path]
+        resample_method_list = ['bilinear', 'bilinear', 'mode', 'bilinear']
+
+        clipped_data_dir = os.path.join(local_workspace_dir, 'data')
+        os.makedirs(clipped_data_dir, exist_ok=True)
+        watershed_info = geoprocessing.get_vector_info(watersheds_path)
+        target_projection_wkt = watershed_info['projection_wkt']
+        watershed_bb = watershed_info['bounding_box']
+        lat_lng_bb = geoprocessing.transform_bounding_box(
+            watershed_bb, target_projection_wkt, osr.SRS_WKT_WGS84_LAT_LONG)
+
+        warped_raster_path_list = [
+            os.path.join(clipped_data_dir, os.path.basename(path))
+            for path in base_raster_path_list]
+
+        job_id = os.path.basename(local_workspace_dir)
+        if zone_mosaic_path_list is not None:
+            with pipeline_trace.span(
+                    'extract zone windows', category='job', job=job_id,
+                    scenario=result_suffix):
+                _extract_zone_windows(
+                    zone_mosaic_path_list, warped_raster_path_list,
+                    watersheds_path)
+        else:
+            with pipeline_trace.span(
+                    'warp inputs', category='job', job=job_id,
+                    scenario=result_suffix):
+                _warp_raster_stack(
+                    local_ndr_taskgraph, base_raster_path_list,
+                    warped_raster_path_list, resample_method_list,
+                    dem_pixel_size, target_pixel_size, lat_lng_bb,
+                    osr.SRS_WKT_WGS84_LAT_LONG, watersheds_path)
+                local_ndr_taskgraph.join()
+
+        args = {
+            'workspace_dir': local_workspace_dir,
+            'dem_path': warped_raster_path_list[0],
+            'runoff_proxy_path': warped_raster_path_list[1],
+            'lulc_path': warped_raster_path_list[2],
+            'fertilizer_path': warped_raster_path_list[3],
+            'watersheds_path': watersheds_path,
+            'biophysical_table_path': biophysical_table_path,
+            'threshold_flow_accumulation': threshold_flow_accumulation,
+            'k_param': k_param,
+            'target_pixel_size': (target_pixel_size, -target_pixel_size),
+            'target_projection_wkt': target_projection_wkt,
+            'single_outlet': geoprocessing.get_vector_info(
+                watersheds_path)['feature_count'] == 1,
+            'biophyisical_lucode_fieldname': biophysical_table_lucode_field,
+            'crit_len_n': 150.0,
+            'prealigned': True,
+            'reuse_dem': True,
+            'results_suffix': result_suffix,
+        }
+        with pipeline_trace.span(
+                'model execute', category='job', job=job_id,
+                scenario=result_suffix):
+            ndr_mfd_plus.execute(args)
+        # reproject here rather than in the stitcher so it runs in parallel
+        global_grid_piece_path = _global_grid_piece_path(
+            local_workspace_dir, result_suffix)
+        global_geotransform, global_raster_size, mask_to_watersheds = (
+            global_grid_info)
+        with pipeline_trace.span(
+                'global grid piece', category='job', job=job_id,
+                scenario=result_suffix):
+            stitch_path_list, deltas_missing = _job_stitch_path_list(
+                local_workspace_dir, local_result_path_list,
+                baseline_delta_info)
+            piece_written = _write_global_grid_piece(
+                stitch_path_list, global_geotransform, global_raster_size,
+                global_grid_piece_path,
+                mask_vector_path=(
+                    watersheds_path if mask_to_watersheds else None))
+            if piece_written and zone_info is not None:
+                _write_global_grid_zone_piece(
+                    global_grid_piece_path, watersheds_path, zone_info)
+        job_status = pipeline_telemetry.COMPLETED
+        if deltas_missing:
+            # the scenario outputs are still stitched, but an output with
+            # holes in its deltas has to show up as a failure
+            pipeline_telemetry.report_job_failure(
+                telemetry_info, local_workspace_dir)
+            job_status = pipeline_telemetry.FAILED
+        pipeline_telemetry.put_stitch_payload(
+            stitch_queue,
+            (global_grid_piece_path if piece_written else None,
+             local_workspace_dir, job_status),
+            telemetry_info)
+    except Exception:
+        pipeline_telemetry.report_job_failure(
+            telemetry_info, local_workspace_dir)
+        # so the stitcher releases the workspace
+        pipeline_telemetry.put_stitch_payload(
+            stitch_queue,
+            (None, local_workspace_dir, pipeline_telemetry.FAILED),
+            telemetry_info)
+        raise
 
 
 def _clean_workspace_worker(
-        expected_signal_count, stitch_done_queue, keep_intermediate_files):
+        expected_signal_count, stitch_done_queue, keep_intermediate_files,
+        job_workspace_manager=None):
     """Removes workspaces when completed.
 
     Args:
@@ -866,6 +1876,9 @@ def _clean_workspace_worker(
             the directory will be removed. Recieving `None` will terminate
             the process.
         keep_intermediate_files (bool): keep intermediate files if true
+        job_workspace_manager (workspace_manager.WorkspaceManager): if not
+            None, done workspaces are released to it to remove or keep
+            within its budget instead.
 
     Returns:
         None
@@ -879,84 +1892,1388 @@ def _clean_workspace_worker(
                 return
             count_dict[dir_path] += 1
             if count_dict[dir_path] == expected_signal_count:
-                LOGGER.info(
+                LOGGER.debug(
                     f'removing {dir_path} after {count_dict[dir_path]} '
                     f'signals')
-                if not keep_intermediate_files:
-                    shutil.rmtree(dir_path)
+                with pipeline_trace.span(
+                        'release workspace', category='cleanup',
+                        job=os.path.basename(dir_path)):
+                    if job_workspace_manager is not None:
+                        job_workspace_manager.release(
+                            dir_path, keep_intermediate_files)
+                    elif not keep_intermediate_files and os.path.isdir(
+                            dir_path):
+                        shutil.rmtree(dir_path)
                 del count_dict[dir_path]
     except Exception:
         LOGGER.exception('error on clean_workspace_worker')
 
 
+def _wgs84_pixel_area_m2(pixel_size_deg, center_lat_array):
+    """Calculate m^2 area of square wgs84 pixels.
+
+    Args:
+        pixel_size_deg (float): length of a side of the pixel in degrees.
+        center_lat_array (numpy.ndarray): latitudes of the pixel centers.
+
+    Returns:
+        numpy.ndarray of the same shape as ``center_lat_array`` with the area
+        of each pixel in m^2.
+    """
+    a = 6378137  # meters
+    b = 6356752.3142  # meters
+    e = numpy.sqrt(1 - (b/a)**2)
+    area_list = []
+    for f in [center_lat_array+pixel_size_deg/2,
+              center_lat_array-pixel_size_deg/2]:
+        sin_f = numpy.sin(numpy.radians(f))
+        zm = 1 - e*sin_f
+        zp = 1 + e*sin_f
+        area_list.append(
+            numpy.pi * b**2 * (
+                numpy.log(zp/zm) / (2*e) + sin_f / (zp*zm)))
+    return numpy.abs(pixel_size_deg / 360. * (area_list[0] - area_list[1]))
+
+
+def _global_pixel_window(wgs84_bb, global_geotransform, global_raster_size):
+    """Pixel window of the global grid that covers ``wgs84_bb``.
+
+    Args:
+        wgs84_bb (list): [minx, miny, maxx, maxy] in lat/lng.
+        global_geotransform (list): geotransform of the global raster.
+        global_raster_size (tuple): (n_cols, n_rows) of the global raster.
+
+    Returns:
+        (xoff, yoff, win_xsize, win_ysize) tuple clipped to the global raster
+        or ``None`` if the bounding box does not overlap it.
+    """
+    gt = global_geotransform
+    x_min = max(0, int(numpy.floor((wgs84_bb[0]-gt[0])/gt[1])))
+    x_max = min(
+        global_raster_size[0], int(numpy.ceil((wgs84_bb[2]-gt[0])/gt[1])))
+    y_min = max(0, int(numpy.floor((wgs84_bb[3]-gt[3])/gt[5])))
+    y_max = min(
+        global_raster_size[1], int(numpy.ceil((wgs84_bb[1]-gt[3])/gt[5])))
+    if x_min >= x_max or y_min >= y_max:
+        return None
+    return (x_min, y_min, x_max-x_min, y_max-y_min)
+
+
+def _global_tile_index_set(
+        wgs84_bb, global_geotransform, global_raster_size, pad=1):
+    """Set of (tile_x, tile_y) global raster tiles that ``wgs84_bb`` touches.
+
+    ``pad`` pixels are added around the window so nearest neighbor edge
+    pixels that land just outside the bounding box are still covered.
+    """
+    window = _global_pixel_window(
+        wgs84_bb, global_geotransform, global_raster_size)
+    if window is None:
+        return set()
+    xoff, yoff, win_xsize, win_ysize = window
+    tile_x_min = max(0, xoff-pad) // STITCH_TILE_SIZE
+    tile_y_min = max(0, yoff-pad) // STITCH_TILE_SIZE
+    tile_x_max = (min(
+        global_raster_size[0], xoff+win_xsize+pad)-1) // STITCH_TILE_SIZE
+    tile_y_max = (min(
+        global_raster_size[1], yoff+win_ysize+pad)-1) // STITCH_TILE_SIZE
+    return set(itertools.product(
+        range(tile_x_min, tile_x_max+1), range(tile_y_min, tile_y_max+1)))
+
+
+def _warp_stack_to_global_grid(
+        base_raster_path_list, global_geotransform, global_raster_size):
+    """Reproject a job's local results onto a window of the global grid.
+
+    The rasters are stacked as bands of one VRT and warped in a single pass
+    so the coordinate transformation and area weights are computed once for
+    all of them. Results are nearest neighbor resampled and area weighted
+    from their projected m^2 pixel area to the m^2 area of the wgs84 pixel
+    they land in, the same as ``stitch_rasters(area_weight_m2_to_wgs84=True)``.
+
+    Args:
+        base_raster_path_list (list): paths to projected local result rasters
+            that share the same pixel grid.
+        global_geotransform (list): geotransform of the global raster.
+        global_raster_size (tuple): (n_cols, n_rows) of the global raster.
+
+    Returns:
+        (array, valid_mask, xoff, yoff) where ``array`` is the float32
+        (n_rasters, rows, cols) stack of area weighted results on the global
+        grid window starting at ``(xoff, yoff)`` and ``valid_mask`` is True
+        where ``array`` has data. The window is expanded to whole global
+        tiles. ``None`` if the rasters don't overlap the global grid.
+    """
+    base_info = geoprocessing.get_raster_info(base_raster_path_list[0])
+    stack_vrt = gdal.BuildVRT(
+        '', base_raster_path_list,
+        options=gdal.BuildVRTOptions(separate=True))
+    vrt_gt = stack_vrt.GetGeoTransform()
+    vrt_bb = [
+        vrt_gt[0], vrt_gt[3]+stack_vrt.RasterYSize*vrt_gt[5],
+        vrt_gt[0]+stack_vrt.RasterXSize*vrt_gt[1], vrt_gt[3]]
+    base_wgs84_bb = geoprocessing.transform_bounding_box(
+        vrt_bb, base_info['projection_wkt'], osr.SRS_WKT_WGS84_LAT_LONG)
+    window = _global_pixel_window(
+        base_wgs84_bb, global_geotransform, global_raster_size)
+    if window is None:
+        return None
+    xoff, yoff, win_xsize, win_ysize = window
+    # expand to whole global tiles so stitching is block aligned
+    tile_x_max = min(global_raster_size[0], -(
+        -(xoff+win_xsize) // STITCH_TILE_SIZE) * STITCH_TILE_SIZE)
+    tile_y_max = min(global_raster_size[1], -(
+        -(yoff+win_ysize) // STITCH_TILE_SIZE) * STITCH_TILE_SIZE)
+    xoff = (xoff // STITCH_TILE_SIZE) * STITCH_TILE_SIZE
+    yoff = (yoff // STITCH_TILE_SIZE) * STITCH_TILE_SIZE
+    win_xsize = tile_x_max - xoff
+    win_ysize = tile_y_max - yoff
+    gt = global_geotransform
+    target_bb = [
+        gt[0]+xoff*gt[1], gt[3]+(yoff+win_ysize)*gt[5],
+        gt[0]+(xoff+win_xsize)*gt[1], gt[3]+yoff*gt[5]]
+    nodata_list = []
+    for band_index in range(stack_vrt.RasterCount):
+        nodata = stack_vrt.GetRasterBand(band_index+1).GetNoDataValue()
+        nodata_list.append(GLOBAL_NODATA if nodata is None else nodata)
+    warped_raster = gdal.Warp(
+        '', stack_vrt, options=gdal.WarpOptions(
+            format='MEM', outputBounds=target_bb,
+            width=win_xsize, height=win_ysize,
+            dstSRS=osr.SRS_WKT_WGS84_LAT_LONG, resampleAlg='near',
+            dstNodata=' '.join([str(v) for v in nodata_list]),
+            outputType=gdal.GDT_Float32))
+    stack_vrt = None
+    array = warped_raster.ReadAsArray().reshape(
+        (len(nodata_list), win_ysize, win_xsize))
+    warped_raster = None
+
+    valid_mask = ~numpy.isclose(
+        array, numpy.array(nodata_list)[:, numpy.newaxis, numpy.newaxis])
+    base_pixel_area_m2 = abs(
+        base_info['pixel_size'][0] * base_info['pixel_size'][1])
+    center_lat_array = gt[3] + (
+        yoff + numpy.arange(win_ysize) + 0.5) * gt[5]
+    area_weight = (_wgs84_pixel_area_m2(
+        abs(gt[1]), center_lat_array) / base_pixel_area_m2).astype(
+            numpy.float32)
+    array *= area_weight[numpy.newaxis, :, numpy.newaxis]
+    return array, valid_mask, xoff, yoff
+
+
+def _write_global_grid_piece(
+        base_raster_path_list, global_geotransform, global_raster_size,
+        target_piece_path, mask_vector_path=None):
+    """Warp a job's results onto the global grid and save them to stitch.
+
+    Called on the compute workers so the stitcher only has to merge
+    already reprojected, area weighted, tile aligned blocks.
+
+    Args:
+        base_raster_path_list (list): paths to projected local result rasters
+            that share the same pixel grid.
+        global_geotransform (list): geotransform of the global raster.
+        global_raster_size (tuple): (n_cols, n_rows) of the global raster.
+        target_piece_path (str): path to the multiband raster to create, it
+            has a band per base raster in the same order.
+        mask_vector_path (str): if not None, path to the job's watersheds.
+            Only global pixels whose centers are inside them are kept, the
+            rest of the piece is nodata. Watersheds don't overlap so every
+            global pixel then comes from at most one job.
+
+    Returns:
+        True if the piece was written, False if the results don't overlap
+        the global grid.
+    """
+    warp_result = _warp_stack_to_global_grid(
+        base_raster_path_list, global_geotransform, global_raster_size)
+    if warp_result is None:
+        return False
+    array, valid_mask, xoff, yoff = warp_result
+    n_bands, win_ysize, win_xsize = array.shape
+    gt = global_geotransform
+    piece_gt = [gt[0]+xoff*gt[1], gt[1], 0, gt[3]+yoff*gt[5], 0, gt[5]]
+    if mask_vector_path is not None:
+        valid_mask &= _watershed_pixel_mask(
+            mask_vector_path, piece_gt, win_xsize, win_ysize)[numpy.newaxis]
+    array[~valid_mask] = GLOBAL_NODATA
+    # write to a temporary file so a partial piece is never stitched
+    working_piece_path = '%s_working%s' % os.path.splitext(target_piece_path)
+    driver = gdal.GetDriverByName('GTiff')
+    piece_raster = driver.Create(
+        working_piece_path, win_xsize, win_ysize, n_bands, gdal.GDT_Float32,
+        options=GLOBAL_RASTER_CREATION_OPTIONS)
+    piece_raster.SetProjection(osr.SRS_WKT_WGS84_LAT_LONG)
+    piece_raster.SetGeoTransform(piece_gt)
+    for band_index in range(n_bands):
+        piece_band = piece_raster.GetRasterBand(band_index+1)
+        piece_band.SetNoDataValue(GLOBAL_NODATA)
+        piece_band.WriteArray(array[band_index])
+    piece_band = None
+    piece_raster = None
+    os.replace(working_piece_path, target_piece_path)
+    return True
+
+
+def _watershed_pixel_mask(
+        vector_path, geotransform, n_cols, n_rows,
+        projection_wkt=osr.SRS_WKT_WGS84_LAT_LONG):
+    """Boolean (rows, cols) array, True where a pixel center is in a polygon.
+
+    Args:
+        vector_path (str): path to a polygon vector, reprojected on the fly.
+        geotransform (list): geotransform of the grid to mask.
+        n_cols, n_rows (int): size of the grid to mask.
+        projection_wkt (str): projection of the grid, wgs84 by default.
+
+    Returns:
+        numpy.ndarray of the pixels covered by ``vector_path``.
+    """
+    mask_raster = gdal.GetDriverByName('MEM').Create(
+        '', n_cols, n_rows, 1, gdal.GDT_Byte)
+    mask_raster.SetProjection(projection_wkt)
+    mask_raster.SetGeoTransform(geotransform)
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    gdal.RasterizeLayer(mask_raster, [1], layer, burn_values=[1])
+    layer = None
+    vector = None
+    mask_array = mask_raster.ReadAsArray().astype(bool)
+    mask_raster = None
+    return mask_array
+
+
+def _read_global_grid_piece(piece_path, global_geotransform):
+    """Read a piece made by ``_write_global_grid_piece``.
+
+    Args:
+        piece_path (str): path to the piece raster.
+        global_geotransform (list): geotransform of the global raster.
+
+    Returns:
+        (array, valid_mask, xoff, yoff) of the (n_bands, rows, cols) piece
+        at global pixel offset ``(xoff, yoff)``.
+    """
+    piece_raster = gdal.OpenEx(piece_path, gdal.OF_RASTER)
+    piece_gt = piece_raster.GetGeoTransform()
+    xoff = int(round(
+        (piece_gt[0]-global_geotransform[0]) / global_geotransform[1]))
+    yoff = int(round(
+        (piece_gt[3]-global_geotransform[3]) / global_geotransform[5]))
+    array = piece_raster.ReadAsArray().reshape((
+        piece_raster.RasterCount, piece_raster.RasterYSize,
+        piece_raster.RasterXSize))
+    piece_raster = None
+    valid_mask = ~numpy.isclose(array, GLOBAL_NODATA)
+    return array, valid_mask, xoff, yoff
+
+
+def _global_grid_piece_path(local_workspace_dir, result_suffix):
+    """Path a job writes its global grid piece to."""
+    if result_suffix is None:
+        return os.path.join(local_workspace_dir, 'global_grid_piece.tif')
+    return os.path.join(
+        local_workspace_dir, f'global_grid_piece_{result_suffix}.tif')
+
+
+def _global_grid_zone_piece_path(piece_path):
+    """Path to the zones of the global grid piece at ``piece_path``."""
+    return '%s_zones%s' % os.path.splitext(piece_path)
+
+
+def _rasterize_zone_codes(vector_path, id_field, target_raster, band_index):
+    """Burn a code per feature of ``vector_path`` into a band.
+
+    Codes are 1 based, 0 is left where no feature covers a pixel center.
+    Features are reprojected to the raster on the fly.
+
+    Args:
+        vector_path (str): path to a polygon vector.
+        id_field (str): field with the id of each feature's zone.
+        target_raster (gdal.Dataset): raster to burn into.
+        band_index (int): 1 based band of ``target_raster`` to burn.
+
+    Returns:
+        list of zone ids where code ``i`` is the zone id at index ``i-1``.
+    """
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    gt = target_raster.GetGeoTransform()
+    layer_srs = layer.GetSpatialRef()
+    if layer_srs is not None and layer_srs.IsGeographic():
+        # skip the features that can't touch the raster
+        layer.SetSpatialFilterRect(
+            gt[0], gt[3]+target_raster.RasterYSize*gt[5],
+            gt[0]+target_raster.RasterXSize*gt[1], gt[3])
+    zone_vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    zone_layer = zone_vector.CreateLayer('zones', layer_srs, ogr.wkbUnknown)
+    zone_layer.CreateField(ogr.FieldDefn('zone_code', ogr.OFTInteger))
+    zone_id_list = []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        zone_id_list.append(str(feature.GetField(id_field)))
+        zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+        zone_feature.SetGeometry(geom.Clone())
+        zone_feature.SetField('zone_code', len(zone_id_list))
+        zone_layer.CreateFeature(zone_feature)
+    zone_feature = None
+    feature = None
+    layer = None
+    vector = None
+    gdal.RasterizeLayer(
+        target_raster, [band_index], zone_layer,
+        options=['ATTRIBUTE=zone_code'])
+    zone_layer = None
+    zone_vector = None
+    return zone_id_list
+
+
+def _write_global_grid_zone_piece(piece_path, watersheds_path, zone_info):
+    """Rasterize the basin and country of each pixel of a job's piece.
+
+    Band 1 is the basin code and band 2 the country code, the ids they
+    stand for are stored as json in the ``zone_id_lists`` metadata item.
+    Pixels are assigned by their center so each one lands in at most one
+    basin, and so in at most one job.
+
+    Args:
+        piece_path (str): piece made by ``_write_global_grid_piece``.
+        watersheds_path (str): path to the job's watersheds, made by
+            ``_create_fid_subset`` so they have a ``BASIN_ID_FIELD``.
+        zone_info (tuple): (country_vector_path, country_id_field), the
+            country vector may be None to only aggregate by basin.
+
+    Returns:
+        True if the zones were written, False if the watersheds have no
+        basin ids.
+    """
+    country_vector_path, country_id_field = zone_info
+    watershed_vector = gdal.OpenEx(watersheds_path, gdal.OF_VECTOR)
+    has_basin_id = watershed_vector.GetLayer().FindFieldIndex(
+        BASIN_ID_FIELD, True) >= 0
+    watershed_vector = None
+    if not has_basin_id:
+        LOGGER.warning(
+            f'{watersheds_path} has no {BASIN_ID_FIELD}, delete the '
+            f'watershed subsets to rebuild them for zonal aggregation')
+        return False
+    piece_info = geoprocessing.get_raster_info(piece_path)
+    zone_raster = gdal.GetDriverByName('MEM').Create(
+        '', *piece_info['raster_size'], 2, gdal.GDT_Int32)
+    zone_raster.SetProjection(piece_info['projection_wkt'])
+    zone_raster.SetGeoTransform(piece_info['geotransform'])
+    zone_id_lists = {
+        BASIN_ZONE: _rasterize_zone_codes(
+            watersheds_path, BASIN_ID_FIELD, zone_raster, 1),
+        COUNTRY_ZONE: [],
+    }
+    if country_vector_path is not None:
+        zone_id_lists[COUNTRY_ZONE] = _rasterize_zone_codes(
+            country_vector_path, country_id_field, zone_raster, 2)
+    zone_raster.SetMetadataItem('zone_id_lists', json.dumps(zone_id_lists))
+    zone_piece_path = _global_grid_zone_piece_path(piece_path)
+    working_zone_piece_path = '%s_working%s' % os.path.splitext(
+        zone_piece_path)
+    gdal.Translate(
+        working_zone_piece_path, zone_raster, options=gdal.TranslateOptions(
+            format='GTiff', creationOptions=('TILED=YES', 'COMPRESS=LZW')))
+    zone_raster = None
+    os.replace(working_zone_piece_path, zone_piece_path)
+    return True
+
+
+def _read_global_grid_zone_piece(zone_piece_path):
+    """Read zones made by ``_write_global_grid_zone_piece``.
+
+    Returns:
+        (zone_array, zone_id_lists) where ``zone_array`` is the
+        (2, rows, cols) basin and country code array and ``zone_id_lists``
+        maps ``BASIN_ZONE`` and ``COUNTRY_ZONE`` to their lists of ids.
+    """
+    zone_raster = gdal.OpenEx(zone_piece_path, gdal.OF_RASTER)
+    zone_array = zone_raster.ReadAsArray()
+    zone_id_lists = json.loads(zone_raster.GetMetadataItem('zone_id_lists'))
+    zone_raster = None
+    return zone_array, zone_id_lists
+
+
+def _tile_window(tile_index, raster_size):
+    """(xoff, yoff, win_xsize, win_ysize) of a tile clipped to the raster."""
+    xoff = tile_index[0] * STITCH_TILE_SIZE
+    yoff = tile_index[1] * STITCH_TILE_SIZE
+    return (
+        xoff, yoff,
+        min(STITCH_TILE_SIZE, raster_size[0]-xoff),
+        min(STITCH_TILE_SIZE, raster_size[1]-yoff))
+
+
+def _used_block_bytes(raster_path):
+    """Bytes of a GeoTIFF's blocks that its bands and overviews point to."""
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    # pixel interleaved bands point to the same blocks
+    block_set = set()
+    for band_id in range(raster.RasterCount):
+        band = raster.GetRasterBand(band_id+1)
+        for level_band in [band] + [
+                band.GetOverview(overview_index)
+                for overview_index in range(band.GetOverviewCount())]:
+            block_xsize, block_ysize = level_band.GetBlockSize()
+            for block_row in range(
+                    -(-level_band.YSize // block_ysize)):
+                for block_col in range(
+                        -(-level_band.XSize // block_xsize)):
+                    block_offset = level_band.GetMetadataItem(
+                        f'BLOCK_OFFSET_{block_col}_{block_row}', 'TIFF')
+                    if block_offset is None:
+                        # sparse, never written
+                        continue
+                    block_set.add((block_offset, int(
+                        level_band.GetMetadataItem(
+                            f'BLOCK_SIZE_{block_col}_{block_row}',
+                            'TIFF'))))
+    raster = None
+    return sum(block_bytes for _, block_bytes in block_set)
+
+
+def _compact_raster(raster_path):
+    """Rewrite a raster so blocks appended by in-place updates are packed.
+
+    Skipped unless the unused blocks are at least
+    ``COMPACT_MIN_UNUSED_FRACTION`` of the file, so a rerun that updates a
+    few watersheds doesn't rewrite the whole output.
+    """
+    file_bytes = os.path.getsize(raster_path)
+    unused_bytes = file_bytes - _used_block_bytes(raster_path)
+    if unused_bytes < COMPACT_MIN_UNUSED_FRACTION * file_bytes:
+        LOGGER.info(
+            f'not compacting {raster_path}, {unused_bytes} of its '
+            f'{file_bytes} bytes are unused')
+        return
+    LOGGER.info(
+        f'compacting {raster_path}, {unused_bytes} of its {file_bytes} '
+        f'bytes are unused')
+    compact_raster_path = '%s_compact%s' % os.path.splitext(raster_path)
+    gdal.Translate(
+        compact_raster_path, raster_path, options=gdal.TranslateOptions(
+            format='GTiff', creationOptions=(
+                GLOBAL_RASTER_CREATION_OPTIONS+('COPY_SRC_OVERVIEWS=YES',))))
+    os.replace(compact_raster_path, raster_path)
+
+
+def _sum_pool_2(array):
+    """Sum 2x2 blocks of a 2D array, odd edges are padded with 0."""
+    n_rows, n_cols = array.shape
+    if n_rows % 2 or n_cols % 2:
+        array = numpy.pad(array, ((0, n_rows % 2), (0, n_cols % 2)))
+    return array.reshape(
+        array.shape[0]//2, 2, array.shape[1]//2, 2).sum(axis=(1, 3))
+
+
+def _write_overview_windows(band_list, xoff, yoff, array, nodata):
+    """Update the overviews that cover a window just written to bands.
+
+    Each overview pixel is the average of the valid full resolution pixels
+    under it, computed from the window alone. The window must start on a
+    multiple of the largest overview factor, which holds for stitch tiles.
+
+    Args:
+        band_list (list): bands whose overview ``i`` has a factor of
+            ``GLOBAL_OVERVIEW_FACTOR_LIST[i]``. Bands without overviews are
+            skipped.
+        xoff, yoff (int): pixel offset of the window in the bands.
+        array (numpy.ndarray): (n_bands, rows, cols) values of the window.
+        nodata (float): nodata value of the bands.
+
+    Returns:
+        None
+    """
+    for band, band_array in zip(band_list, array):
+        n_overviews = band.GetOverviewCount()
+        if n_overviews == 0:
+            continue
+        valid_mask = ~numpy.isclose(band_array, nodata)
+        value_sum = numpy.where(valid_mask, band_array, 0).astype(
+            numpy.float64)
+        count = valid_mask.astype(numpy.int32)
+        for overview_index in range(n_overviews):
+            # successive powers of 2 so each level pools the one before
+            value_sum = _sum_pool_2(value_sum)
+            count = _sum_pool_2(count)
+            factor = GLOBAL_OVERVIEW_FACTOR_LIST[overview_index]
+            overview_array = numpy.full(
+                value_sum.shape, nodata, dtype=numpy.float32)
+            valid_mask = count > 0
+            overview_array[valid_mask] = (
+                value_sum[valid_mask] / count[valid_mask])
+            band.GetOverview(overview_index).WriteArray(
+                overview_array, xoff=xoff//factor, yoff=yoff//factor)
+
+
+class _GlobalRasterTileStore:
+    """Read and write tiles of a single global GeoTIFF."""
+
+    def __init__(self, raster_path):
+        """Open ``raster_path`` for update."""
+        self.raster_path = raster_path
+        self._raster = gdal.OpenEx(
+            raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        self._band_list = [
+            self._raster.GetRasterBand(band_id+1)
+            for band_id in range(self._raster.RasterCount)]
+        self.nodata = self._band_list[0].GetNoDataValue()
+        self.raster_size = (self._raster.RasterXSize, self._raster.RasterYSize)
+        self.n_bands = self._raster.RasterCount
+        self.geotransform = self._raster.GetGeoTransform()
+
+    def read_tile(self, tile_index):
+        """Read (n_bands, rows, cols) array of a tile."""
+        xoff, yoff, win_xsize, win_ysize = _tile_window(
+            tile_index, self.raster_size)
+        return numpy.stack([
+            band.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
+            for band in self._band_list])
+
+    def write_tiles(self, tile_list):
+        """Write a list of (tile_index, tile_array) tuples."""
+        for tile_index, tile_array in tile_list:
+            xoff, yoff, _, _ = _tile_window(tile_index, self.raster_size)
+            for band, band_array in zip(self._band_list, tile_array):
+                band.WriteArray(band_array, xoff=xoff, yoff=yoff)
+            _write_overview_windows(
+                self._band_list, xoff, yoff, tile_array, self.nodata)
+
+    def flush(self):
+        """Flush written tiles to disk."""
+        self._raster.FlushCache()
+
+    def close(self):
+        """Flush and close the raster."""
+        self._raster.FlushCache()
+        self._band_list = None
+        self._raster = None
+
+    def compact(self):
+        """Pack the raster after it's closed."""
+        _compact_raster(self.raster_path)
+
+
+def _shard_dir(global_vrt_path):
+    """Directory holding the shards of a sharded global output."""
+    return f'{os.path.splitext(global_vrt_path)[0]}_shards'
+
+
+class _ShardedTileStore:
+    """Read and write tiles of a global output split into shard GeoTIFFs.
+
+    The global grid is described by a VRT and split into shards of
+    ``GLOBAL_SHARD_SIZE_TILES`` by ``GLOBAL_SHARD_SIZE_TILES`` tiles, each
+    its own tiled GeoTIFF created the first time it's written to. Shards
+    are independent files so tiles in different shards are written
+    concurrently. The VRT is rebuilt as a mosaic of the shards on close.
+    """
+
+    def __init__(self, global_vrt_path):
+        """Open the sharded output described by ``global_vrt_path``."""
+        self.raster_path = global_vrt_path
+        self.shard_dir = _shard_dir(global_vrt_path)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        vrt_raster = gdal.OpenEx(global_vrt_path, gdal.OF_RASTER)
+        self.nodata = vrt_raster.GetRasterBand(1).GetNoDataValue()
+        self.raster_size = (vrt_raster.RasterXSize, vrt_raster.RasterYSize)
+        self.n_bands = vrt_raster.RasterCount
+        self.geotransform = vrt_raster.GetGeoTransform()
+        self.projection_wkt = vrt_raster.GetProjection()
+        self.band_name_list = [
+            vrt_raster.GetRasterBand(band_id+1).GetDescription()
+            for band_id in range(self.n_bands)]
+        vrt_raster = None
+        # shard index -> (raster, band list, lock)
+        self._shard_map = {}
+        self._shard_map_lock = threading.Lock()
+        self._touched_shard_set = set()
+
+    def shard_path(self, shard_index):
+        """Path to the shard GeoTIFF at (shard_x, shard_y)."""
+        return os.path.join(
+            self.shard_dir,
+            f'{os.path.basename(self.shard_dir)}_'
+            f'{shard_index[0]:03d}_{shard_index[1]:03d}.tif')
+
+    def shard_window(self, shard_index):
+        """(xoff, yoff, win_xsize, win_ysize) of a shard in the global grid."""
+        shard_size = GLOBAL_SHARD_SIZE_TILES * STITCH_TILE_SIZE
+        xoff = shard_index[0] * shard_size
+        yoff = shard_index[1] * shard_size
+        return (
+            xoff, yoff,
+            min(shard_size, self.raster_size[0]-xoff),
+            min(shard_size, self.raster_size[1]-yoff))
+
+    def _get_shard(self, shard_index, create):
+        """(raster, band list, lock) of a shard or None if not created."""
+        with self._shard_map_lock:
+            if shard_index in self._shard_map:
+                return self._shard_map[shard_index]
+            shard_path = self.shard_path(shard_index)
+            if not os.path.exists(shard_path):
+                if not create:
+                    return None
+                xoff, yoff, win_xsize, win_ysize = self.shard_window(
+                    shard_index)
+                gt = self.geotransform
+                driver = gdal.GetDriverByName('GTiff')
+                shard_raster = driver.Create(
+                    shard_path, win_xsize, win_ysize, self.n_bands,
+                    gdal.GDT_Float32, options=GLOBAL_RASTER_CREATION_OPTIONS)
+                shard_raster.SetProjection(self.projection_wkt)
+                shard_raster.SetGeoTransform(
+                    [gt[0]+xoff*gt[1], gt[1], 0, gt[3]+yoff*gt[5], 0, gt[5]])
+                for band_id, band_name in enumerate(self.band_name_list):
+                    shard_band = shard_raster.GetRasterBand(band_id+1)
+                    shard_band.SetNoDataValue(self.nodata)
+                    shard_band.SetDescription(band_name)
+                shard_band = None
+                shard_raster.BuildOverviews(
+                    'NONE', GLOBAL_OVERVIEW_FACTOR_LIST)
+                shard_raster = None
+            shard_raster = gdal.OpenEx(
+                shard_path, gdal.OF_RASTER | gdal.GA_Update)
+            self._shard_map[shard_index] = (
+                shard_raster,
+                [shard_raster.GetRasterBand(band_id+1)
+                 for band_id in range(self.n_bands)],
+                threading.Lock())
+            return self._shard_map[shard_index]
+
+    def _shard_tile_offset(self, tile_index):
+        """Shard index and pixel offset of ``tile_index`` in that shard."""
+        shard_index = (
+            tile_index[0] // GLOBAL_SHARD_SIZE_TILES,
+            tile_index[1] // GLOBAL_SHARD_SIZE_TILES)
+        return shard_index, (
+            (tile_index[0] % GLOBAL_SHARD_SIZE_TILES) * STITCH_TILE_SIZE,
+            (tile_index[1] % GLOBAL_SHARD_SIZE_TILES) * STITCH_TILE_SIZE)
+
+    def read_tile(self, tile_index):
+        """Read (n_bands, rows, cols) array of a tile."""
+        _, _, win_xsize, win_ysize = _tile_window(
+            tile_index, self.raster_size)
+        shard_index, (xoff, yoff) = self._shard_tile_offset(tile_index)
+        shard = self._get_shard(shard_index, False)
+        if shard is None:
+            return numpy.full(
+                (self.n_bands, win_ysize, win_xsize), self.nodata,
+                dtype=numpy.float32)
+        _, band_list, shard_lock = shard
+        with shard_lock:
+            return numpy.stack([
+                band.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
+                for band in band_list])
+
+    def write_shard_arrays(self, shard_index, offset_array_list):
+        """Write (shard pixel offset, array) tuples into one shard."""
+        _, band_list, shard_lock = self._get_shard(shard_index, True)
+        self._touched_shard_set.add(shard_index)
+        with shard_lock:
+            for (xoff, yoff), array in offset_array_list:
+                for band, band_array in zip(band_list, array):
+                    band.WriteArray(band_array, xoff=xoff, yoff=yoff)
+                _write_overview_windows(
+                    band_list, xoff, yoff, array, self.nodata)
+
+    def write_tiles(self, tile_list):
+        """Write a list of (tile_index, tile_array) tuples.
+
+        Tiles are grouped by shard and the shards are written concurrently.
+        """
+        shard_tile_map = collections.defaultdict(list)
+        for tile_index, tile_array in tile_list:
+            shard_index, offset = self._shard_tile_offset(tile_index)
+            shard_tile_map[shard_index].append((offset, tile_array))
+        if len(shard_tile_map) == 1:
+            self.write_shard_arrays(*next(iter(shard_tile_map.items())))
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=N_SHARD_WRITERS) as executor:
+            for future in [
+                    executor.submit(self.write_shard_arrays, *item)
+                    for item in shard_tile_map.items()]:
+                future.result()
+
+    def flush(self):
+        """Flush written tiles to disk."""
+        for shard_raster, _, shard_lock in list(self._shard_map.values()):
+            with shard_lock:
+                shard_raster.FlushCache()
+
+    def close(self):
+        """Close all the shards and rebuild the mosaic VRT."""
+        self.flush()
+        self._shard_map = {}
+        _build_shard_mosaic(self.raster_path)
+
+    def compact(self):
+        """Pack the shards written to since this store was opened."""
+        for shard_index in sorted(self._touched_shard_set):
+            _compact_raster(self.shard_path(shard_index))
+
+
+def _build_shard_mosaic(global_vrt_path, shard_path_list=None):
+    """Rebuild the VRT of a sharded global output as a mosaic of its shards.
+
+    Args:
+        global_vrt_path (str): path to the VRT, it keeps its global extent
+            and band names.
+        shard_path_list (list): shards to mosaic, defaults to all shards in
+            the output's shard directory.
+
+    Returns:
+        None
+    """
+    if shard_path_list is None:
+        shard_path_list = sorted(glob.glob(os.path.join(
+            _shard_dir(global_vrt_path), '*.tif')))
+    if not shard_path_list:
+        return
+    vrt_raster = gdal.OpenEx(global_vrt_path, gdal.OF_RASTER)
+    gt = vrt_raster.GetGeoTransform()
+    bounds = [
+        gt[0], gt[3]+vrt_raster.RasterYSize*gt[5],
+        gt[0]+vrt_raster.RasterXSize*gt[1], gt[3]]
+    band_name_list = [
+        vrt_raster.GetRasterBand(band_id+1).GetDescription()
+        for band_id in range(vrt_raster.RasterCount)]
+    vrt_raster = None
+    working_vrt_path = '%s_working%s' % os.path.splitext(global_vrt_path)
+    vrt_raster = gdal.BuildVRT(
+        working_vrt_path, shard_path_list, options=gdal.BuildVRTOptions(
+            outputBounds=bounds, xRes=gt[1], yRes=abs(gt[5]),
+            VRTNodata=GLOBAL_NODATA))
+    for band_id, band_name in enumerate(band_name_list):
+        vrt_raster.GetRasterBand(band_id+1).SetDescription(band_name)
+    vrt_raster = None
+    os.replace(working_vrt_path, global_vrt_path)
+
+
+def _build_shard_cogs(global_vrt_path):
+    """Make a cloud optimized GeoTIFF of each shard and a VRT over them.
+
+    COGs are written to a ``cog`` directory next to the shards and mosaicked
+    in ``<global_vrt_path>_cog.vrt``. Shards whose COG is newer than the
+    shard are skipped.
+
+    Args:
+        global_vrt_path (str): path to the VRT of a sharded global output.
+
+    Returns:
+        None
+    """
+    shard_dir = _shard_dir(global_vrt_path)
+    cog_dir = os.path.join(shard_dir, 'cog')
+    os.makedirs(cog_dir, exist_ok=True)
+    cog_path_list = []
+    for shard_path in sorted(glob.glob(os.path.join(shard_dir, '*.tif'))):
+        cog_path = os.path.join(cog_dir, os.path.basename(shard_path))
+        if (not os.path.exists(cog_path) or
+                os.path.getmtime(cog_path) < os.path.getmtime(shard_path)):
+            LOGGER.info(f'building cog {cog_path}')
+            gdal.Translate(cog_path, shard_path, options=gdal.TranslateOptions(
+                format='COG', creationOptions=(
+                    'COMPRESS=LZW', 'BIGTIFF=IF_SAFER')))
+        cog_path_list.append(cog_path)
+    cog_vrt_path = '%s_cog%s' % os.path.splitext(global_vrt_path)
+    if not os.path.exists(cog_vrt_path):
+        shutil.copyfile(global_vrt_path, cog_vrt_path)
+    _build_shard_mosaic(cog_vrt_path, cog_path_list)
+
+
+def _open_global_tile_store(global_raster_path):
+    """Tile store for a global output, sharded if it's a ``.vrt``."""
+    if global_raster_path.endswith('.vrt'):
+        return _ShardedTileStore(global_raster_path)
+    return _GlobalRasterTileStore(global_raster_path)
+
+
+class _GlobalTileAccumulator:
+    """Accumulate stitched results in memory by global raster tile.
+
+    Tiles are read from the global output the first time they're touched and
+    updated in memory as job results arrive. A tile is compressed and written
+    back once every job expected to overlap it has been released, or when it
+    is the least recently used tile and the cache is full. A block touched by
+    many small watersheds is then written once instead of once per job.
+    """
+
+    def __init__(
+            self, global_raster_path, max_cached_tiles,
+            job_footprint_map=None):
+        """Open the global output for accumulation.
+
+        Args:
+            global_raster_path (str): path to an existing global raster tiled
+                in ``STITCH_TILE_SIZE`` blocks, or the ``.vrt`` of a sharded
+                global output.
+            max_cached_tiles (int): number of tiles to hold in memory before
+                spilling the least recently used one to disk.
+            job_footprint_map (dict): maps a job id to the wgs84 bounding box
+                of that job. Used to know when a tile has no more pending
+                jobs. If ``None`` tiles are only written on eviction or
+                ``close``.
+        """
+        self.global_raster_path = global_raster_path
+        self._tile_store = _open_global_tile_store(global_raster_path)
+        self.nodata = self._tile_store.nodata
+        self.raster_size = self._tile_store.raster_size
+        self.n_bands = self._tile_store.n_bands
+        self.geotransform = self._tile_store.geotransform
+        self._max_cached_tiles = max_cached_tiles
+        # tile index -> (n_bands, rows, cols) array, in LRU order
+        self._tile_cache = collections.OrderedDict()
+        # tile index -> set of job ids with data in the cached tile
+        self._tile_job_map = collections.defaultdict(set)
+        # job id -> number of cached tiles still holding its data
+        self._job_pending_tile_count = collections.defaultdict(int)
+        self._durable_job_list = []
+        self._job_tile_index_map = {}
+        self._tile_ref_count = collections.Counter()
+        for job_id, wgs84_bb in (job_footprint_map or {}).items():
+            tile_index_set = _global_tile_index_set(
+                wgs84_bb, self.geotransform, self.raster_size)
+            self._job_tile_index_map[job_id] = tile_index_set
+            self._tile_ref_count.update(tile_index_set)
+        self.n_tile_reads = 0
+        self.n_tile_writes = 0
+        self._closed = False
+
+    def _get_tile(self, tile_index, load=True):
+        """Return the cached tile array.
+
+        If the tile isn't cached it's read from disk, or if ``load`` is False
+        because the caller will overwrite all of it, started as nodata.
+        """
+        if tile_index in self._tile_cache:
+            self._tile_cache.move_to_end(tile_index)
+            return self._tile_cache[tile_index]
+        if load:
+            tile_array = self._tile_store.read_tile(tile_index)
+            self.n_tile_reads += 1
+        else:
+            _, _, win_xsize, win_ysize = _tile_window(
+                tile_index, self.raster_size)
+            tile_array = numpy.full(
+                (self.n_bands, win_ysize, win_xsize), self.nodata,
+                dtype=numpy.float32)
+        self._tile_cache[tile_index] = tile_array
+        if len(self._tile_cache) > self._max_cached_tiles:
+            self._write_tiles([next(iter(self._tile_cache))])
+        return tile_array
+
+    def _write_tiles(self, tile_index_list):
+        """Write cached tiles to the global output and drop them."""
+        with pipeline_trace.span(
+                'write tiles', category='stitch',
+                output=self.global_raster_path,
+                n_tiles=len(tile_index_list)):
+            self._tile_store.write_tiles([
+                (tile_index, self._tile_cache.pop(tile_index))
+                for tile_index in tile_index_list])
+        self.n_tile_writes += len(tile_index_list)
+        for tile_index in tile_index_list:
+            for job_id in self._tile_job_map.pop(tile_index, ()):
+                self._job_pending_tile_count[job_id] -= 1
+                if self._job_pending_tile_count[job_id] == 0:
+                    del self._job_pending_tile_count[job_id]
+                    self._durable_job_list.append(job_id)
+
+    def add(self, job_id, array, valid_mask, xoff, yoff):
+        """Replace global values with the valid pixels of ``array``.
+
+        Args:
+            job_id (str): id of the job the data came from.
+            array (numpy.ndarray): (n_bands, rows, cols) or (rows, cols)
+                array of values on the global grid.
+            valid_mask (numpy.ndarray): boolean array of the same shape as
+                ``array`` that's True where ``array`` should be written.
+            xoff, yoff (int): global pixel offset of ``array``.
+
+        Returns:
+            None
+        """
+        if array.ndim == 2:
+            array = array[numpy.newaxis, ...]
+            valid_mask = valid_mask[numpy.newaxis, ...]
+        win_ysize, win_xsize = array.shape[1:]
+        touched = False
+        for tile_x in range(
+                xoff // STITCH_TILE_SIZE,
+                (xoff+win_xsize-1) // STITCH_TILE_SIZE + 1):
+            for tile_y in range(
+                    yoff // STITCH_TILE_SIZE,
+                    (yoff+win_ysize-1) // STITCH_TILE_SIZE + 1):
+                tile_index = (tile_x, tile_y)
+                tile_xoff, tile_yoff, tile_xsize, tile_ysize = (
+                    _tile_window(tile_index, self.raster_size))
+                # intersection of array window and tile in global coords
+                x0 = max(xoff, tile_xoff)
+                x1 = min(xoff+win_xsize, tile_xoff+tile_xsize)
+                y0 = max(yoff, tile_yoff)
+                y1 = min(yoff+win_ysize, tile_yoff+tile_ysize)
+                array_slice = (
+                    slice(None), slice(y0-yoff, y1-yoff),
+                    slice(x0-xoff, x1-xoff))
+                mask_slice = valid_mask[array_slice]
+                if not mask_slice.any():
+                    continue
+                # a block that covers the whole tile is a straight copy
+                full_tile = (
+                    (x1-x0, y1-y0) == (tile_xsize, tile_ysize) and
+                    mask_slice.all())
+                tile_array = self._get_tile(tile_index, load=not full_tile)
+                tile_slice = tile_array[
+                    :, y0-tile_yoff:y1-tile_yoff, x0-tile_xoff:x1-tile_xoff]
+                tile_slice[mask_slice] = array[array_slice][mask_slice]
+                if job_id not in self._tile_job_map[tile_index]:
+                    self._tile_job_map[tile_index].add(job_id)
+                    self._job_pending_tile_count[job_id] += 1
+                touched = True
+        if not touched:
+            self._durable_job_list.append(job_id)
+
+    def release(self, job_id):
+        """Mark ``job_id`` as done, writing tiles that are now complete."""
+        complete_tile_list = []
+        for tile_index in self._job_tile_index_map.pop(job_id, ()):
+            self._tile_ref_count[tile_index] -= 1
+            if self._tile_ref_count[tile_index] <= 0:
+                del self._tile_ref_count[tile_index]
+                if tile_index in self._tile_cache:
+                    complete_tile_list.append(tile_index)
+        if complete_tile_list:
+            self._write_tiles(complete_tile_list)
+
+    def pop_durable_jobs(self):
+        """List of job ids whose data have all been written to disk."""
+        if not self._durable_job_list:
+            return []
+        if not self._closed:
+            with pipeline_trace.span(
+                    'flush tiles', category='stitch',
+                    output=self.global_raster_path):
+                self._tile_store.flush()
+        durable_job_list = self._durable_job_list
+        self._durable_job_list = []
+        return durable_job_list
+
+    def flush(self):
+        """Write all cached tiles, even ones that more jobs will touch."""
+        if self._tile_cache:
+            self._write_tiles(list(self._tile_cache))
+
+    def close(self):
+        """Write all cached tiles and close the global output."""
+        self.flush()
+        # closing the store flushes it
+        self._tile_store.close()
+        self._closed = True
+        LOGGER.info(
+            f'{self.global_raster_path}: {self.n_tile_reads} tile reads, '
+            f'{self.n_tile_writes} tile writes')
+
+    def compact(self):
+        """Pack the global output after ``close`` if tiles were written."""
+        if self.n_tile_writes == 0:
+            return
+        self._tile_store.compact()
+
+
+class _ZonalAggregator:
+    """Per country and per basin totals of a global raster's bands.
+
+    Each job's contribution is computed from its piece as it's stitched and
+    kept by job, so a job that's stitched again replaces its previous
+    contribution instead of adding to it. Only pixels inside the job's own
+    basins are counted, so the basins partition the pixels between jobs and
+    nothing is counted twice. Contributions are appended to a
+    ``<raster>_zonal_partials.jsonl`` log next to the global raster that's
+    reloaded on a rerun, and ``write_tables`` sums them into
+    ``<raster>_by_basin.csv`` and ``<raster>_by_country.csv``.
+    """
+
+    def __init__(self, global_raster_path):
+        """Load any contributions already logged for ``global_raster_path``.
+
+        Args:
+            global_raster_path (str): path to the global raster, its band
+                descriptions name the rows of the tables.
+        """
+        global_raster = gdal.OpenEx(global_raster_path, gdal.OF_RASTER)
+        self.band_name_list = [
+            global_raster.GetRasterBand(band_id+1).GetDescription()
+            for band_id in range(global_raster.RasterCount)]
+        self.pixel_size_deg = abs(global_raster.GetGeoTransform()[1])
+        global_raster = None
+        self._base_path = os.path.splitext(global_raster_path)[0]
+        self.partials_path = f'{self._base_path}_zonal_partials.jsonl'
+        # job id -> band name -> zone type -> zone id -> list of
+        # [count, sum, area_m2, area_weighted_sum]
+        self._job_partial_map = {}
+        if os.path.exists(self.partials_path):
+            with open(self.partials_path, 'r') as partials_file:
+                for line in partials_file:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # line cut short by a crash
+                        continue
+                    self._job_partial_map[record['job_id']] = (
+                        record['partial'])
+        self._partials_file = open(self.partials_path, 'a')
+
+    def add(
+            self, job_id, array, valid_mask, zone_array, zone_id_lists,
+            center_lat_array):
+        """Set the contribution of ``job_id``.
+
+        Args:
+            job_id (str): id of the job the data came from.
+            array (numpy.ndarray): (n_bands, rows, cols) values of the job
+                on the global grid.
+            valid_mask (numpy.ndarray): True where ``array`` has data.
+            zone_array (numpy.ndarray): (2, rows, cols) basin and country
+                codes of the same window.
+            zone_id_lists (dict): maps ``BASIN_ZONE`` and ``COUNTRY_ZONE`` to
+                the zone ids of their codes.
+            center_lat_array (numpy.ndarray): latitude of each row center.
+
+        Returns:
+            None
+        """
+        pixel_area_array = numpy.broadcast_to(_wgs84_pixel_area_m2(
+            self.pixel_size_deg, center_lat_array)[:, numpy.newaxis],
+            array.shape[1:])
+        in_basin_mask = zone_array[0] > 0
+        partial = {}
+        for band_name, band_array, band_valid_mask in zip(
+                self.band_name_list, array, valid_mask):
+            mask = band_valid_mask & in_basin_mask
+            value_array = band_array[mask].astype(numpy.float64)
+            area_array = pixel_area_array[mask]
+            band_partial = {}
+            for zone_type, zone_code_array in zip(
+                    (BASIN_ZONE, COUNTRY_ZONE), zone_array):
+                zone_id_list = zone_id_lists[zone_type]
+                code_array = zone_code_array[mask]
+                n_codes = len(zone_id_list)+1
+                count_array = numpy.bincount(code_array, minlength=n_codes)
+                stat_array_list = [
+                    count_array,
+                    numpy.bincount(
+                        code_array, weights=value_array, minlength=n_codes),
+                    numpy.bincount(
+                        code_array, weights=area_array, minlength=n_codes),
+                    numpy.bincount(
+                        code_array, weights=value_array*area_array,
+                        minlength=n_codes)]
+                zone_partial = {}
+                for code in numpy.nonzero(count_array)[0]:
+                    if code == 0:
+                        continue
+                    zone_stats = zone_partial.setdefault(
+                        zone_id_list[code-1], [0, 0.0, 0.0, 0.0])
+                    for stat_index, stat_array in enumerate(stat_array_list):
+                        zone_stats[stat_index] += stat_array[code].item()
+                band_partial[zone_type] = zone_partial
+            partial[band_name] = band_partial
+        self._job_partial_map[job_id] = partial
+        self._partials_file.write(
+            json.dumps({'job_id': job_id, 'partial': partial}) + '\n')
+        self._partials_file.flush()
+
+    def write_tables(self):
+        """Write the totals of every zone and compact the partials log."""
+        self._partials_file.close()
+        working_partials_path = f'{self.partials_path}_working'
+        with open(working_partials_path, 'w') as partials_file:
+            for job_id, partial in self._job_partial_map.items():
+                partials_file.write(
+                    json.dumps({'job_id': job_id, 'partial': partial}) + '\n')
+        os.replace(working_partials_path, self.partials_path)
+        self._partials_file = open(self.partials_path, 'a')
+
+        for zone_type in (BASIN_ZONE, COUNTRY_ZONE):
+            # (band name, zone id) -> [count, sum, area_m2, area weighted sum]
+            total_map = collections.defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+            for partial in self._job_partial_map.values():
+                for band_name, band_partial in partial.items():
+                    for zone_id, zone_stats in band_partial.get(
+                            zone_type, {}).items():
+                        zone_total = total_map[(band_name, zone_id)]
+                        for stat_index, stat in enumerate(zone_stats):
+                            zone_total[stat_index] += stat
+            table_path = f'{self._base_path}_by_{zone_type}.csv'
+            LOGGER.info(f'writing {len(total_map)} rows to {table_path}')
+            with open(table_path, 'w') as table_file:
+                table_file.write(
+                    f'band,{zone_type},count,sum,mean,area_m2,'
+                    f'area_weighted_sum\n')
+                for (band_name, zone_id), (
+                        count, value_sum, area, area_weighted_sum) in sorted(
+                            total_map.items()):
+                    table_file.write(
+                        f'{band_name},{zone_id},{count},{value_sum!r},'
+                        f'{value_sum/count!r},{area!r},'
+                        f'{area_weighted_sum!r}\n')
+
+
+@pipeline_profiling.profile_job(lambda args: 'stitch_' + os.path.basename(
+    os.path.splitext(args['target_stitch_raster_path_list'][0])[0]))
 def stitch_worker(
-        rasters_to_stitch_queue, target_stitch_raster_path, n_expected,
-        signal_done_queue):
+        rasters_to_stitch_queue, target_stitch_raster_path_list, n_expected,
+        signal_done_queue, job_footprint_map=None, build_shard_cogs=False,
+        output_telemetry=None, aggregate_zones=False, masked_pieces=False):
     """Update the database with completed work.
 
     Args:
-        rasters_to_stitch_queue (queue): queue that recieves paths to
-            rasters to stitch into target_stitch_raster_path.
-        target_stitch_raster_path (str): path to an existing raster to stitch
-            into.
+        rasters_to_stitch_queue (queue): queue that recieves
+            ``(piece_path, job_workspace_dir, status)`` tuples where
+            ``piece_path`` is a raster made by ``_write_global_grid_piece``
+            with a band per job result, or ``None`` if the job was skipped,
+            raised or doesn't overlap the global grid. ``status`` is the
+            ``pipeline_telemetry`` status of the job, ``FAILED`` with a
+            piece if its deltas couldn't be made. ``_FLUSH_TILES``
+            asks for every cached tile to be written so the workspaces
+            waiting on them can be released.
+        target_stitch_raster_path_list (list): paths to existing global
+            rasters to stitch into. The job results are assigned in order to
+            the bands of these rasters, so this is either one single band
+            raster per result or one raster with a band per result.
         n_expected (int): number of expected stitch signals
-        signal_done_queue (queue): as each job is complete the directory path
-            to the raster will be passed in to eventually remove.
-
+        signal_done_queue (queue): as each job's stitched data are written
+            to disk, or the job is found to have nothing to stitch or to
+            have failed, its workspace directory will be passed in to
+            eventually remove.
+        job_footprint_map (dict): maps job workspace directory to the wgs84
+            bounding box of its watersheds so tiles can be written as soon
+            as every job overlapping them is stitched.
+        build_shard_cogs (bool): if True and the targets are sharded
+            ``.vrt`` outputs, build cloud optimized GeoTIFFs of the shards
+            when done.
+        output_telemetry (pipeline_telemetry.OutputTelemetry): if not None,
+            each job is recorded as completed or skipped when it's received.
+        aggregate_zones (bool): if True, per basin and country totals of
+            every band are updated from each piece that has zones and
+            written as tables next to the global rasters when done, see
+            ``_ZonalAggregator``.
+        masked_pieces (bool): if True the pieces were masked to their
+            watersheds so no two jobs write the same pixel. The result then
+            doesn't depend on stitch order and pieces are read
+            concurrently and stitched as soon as they're read, otherwise
+            they're stitched in the order they're received.
 
     Return:
         ``None``
     """
+    stitch_id = ', '.join(target_stitch_raster_path_list)
     try:
+        # nothing is opened until the first job is done, so the stitchers
+        # of scenarios whose jobs haven't started yet only hold a thread
+        first_payload = rasters_to_stitch_queue.get()
         processed_so_far = 0
-        n_buffered = 0
         start_time = time.time()
-        stitch_buffer_list = []
-        LOGGER.info(f'started stitch worker for {target_stitch_raster_path}')
-        while True:
-            payload = rasters_to_stitch_queue.get()
-            if payload is not None:
-                if payload[0] is None:  # means skip this raster
-                    processed_so_far += 1
-                    continue
-                stitch_buffer_list.append(payload)
-
-            if len(stitch_buffer_list) > N_TO_BUFFER_STITCH or payload is None:
-                LOGGER.info(
-                    f'about to stitch {n_buffered} into '
-                    f'{target_stitch_raster_path}')
-                geoprocessing.stitch_rasters(
-                    stitch_buffer_list, ['near']*len(stitch_buffer_list),
-                    (target_stitch_raster_path, 1),
-                    area_weight_m2_to_wgs84=True,
-                    overlap_algorithm='replace')
-                #  _ is the band number
-                for stitch_path, _ in stitch_buffer_list:
-                    signal_done_queue.put(os.path.dirname(stitch_path))
-                stitch_buffer_list = []
-
-            if payload is None:
-                LOGGER.info(f'all done sitching {target_stitch_raster_path}')
-                return
+        LOGGER.info(f'started stitch worker for {stitch_id}')
+        tile_accumulator_list = [
+            _GlobalTileAccumulator(
+                path, N_STITCH_TILES_TO_CACHE // len(
+                    target_stitch_raster_path_list),
+                job_footprint_map)
+            for path in target_stitch_raster_path_list]
+        # all global rasters share the same grid
+        global_geotransform = tile_accumulator_list[0].geotransform
+        zonal_aggregator_list = []
+        if aggregate_zones:
+            zonal_aggregator_list = [
+                _ZonalAggregator(path)
+                for path in target_stitch_raster_path_list]
+        # job is done when its data are on disk in every global raster
+        durable_count = collections.defaultdict(int)
+
+        def _signal_durable_jobs(job_dir_list):
+            for job_dir in job_dir_list:
+                durable_count[job_dir] += 1
+                if durable_count[job_dir] == len(tile_accumulator_list):
+                    del durable_count[job_dir]
+                    signal_done_queue.put(job_dir)
+
+        def _read_piece(piece_path, job_dir):
+            """Read a piece and its zones, runs on the piece readers."""
+            if piece_path is None:
+                return None, None
+            with pipeline_trace.span(
+                    'read piece', category='stitch',
+                    job=os.path.basename(job_dir), output=stitch_id):
+                piece = _read_global_grid_piece(
+                    piece_path, global_geotransform)
+                zone_piece_path = _global_grid_zone_piece_path(piece_path)
+                zones = None
+                if zonal_aggregator_list and os.path.exists(zone_piece_path):
+                    zones = _read_global_grid_zone_piece(zone_piece_path)
+            return piece, zones
+
+        @pipeline_trace.traced(
+            'stitch piece', lambda args: {
+                'job': os.path.basename(args['job_dir']),
+                'output': stitch_id},
+            category='stitch')
+        def _stitch_piece(job_dir, status, piece, zones):
+            nonlocal processed_so_far
+            if piece is not None:
+                array, valid_mask, xoff, yoff = piece
+                band_offset = 0
+                for tile_accumulator in tile_accumulator_list:
+                    band_slice = slice(
+                        band_offset, band_offset+tile_accumulator.n_bands)
+                    band_offset += tile_accumulator.n_bands
+                    if band_slice.stop > array.shape[0]:
+                        # e.g. the deltas of a job with no baseline, cleared
+                        # where the job has results since an incremental
+                        # run's deltas start at 0 there
+                        band_shape = (
+                            tile_accumulator.n_bands,) + array.shape[1:]
+                        tile_accumulator.add(
+                            job_dir,
+                            numpy.full(
+                                band_shape, tile_accumulator.nodata,
+                                dtype=numpy.float32),
+                            numpy.broadcast_to(
+                                valid_mask.any(axis=0), band_shape),
+                            xoff, yoff)
+                        continue
+                    tile_accumulator.add(
+                        job_dir, array[band_slice], valid_mask[band_slice],
+                        xoff, yoff)
+                if zones is not None:
+                    zone_array, zone_id_lists = zones
+                    center_lat_array = global_geotransform[3] + (
+                        yoff + numpy.arange(array.shape[1]) + 0.5) * (
+                            global_geotransform[5])
+                    band_offset = 0
+                    for zonal_aggregator in zonal_aggregator_list:
+                        band_slice = slice(
+                            band_offset,
+                            band_offset+len(zonal_aggregator.band_name_list))
+                        band_offset = band_slice.stop
+                        if band_slice.stop > array.shape[0]:
+                            continue
+                        zonal_aggregator.add(
+                            job_dir, array[band_slice],
+                            valid_mask[band_slice], zone_array,
+                            zone_id_lists, center_lat_array)
+            else:
+                # skipped, failed, or nothing landed on the global grid
+                signal_done_queue.put(job_dir)
+            # a failure the job already reported isn't counted twice
+            if output_telemetry is not None:
+                output_telemetry.record_job(job_dir, status)
+            for tile_accumulator in tile_accumulator_list:
+                tile_accumulator.release(job_dir)
+                _signal_durable_jobs(tile_accumulator.pop_durable_jobs())
 
             processed_so_far += 1
+            if processed_so_far < n_expected and not (
+                    pipeline_logging.progress_due(
+                        stitch_id, STITCH_PROGRESS_INTERVAL_S)):
+                return
             jobs_per_sec = processed_so_far / (time.time() - start_time)
             remaining_time_s = (
-                n_expected / jobs_per_sec)
+                (n_expected-processed_so_far) / jobs_per_sec)
             remaining_time_h = int(remaining_time_s // 3600)
             remaining_time_s -= remaining_time_h * 3600
             remaining_time_m = int(remaining_time_s // 60)
             remaining_time_s -= remaining_time_m * 60
             LOGGER.info(
-                f'remaining jobs to process for {target_stitch_raster_path}: '
+                f'remaining jobs to process for {stitch_id}: '
                 f'{n_expected-processed_so_far} - '
                 f'processed so far {processed_so_far} - '
                 f'process/sec: {jobs_per_sec:.1f}s - '
                 f'time left: {remaining_time_h}:'
                 f'{remaining_time_m:02d}:{remaining_time_s:04.1f}')
+
+        # (future, job_dir, status) in the order they were received
+        pending_list = []
+
+        def _stitch_read_pieces(max_pending):
+            """Stitch read pieces until at most ``max_pending`` are left."""
+            while pending_list:
+                if masked_pieces:
+                    ready_list = [
+                        pending for pending in pending_list
+                        if pending[0].done()]
+                else:
+                    ready_list = (
+                        pending_list[:1] if pending_list[0][0].done()
+                        else [])
+                if not ready_list:
+                    if len(pending_list) <= max_pending:
+                        return
+                    concurrent.futures.wait(
+                        [pending[0] for pending in pending_list]
+                        if masked_pieces else [pending_list[0][0]],
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    continue
+                for pending in ready_list:
+                    pending_list.remove(pending)
+                    future, job_dir, status = pending
+                    _stitch_piece(job_dir, status, *future.result())
+
+        n_piece_readers = N_STITCH_PIECE_READERS if masked_pieces else 1
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_piece_readers) as piece_reader:
+            payload = first_payload
+            while True:
+                if payload is None:
+                    _stitch_read_pieces(0)
+                    break
+                if payload == _FLUSH_TILES:
+                    _stitch_read_pieces(0)
+                    with pipeline_trace.span(
+                            'flush cached tiles', category='stitch',
+                            output=stitch_id):
+                        for tile_accumulator in tile_accumulator_list:
+                            tile_accumulator.flush()
+                            _signal_durable_jobs(
+                                tile_accumulator.pop_durable_jobs())
+                    payload = rasters_to_stitch_queue.get()
+                    continue
+                piece_path, job_dir, status = payload
+                pending_list.append((
+                    piece_reader.submit(_read_piece, piece_path, job_dir),
+                    job_dir, status))
+                _stitch_read_pieces(n_piece_readers)
+                payload = rasters_to_stitch_queue.get()
+
+        with pipeline_trace.span(
+                'close outputs', category='stitch', output=stitch_id):
+            for tile_accumulator in tile_accumulator_list:
+                tile_accumulator.close()
+                _signal_durable_jobs(tile_accumulator.pop_durable_jobs())
+            for tile_accumulator in tile_accumulator_list:
+                tile_accumulator.compact()
+            for zonal_aggregator in zonal_aggregator_list:
+                zonal_aggregator.write_tables()
+        if build_shard_cogs:
+            for target_stitch_raster_path in target_stitch_raster_path_list:
+                if target_stitch_raster_path.endswith('.vrt'):
+                    with pipeline_trace.span(
+                            'build shard cogs', category='stitch',
+                            output=target_stitch_raster_path):
+                        _build_shard_cogs(target_stitch_raster_path)
+        LOGGER.info(f'all done sitching {stitch_id}')
     except Exception:
-        LOGGER.exception(
-            f'error on stitch worker for {target_stitch_raster_path}')
+        LOGGER.exception(f'error on stitch worker for {stitch_id}')
         raise
 
 
@@ -975,102 +3292,288 @@ def _run_ndr(
         k_param,
         target_stitch_raster_map,
         keep_intermediate_files=False,
-        result_suffix=None,):
+        result_suffix=None,
+        multiband_stitch_raster_path=None,
+        sharded_output=False,
+        build_shard_cogs=False,
+        telemetry=None,
+        aggregate_zones=False,
+        country_vector_path=None,
+        baseline_suffix=None,
+        mask_to_watersheds=False,
+        job_workspace_manager=None,
+        priority_offset=0,
+        workspace_task_map=None,
+        wait=True,
+        incremental_input_pair_list=None,
+        scope_table_edits=False,
+        zone_mosaic_dir=None,
+        zone_mosaic_task_map=None):
 
     # create intersecting bounding box of input data
     global_wgs84_bb = _calculate_intersecting_bounding_box(
         [dem_path, runoff_proxy_path, fertilizer_path, lulc_path])
 
-    stitch_raster_queue_map = {}
-    stitch_worker_list = []
-    multiprocessing_manager = multiprocessing.Manager()
-    signal_done_queue = multiprocessing_manager.Queue()
-    for local_result_path, global_stitch_raster_path in \
-            target_stitch_raster_map.items():
-        if result_suffix is not None:
-            global_stitch_raster_path = (
-                f'%s_{result_suffix}%s' % os.path.splitext(
-                    global_stitch_raster_path))
-            local_result_path = (
-                f'%s_{result_suffix}%s' % os.path.splitext(
-                    local_result_path))
-        if not os.path.exists(global_stitch_raster_path):
-            LOGGER.info(f'creating {global_stitch_raster_path}')
-            driver = gdal.GetDriverByName('GTiff')
-            n_cols = int((GLOBAL_BB[2]-GLOBAL_BB[0])/GLOBAL_PIXEL_SIZE_DEG)
-            n_rows = int((GLOBAL_BB[3]-GLOBAL_BB[1])/GLOBAL_PIXEL_SIZE_DEG)
-            LOGGER.info(f'**** creating raster of size {n_cols} by {n_rows}')
-            target_raster = driver.Create(
-                global_stitch_raster_path,
-                n_cols, n_rows, 1,
-                gdal.GDT_Float32,
-                options=(
-                    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW',
-                    'SPARSE_OK=TRUE', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'))
-            wgs84_srs = osr.SpatialReference()
-            wgs84_srs.ImportFromEPSG(4326)
-            target_raster.SetProjection(wgs84_srs.ExportToWkt())
-            target_raster.SetGeoTransform(
-                [GLOBAL_BB[0], GLOBAL_PIXEL_SIZE_DEG, 0,
-                 GLOBAL_BB[3], 0, -GLOBAL_PIXEL_SIZE_DEG])
-            target_band = target_raster.GetRasterBand(1)
-            target_band.SetNoDataValue(-9999)
-            target_raster = None
-        stitch_queue = multiprocessing_manager.Queue(N_TO_BUFFER_STITCH*2)
-        stitch_thread = threading.Thread(
-            target=stitch_worker,
-            args=(
-                stitch_queue, global_stitch_raster_path,
-                len(watershed_path_list),
-                signal_done_queue))
-        stitch_thread.start()
-        stitch_raster_queue_map[local_result_path] = stitch_queue
-        stitch_worker_list.append(stitch_thread)
+    job_list = []
+    for index, watershed_path in enumerate(watershed_path_list):
+        local_workspace_dir = _job_workspace_dir(
+            workspace_dir, watershed_path)
+        job_list.append((index, watershed_path, local_workspace_dir))
+    job_footprint_map = {
+        local_workspace_dir: _watershed_wgs84_bb(watershed_path)
+        for _, watershed_path, local_workspace_dir in job_list}
+    if incremental_input_pair_list is not None and (
+            baseline_suffix is not None):
+        job_list = _incremental_job_list(
+            job_list, job_footprint_map, incremental_input_pair_list)
+        job_footprint_map = {
+            local_workspace_dir: job_footprint_map[local_workspace_dir]
+            for _, _, local_workspace_dir in job_list}
+        _start_from_baseline_outputs(
+            target_stitch_raster_map, result_suffix, baseline_suffix,
+            multiband_stitch_raster_path, sharded_output)
+    finish_callback = None
+    if scope_table_edits:
+        table_record_path = os.path.join(
+            workspace_dir, f'biophysical_table_{result_suffix}.json')
+        # stat the inputs now, the record is of what the run started with
+        run_input_record = _run_input_record(
+            [dem_path, runoff_proxy_path, fertilizer_path, lulc_path] +
+            [watershed_path for _, watershed_path, _ in job_list], {
+                'threshold_flow_accumulation': threshold_flow_accumulation,
+                'k_param': k_param,
+                'target_pixel_size': target_pixel_size,
+                'mask_to_watersheds': mask_to_watersheds,
+                'target_stitch_raster_map': target_stitch_raster_map,
+                'multiband_stitch_raster_path': multiband_stitch_raster_path,
+                'baseline_suffix': baseline_suffix,
+            })
+        job_list = _table_edit_job_list(
+            job_list, job_footprint_map, table_record_path, run_input_record,
+            lulc_path, biophysical_table_path, biophysical_table_lucode_field,
+            _global_stitch_raster_paths(
+                target_stitch_raster_map, result_suffix,
+                multiband_stitch_raster_path, sharded_output)[1])
+        job_footprint_map = {
+            local_workspace_dir: job_footprint_map[local_workspace_dir]
+            for _, _, local_workspace_dir in job_list}
+        finish_callback = functools.partial(
+            _write_table_record, table_record_path, run_input_record,
+            biophysical_table_path, biophysical_table_lucode_field)
+
+    # create global stitch rasters and start the stitcher, all of a job's
+    # outputs are stitched together in one pass
+    local_result_path_list, global_stitch_raster_path_list = (
+        _create_global_stitch_rasters(
+            target_stitch_raster_map, GLOBAL_BB, result_suffix,
+            multiband_stitch_raster_path, sharded_output))
+    baseline_delta_info = None
+    if baseline_suffix is not None:
+        # deltas are stitched as the bands after the scenario outputs
+        baseline_delta_info, global_delta_raster_path_list = (
+            _create_global_delta_rasters(
+                target_stitch_raster_map, GLOBAL_BB, result_suffix,
+                baseline_suffix, multiband_stitch_raster_path,
+                sharded_output, start_at_zero=(
+                    incremental_input_pair_list is not None)))
+        global_stitch_raster_path_list += global_delta_raster_path_list
+    global_raster_info = geoprocessing.get_raster_info(
+        global_stitch_raster_path_list[0])
+    global_grid_info = (
+        global_raster_info['geotransform'], global_raster_info['raster_size'],
+        mask_to_watersheds)
+    zone_info = None
+    if aggregate_zones:
+        zone_info = (country_vector_path, COUNTRY_ID_FIELD)
+    # stitcher and cleaner are threads here, only the jobs are in other
+    # processes
+    signal_done_queue = queue.Queue()
+    stitch_queue = result_channel.ResultChannel(N_TO_BUFFER_STITCH*2)
+    output_telemetry = None
+    telemetry_info = None
+    if telemetry is not None:
+        output_telemetry = telemetry.add_output(
+            f'ndr_{result_suffix}',
+            [local_workspace_dir for _, _, local_workspace_dir in job_list],
+            stitch_queue)
+        telemetry_info = output_telemetry.worker_info
+    flush_callback = None
+    if job_workspace_manager is not None:
+        # main planned a use of every watershed's workspace
+        job_dir_set = set(
+            local_workspace_dir for _, _, local_workspace_dir in job_list)
+        job_workspace_manager.cancel_planned_uses([
+            local_workspace_dir for local_workspace_dir in [
+                _job_workspace_dir(workspace_dir, watershed_path)
+                for watershed_path in watershed_path_list]
+            if local_workspace_dir not in job_dir_set])
+        job_workspace_manager.add_existing(
+            [local_workspace_dir for _, _, local_workspace_dir in job_list])
+        # cached tiles hold on to the workspaces of stitched jobs until the
+        # last job overlapping them is stitched, which may be one that's
+        # waiting for a workspace to be released
+        flush_callback = functools.partial(
+            _request_stitch_flush, stitch_queue)
+        job_workspace_manager.add_flush_callback(flush_callback)
+    stitch_thread = threading.Thread(
+        target=stitch_worker,
+        args=(
+            stitch_queue, global_stitch_raster_path_list, len(job_list),
+            signal_done_queue, job_footprint_map, build_shard_cogs,
+            output_telemetry, aggregate_zones, mask_to_watersheds))
+    stitch_thread.start()
 
     clean_workspace_worker = threading.Thread(
         target=_clean_workspace_worker,
         args=(
-            len(target_stitch_raster_map), signal_done_queue,
-            keep_intermediate_files))
+            1, signal_done_queue, keep_intermediate_files,
+            job_workspace_manager))
     clean_workspace_worker.daemon = True
     clean_workspace_worker.start()
 
+    watershed_mosaic_map = {}
+    if zone_mosaic_dir is not None:
+        # same order as the inputs are warped in _execute_ndr_job
+        watershed_mosaic_map = _add_zone_mosaic_tasks(
+            task_graph,
+            [dem_path, runoff_proxy_path, lulc_path, fertilizer_path],
+            ['bilinear', 'bilinear', 'mode', 'bilinear'],
+            watershed_path_list, target_pixel_size, zone_mosaic_dir,
+            {} if zone_mosaic_task_map is None else zone_mosaic_task_map,
+            priority_offset+1)
+
     # Iterate through each watershed subset and run ndr
     # stitch the results of whatever outputs to whatever global output raster.
-    for index, watershed_path in enumerate(watershed_path_list):
-        local_workspace_dir = os.path.join(
-            workspace_dir, os.path.splitext(
-                os.path.basename(watershed_path))[0])
-        task_graph.add_task(
+    for index, watershed_path, local_workspace_dir in job_list:
+        if job_workspace_manager is not None:
+            with pipeline_trace.span(
+                    'admit workspace', category='schedule',
+                    job=os.path.basename(local_workspace_dir)):
+                job_workspace_manager.admit(local_workspace_dir)
+        dependent_task_list = []
+        if workspace_task_map is not None and (
+                local_workspace_dir in workspace_task_map):
+            dependent_task_list.append(
+                workspace_task_map[local_workspace_dir])
+        zone_mosaic_path_list = None
+        if watershed_path in watershed_mosaic_map:
+            zone_mosaic_path_list, zone_mosaic_task_list = (
+                watershed_mosaic_map[watershed_path])
+            dependent_task_list += zone_mosaic_task_list
+        job_task = task_graph.add_task(
             func=_execute_ndr_job,
             args=(
                 global_wgs84_bb, watershed_path, local_workspace_dir, dem_path,
                 lulc_path, runoff_proxy_path, fertilizer_path,
                 biophysical_table_path,
                 threshold_flow_accumulation, k_param, target_pixel_size,
-                biophysical_table_lucode_field, stitch_raster_queue_map,
-                result_suffix),
+                biophysical_table_lucode_field, global_grid_info, zone_info,
+                stitch_queue, telemetry_info, local_result_path_list,
+                result_suffix, baseline_delta_info, zone_mosaic_path_list),
+            dependent_task_list=dependent_task_list,
             transient_run=False,
-            priority=-index,  # priority in insert order
+            # priority in insert order
+            priority=priority_offset-index,
             task_name=f'ndr {os.path.basename(local_workspace_dir)}')
-
+        if workspace_task_map is not None:
+            workspace_task_map[local_workspace_dir] = job_task
+
+    pending_run = _PendingRun(
+        f'ndr {result_suffix}', stitch_queue, stitch_thread,
+        signal_done_queue, clean_workspace_worker, finish_callback,
+        job_workspace_manager, flush_callback)
+    if not wait:
+        return pending_run
     LOGGER.info('wait for ndr jobs to complete')
     task_graph.join()
-    for local_result_path, stitch_queue in stitch_raster_queue_map.items():
-        stitch_queue.put(None)
-    LOGGER.info('all done with ndr, waiting for stitcher to terminate')
-    for stitch_thread in stitch_worker_list:
-        stitch_thread.join()
-    LOGGER.info(
-        'all done with stitching, waiting for workspace worker to terminate')
-    signal_done_queue.put(None)
-    clean_workspace_worker.join()
-
-    LOGGER.info('all done with ndr -- stitcher terminated')
+    pending_run.finish()
 
 
 def main():
     """Entry point."""
+    parser = argparse.ArgumentParser(
+        description='run global SDR and NDR scenarios')
+    parser.add_argument(
+        '--run_plan', default=DEFAULT_RUN_PLAN_PATH,
+        help='path to a run plan json file of the scenarios to run')
+    parser.add_argument(
+        '--preview', action='store_true',
+        help='print the runs and their estimated cost then quit')
+    parser.add_argument(
+        '--zone_mosaics', action='store_true',
+        help=(
+            'warp each input once per UTM zone and cut the jobs\' inputs '
+            'out of those mosaics'))
+    parser.add_argument(
+        '--sharded_output', action='store_true',
+        help=(
+            'write each global output as GeoTIFF shards of '
+            f'{GLOBAL_SHARD_SIZE_TILES}x{GLOBAL_SHARD_SIZE_TILES} stitch '
+            'tiles under a VRT mosaic rather than one BigTIFF'))
+    parser.add_argument(
+        '--shard_cogs', action='store_true',
+        help=(
+            'with --sharded_output, build a cloud optimized GeoTIFF of each '
+            'shard and a VRT over them once an output is stitched'))
+    parser.add_argument(
+        '--scope_table_edits', action='store_true',
+        help=(
+            'rerun only the jobs with land cover codes whose biophysical '
+            'table rows changed since a run last finished, when nothing '
+            'else it uses has changed'))
+    parser.add_argument(
+        '--profile_jobs', nargs='+', default=None,
+        help=(
+            'job ids, or fnmatch patterns such as "sdr_af_bas_15s_beta_*", '
+            f'to profile with cProfile into {PROFILE_DIR}'))
+    parser.add_argument(
+        '--profile_sample_s', type=float, default=None,
+        help=(
+            'sample the stack of every job at this interval in seconds '
+            f'into {PROFILE_DIR}'))
+    parser.add_argument(
+        '--trace', action='store_true',
+        help=(
+            f'record a timeline of the run\'s stages into {TRACE_DIR} and '
+            f'merge it into {TRACE_DIR}.json for chrome://tracing or '
+            f'Perfetto'))
+    parser.add_argument(
+        '--log_listener', action='store_true',
+        help=(
+            f'send the records of every worker to one writer of {LOG_PATH} '
+            'rather than have each process append to it'))
+    parser.add_argument(
+        '--log_level', nargs='+', default=[],
+        help=(
+            'levels of subsystems as logger name=LEVEL, such as '
+            '"inspring.sdr_c_factor=DEBUG", or "root=DEBUG" for every '
+            'logger without its own level'))
+    args = parser.parse_args()
+    if args.shard_cogs and not args.sharded_output:
+        parser.error('--shard_cogs needs --sharded_output')
+    # before the task graph starts the workers that inherit the env
+    try:
+        pipeline_logging.configure_levels(args.log_level)
+    except ValueError as error:
+        parser.error(str(error))
+    pipeline_logging.configure_job_logs(FAILED_JOB_LOG_DIR)
+    log_listener = None
+    if args.log_listener:
+        log_listener = pipeline_logging.LogListener(
+            LOG_PATH, pipeline_logging.DEFAULT_LOG_FORMAT)
+        log_listener.start()
+    if args.profile_jobs or args.profile_sample_s:
+        # before the task graph starts the workers that inherit the env
+        pipeline_profiling.configure(
+            PROFILE_DIR, args.profile_jobs, args.profile_sample_s)
+    if args.trace:
+        # the timeline is of this run only
+        shutil.rmtree(TRACE_DIR, ignore_errors=True)
+        pipeline_trace.configure(TRACE_DIR)
+    # check the plan before spending time on downloads
+    plan = run_plan.load_run_plan(args.run_plan, set(ECOSHARD_MAP))
+    planned_run_list = run_plan.expand_run_plan(plan)
+
     task_graph = taskgraph.TaskGraph(
         WORKSPACE_DIR, multiprocessing.cpu_count(), 15.0,
         parallel_mode='process', taskgraph_name='run pipeline main')
@@ -1093,7 +3596,8 @@ def main():
         target_path_list=[WATERSHED_SUBSET_TOKEN_PATH],
         store_result=True,
         task_name='watershed subset batch')
-    watershed_subset_list = watershed_subset_task.get()
+    watershed_subset_list = run_plan.unique_watershed_paths(
+        watershed_subset_task.get())
 
     task_graph.join()
 
@@ -1117,47 +3621,95 @@ def main():
             WORKSPACE_DIR, 'global_modified_load_n.tif'),
     }
 
-    run_sdr = True
-    run_ndr = True
+    # also keeps the baseline outputs around to calculate deltas against
     keep_intermediate_files = True
+
+    global_pixel_count = int(
+        (GLOBAL_BB[2]-GLOBAL_BB[0]) / GLOBAL_PIXEL_SIZE_DEG *
+        (GLOBAL_BB[3]-GLOBAL_BB[1]) / GLOBAL_PIXEL_SIZE_DEG)
+    cost_estimate = run_plan.estimate_run_plan_cost(
+        planned_run_list, watershed_subset_list, plan['cost_model'],
+        global_output_bytes_per_run={
+            run_plan.SDR: len(sdr_target_stitch_raster_map) * (
+                global_pixel_count * 4),
+            run_plan.NDR: len(ndr_target_stitch_raster_map) * (
+                global_pixel_count * 4),
+        },
+        keep_intermediate_files=keep_intermediate_files,
+        n_workers=multiprocessing.cpu_count(),
+        workspace_byte_budget=WORKSPACE_BYTE_BUDGET)
+    cost_message = run_plan.format_cost_estimate(
+        planned_run_list, cost_estimate)
+    LOGGER.info(f'running {args.run_plan}:\n{cost_message}')
+    print(f'{args.run_plan}:\n{cost_message}', flush=True)
+    if args.preview:
+        task_graph.close()
+        if log_listener is not None:
+            task_graph.join()
+            log_listener.stop()
+        return
+
     dem_key = os.path.basename(os.path.splitext(data_map[DEM_KEY])[0])
-    sdr_run_set = set()
-    for lulc_key, biophysical_table_key, lucode, fert_key in [
-            #(ESAMOD2_LULC_KEY, None),
-            #(SC1V5RENATO_GT_0_5_LULC_KEY, None),
-            #(SC1V6RENATO_GT_0_001_LULC_KEY, None),
-            #(SC2V5GRISCOM2035_LULC_KEY, None),
-            #(SC2V6GRISCOM2050_LULC_KEY, None),
-            #(SC3V1PNVNOAG_LULC_KEY, None),
-            #(SC3V2PNVALL_LULC_KEY, None),
-            #(LULC_SC1_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_CURRENT_KEY),
-            #(LULC_SC2_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_CURRENT_KEY),
-            #(LULC_SC3_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_CURRENT_KEY),
-            #(LULC_SC1_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_INTENSIFIED_KEY),
-            #(LULC_SC2_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_INTENSIFIED_KEY),
-            #(LULC_SC1_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_2050_KEY),
-            #(LULC_SC2_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_KEY, NEW_ESA_BIOPHYSICAL_121621_TABLE_LUCODE_VALUE, FERTILIZER_2050_KEY),
-            (NLCD_COTTON_TO_83_KEY, NLCD_BIOPHYSICAL_TABLE_KEY, NLCD_LUCODE, FERTILIZER_CURRENT_KEY),
-            (BASE_NLCD_KEY, NLCD_BIOPHYSICAL_TABLE_KEY, NLCD_LUCODE, FERTILIZER_CURRENT_KEY),
-            ]:
-
-        if run_sdr:
-            sdr_workspace_dir = os.path.join(SDR_WORKSPACE_DIR, dem_key)
-            # SDR doesn't have fert scenarios
-            if lulc_key in sdr_run_set:
-                continue
-            sdr_run_set.add(lulc_key)
-            _run_sdr(
+    job_workspace_manager = workspace_manager.WorkspaceManager(
+        WORKSPACE_BYTE_BUDGET, WORKSPACE_MIN_FREE_BYTES)
+    model_workspace_dir_map = {
+        run_plan.SDR: os.path.join(SDR_WORKSPACE_DIR, dem_key),
+        run_plan.NDR: os.path.join(NDR_WORKSPACE_DIR, dem_key),
+    }
+    # the runs of a model share its workspaces, and a scenario's deltas are
+    # made against the baseline outputs in them, so a workspace isn't
+    # evicted until every planned run has used it
+    for planned_run in planned_run_list:
+        job_workspace_manager.plan_uses([
+            _job_workspace_dir(
+                model_workspace_dir_map[planned_run.model], watershed_path)
+            for watershed_path in watershed_subset_list])
+    telemetry = pipeline_telemetry.PipelineTelemetry(
+        TELEMETRY_SNAPSHOT_PATH, TELEMETRY_HTTP_PORT,
+        job_workspace_manager=job_workspace_manager)
+    telemetry.start()
+    # every scenario's jobs go in the one task graph at once, earlier
+    # scenarios first, so the jobs of the next scenario fill the cores left
+    # idle by the long tail of the previous one
+    pending_run_list = []
+    workspace_task_map = {}
+    zone_mosaic_dir = ZONE_MOSAIC_DIR if args.zone_mosaics else None
+    zone_mosaic_task_map = {}
+    baseline_runs_finished = False
+    for planned_run in planned_run_list:
+        priority_offset = -planned_run.scenario_index * len(
+            watershed_subset_list)
+        incremental_input_pair_list = None
+        if plan['incremental'] and planned_run.baseline_lulc is not None:
+            # an incremental run starts from the baseline's global outputs
+            # so those have to be done first, baseline runs are planned
+            # before any other
+            if not baseline_runs_finished:
+                LOGGER.info(
+                    f'finishing {len(pending_run_list)} baseline runs before '
+                    f'the incremental runs')
+                task_graph.join()
+                for pending_run in pending_run_list:
+                    pending_run.finish()
+                pending_run_list = []
+                baseline_runs_finished = True
+            incremental_input_pair_list = [(
+                data_map[planned_run.baseline_lulc],
+                data_map[planned_run.lulc])]
+        if planned_run.model == run_plan.SDR:
+            sdr_workspace_dir = model_workspace_dir_map[run_plan.SDR]
+            pending_run_list.append(_run_sdr(
                 task_graph=task_graph,
                 workspace_dir=sdr_workspace_dir,
                 watershed_path_list=watershed_subset_list,
                 dem_path=data_map[DEM_KEY],
                 erosivity_path=data_map[EROSIVITY_KEY],
                 erodibility_path=data_map[ERODIBILITY_KEY],
-                lulc_path=data_map[lulc_key],
+                lulc_path=data_map[planned_run.lulc],
                 target_pixel_size=TARGET_PIXEL_SIZE_M,
-                biophysical_table_path=data_map[biophysical_table_key],
-                biophysical_table_lucode_field=lucode,
+                biophysical_table_path=data_map[
+                    planned_run.biophysical_table],
+                biophysical_table_lucode_field=planned_run.lucode_field,
                 threshold_flow_accumulation=THRESHOLD_FLOW_ACCUMULATION,
                 l_cap=L_CAP,
                 k_param=K_PARAM,
@@ -1165,31 +3717,71 @@ def main():
                 ic_0_param=IC_0_PARAM,
                 target_stitch_raster_map=sdr_target_stitch_raster_map,
                 keep_intermediate_files=keep_intermediate_files,
-                result_suffix=lulc_key,
-                )
-
-        if run_ndr:
-            ndr_workspace_dir = os.path.join(NDR_WORKSPACE_DIR, dem_key)
-            if fert_key is None:
-                fert_key = FERTILZER_KEY
-            result_suffix = f'{lulc_key}_{fert_key}'
-            _run_ndr(
+                result_suffix=planned_run.result_suffix,
+                sharded_output=args.sharded_output,
+                build_shard_cogs=args.shard_cogs,
+                telemetry=telemetry,
+                aggregate_zones=True,
+                country_vector_path=data_map[WORLD_BORDERS_KEY],
+                baseline_suffix=planned_run.baseline_suffix,
+                mask_to_watersheds=True,
+                job_workspace_manager=job_workspace_manager,
+                priority_offset=priority_offset,
+                workspace_task_map=workspace_task_map,
+                wait=False,
+                incremental_input_pair_list=incremental_input_pair_list,
+                scope_table_edits=args.scope_table_edits,
+                zone_mosaic_dir=zone_mosaic_dir,
+                zone_mosaic_task_map=zone_mosaic_task_map,
+                ))
+        else:
+            ndr_workspace_dir = model_workspace_dir_map[run_plan.NDR]
+            pending_run_list.append(_run_ndr(
                 task_graph=task_graph,
                 workspace_dir=ndr_workspace_dir,
-                runoff_proxy_path=data_map[HE60PR50_PRECIP_KEY],
-                fertilizer_path=data_map[fert_key],
-                biophysical_table_path=data_map[biophysical_table_key],
-                biophysical_table_lucode_field=lucode,
+                runoff_proxy_path=data_map[planned_run.precipitation],
+                fertilizer_path=data_map[planned_run.fertilizer],
+                biophysical_table_path=data_map[
+                    planned_run.biophysical_table],
+                biophysical_table_lucode_field=planned_run.lucode_field,
                 watershed_path_list=watershed_subset_list,
                 dem_path=data_map[DEM_KEY],
-                lulc_path=data_map[lulc_key],
+                lulc_path=data_map[planned_run.lulc],
                 target_pixel_size=TARGET_PIXEL_SIZE_M,
                 threshold_flow_accumulation=THRESHOLD_FLOW_ACCUMULATION,
                 k_param=K_PARAM,
                 target_stitch_raster_map=ndr_target_stitch_raster_map,
                 keep_intermediate_files=keep_intermediate_files,
-                result_suffix=result_suffix,
-                )
+                result_suffix=planned_run.result_suffix,
+                sharded_output=args.sharded_output,
+                build_shard_cogs=args.shard_cogs,
+                telemetry=telemetry,
+                aggregate_zones=True,
+                country_vector_path=data_map[WORLD_BORDERS_KEY],
+                baseline_suffix=planned_run.baseline_suffix,
+                mask_to_watersheds=True,
+                job_workspace_manager=job_workspace_manager,
+                priority_offset=priority_offset,
+                workspace_task_map=workspace_task_map,
+                wait=False,
+                incremental_input_pair_list=incremental_input_pair_list,
+                scope_table_edits=args.scope_table_edits,
+                zone_mosaic_dir=zone_mosaic_dir,
+                zone_mosaic_task_map=zone_mosaic_task_map,
+                ))
+    LOGGER.info('wait for the jobs of every scenario to complete')
+    task_graph.join()
+    for pending_run in pending_run_list:
+        pending_run.finish()
+    telemetry.stop()
+    if args.trace:
+        n_events = pipeline_trace.merge_traces(TRACE_DIR, f'{TRACE_DIR}.json')
+        LOGGER.info(f'wrote {n_events} trace events to {TRACE_DIR}.json')
+    if log_listener is not None:
+        # the workers hold connections to the listener until they exit
+        task_graph.close()
+        task_graph.join()
+        log_listener.stop()
 
 
 def _warp_raster_stack(
@@ -1239,6 +3831,106 @@ def _warp_raster_stack(
             task_name=f'warping {warped_raster_path}')
 
 
+def _add_zone_mosaic_tasks(
+        task_graph, base_raster_path_list, resample_method_list,
+        watershed_path_list, target_pixel_size, zone_mosaic_dir,
+        zone_mosaic_task_map, priority):
+    """Schedule the zone mosaics of a run's inputs.
+
+    Args:
+        task_graph (taskgraph.TaskGraph): graph to build the mosaics in.
+        base_raster_path_list (list): global inputs in the order the job
+            function warps them.
+        resample_method_list (list): resampling of each input.
+        watershed_path_list (list): watershed subsets of the run, the
+            footprints of each zone's mosaics.
+        target_pixel_size (float): pixel size of the mosaics in meters.
+        zone_mosaic_dir (str): directory of the mosaics.
+        zone_mosaic_task_map (dict): maps a mosaic path to the task that
+            builds it, shared by runs so a mosaic they both use is built
+            once.
+        priority (int): task priority of the mosaics.
+
+    Returns:
+        dictionary mapping each watershed path to a
+        (zone_mosaic_path_list, zone_mosaic_task_list) tuple of the mosaics
+        of its zone, in the order of ``base_raster_path_list``.
+    """
+    os.makedirs(zone_mosaic_dir, exist_ok=True)
+    watershed_mosaic_map = {}
+    for projection_wkt, zone_watershed_list in \
+            zone_mosaics.zone_watershed_map(watershed_path_list).items():
+        footprint_bb_list = [bb for _, bb in zone_watershed_list]
+        zone_mosaic_path_list = []
+        zone_mosaic_task_list = []
+        for base_raster_path, resample_method in zip(
+                base_raster_path_list, resample_method_list):
+            mosaic_path = zone_mosaics.zone_mosaic_path(
+                zone_mosaic_dir, base_raster_path, resample_method,
+                projection_wkt, footprint_bb_list, target_pixel_size)
+            if mosaic_path not in zone_mosaic_task_map:
+                zone_mosaic_task_map[mosaic_path] = task_graph.add_task(
+                    func=zone_mosaics.build_zone_mosaic,
+                    args=(
+                        base_raster_path, resample_method, projection_wkt,
+                        footprint_bb_list, target_pixel_size, mosaic_path),
+                    target_path_list=[mosaic_path],
+                    transient_run=False,
+                    priority=priority,
+                    task_name=f'zone mosaic {os.path.basename(mosaic_path)}')
+            zone_mosaic_path_list.append(mosaic_path)
+            zone_mosaic_task_list.append(zone_mosaic_task_map[mosaic_path])
+        for watershed_path, _ in zone_watershed_list:
+            watershed_mosaic_map[watershed_path] = (
+                zone_mosaic_path_list, zone_mosaic_task_list)
+    return watershed_mosaic_map
+
+
+def _extract_zone_windows(
+        zone_mosaic_path_list, target_raster_path_list,
+        watershed_clip_vector_path):
+    """Cut a job's inputs out of its zone mosaics, masked to its watersheds.
+
+    Used in place of ``_warp_raster_stack`` when the inputs have zone
+    mosaics, the windows are aligned without resampling.
+
+    Args:
+        zone_mosaic_path_list (list): mosaics of the job's zone.
+        target_raster_path_list (list): path of each input's window.
+        watershed_clip_vector_path (str): watersheds of the job in the
+            projection of its zone.
+
+    Returns:
+        None
+    """
+    watershed_bb = geoprocessing.get_vector_info(
+        watershed_clip_vector_path)['bounding_box']
+    for mosaic_path, target_raster_path in zip(
+            zone_mosaic_path_list, target_raster_path_list):
+        if os.path.exists(target_raster_path) and (
+                os.path.getmtime(target_raster_path) >=
+                os.path.getmtime(mosaic_path)):
+            continue
+        unmasked_raster_path = '%s_unmasked%s' % os.path.splitext(
+            target_raster_path)
+        zone_mosaics.extract_window(
+            mosaic_path, watershed_bb, unmasked_raster_path)
+        window_raster = gdal.OpenEx(
+            unmasked_raster_path, gdal.OF_RASTER | gdal.GA_Update)
+        window_band = window_raster.GetRasterBand(1)
+        nodata = window_band.GetNoDataValue()
+        if nodata is not None:
+            window_array = window_band.ReadAsArray()
+            window_array[~_watershed_pixel_mask(
+                watershed_clip_vector_path, window_raster.GetGeoTransform(),
+                window_raster.RasterXSize, window_raster.RasterYSize,
+                window_raster.GetProjection())] = nodata
+            window_band.WriteArray(window_array)
+        window_band = None
+        window_raster = None
+        os.replace(unmasked_raster_path, target_raster_path)
+
+
 def _calculate_intersecting_bounding_box(raster_path_list):
     # create intersecting bounding box of input data
     raster_info_list = [
@@ -1257,17 +3949,24 @@ def _calculate_intersecting_bounding_box(raster_path_list):
     return target_bounding_box
 
 
-def _watersheds_intersect(wgs84_bb, watersheds_path):
-    """True if watersheds intersect the wgs84 bounding box."""
+def _watershed_wgs84_bb(watersheds_path):
+    """Bounding box of the watershed vector in lat/lng."""
     watershed_info = geoprocessing.get_vector_info(watersheds_path)
-    watershed_wgs84_bb = geoprocessing.transform_bounding_box(
+    return geoprocessing.transform_bounding_box(
         watershed_info['bounding_box'],
         watershed_info['projection_wkt'],
         osr.SRS_WKT_WGS84_LAT_LONG)
+
+
+def _watersheds_intersect(wgs84_bb, watersheds_path):
+    """True if watersheds intersect the wgs84 bounding box."""
+    watershed_wgs84_bb = _watershed_wgs84_bb(watersheds_path)
     try:
         _ = geoprocessing.merge_bounding_box_list(
             [wgs84_bb, watershed_wgs84_bb], 'intersection')
-        LOGGER.info(f'{watersheds_path} intersects {wgs84_bb} with {watershed_wgs84_bb}')
+        LOGGER.debug(
+            f'{watersheds_path} intersects {wgs84_bb} with '
+            f'{watershed_wgs84_bb}')
         return True
     except ValueError:
         LOGGER.warn(f'{watersheds_path} does not intersect {wgs84_bb}')
@@ -0,0 +1,370 @@
+"""Declarative run plans for the SDR/NDR pipeline.
+
+A run plan is a JSON file naming the data map keys of each scenario:
+
+    {
+        "run_sdr": true,
+        "run_ndr": true,
+        "baseline": "nlcd2016",
+        "defaults": {
+            "biophysical_table": "nlcd_biophysical",
+            "lucode_field": "lulc",
+            "fertilizer": "fertilizer_current",
+            "precipitation": "he60pr50"
+        },
+        "scenarios": [
+            {"lulc": "nlcd2016"},
+            {"lulc": "nlcd2016_cotton_to_83"},
+            {"lulc": "nlcd2016", "fertilizer": "fertilizer_2050"}
+        ]
+    }
+
+``defaults`` fill in whatever a scenario leaves out. ``expand_run_plan``
+turns the scenarios into model runs and drops work they share: the SDR
+run of scenarios that only differ in fertilizer or precipitation is run
+once. Runs of a model share one workspace per watershed subset, so the
+warped inputs and routing of a watershed are reused by each scenario
+rather than redone, see ``_run_sdr(workspace_task_map=...)``. A
+``baseline`` land cover's runs are put first and the other scenarios are
+stitched as deltas against the baseline run with the same fertilizer and
+precipitation. With ``"incremental": true`` those scenarios only rerun the
+watersheds where their land cover differs from the baseline's and start
+their global outputs from the baseline's, see ``change_detection``. The
+baseline runs then have to finish before the other scenarios start, and a
+scenario that differs from its baseline in more than land cover, such as
+its biophysical table, is run in full.
+
+``estimate_run_plan_cost`` gives a rough CPU-hour, disk and I/O budget of
+the expanded runs from the areas of the watershed subsets.
+"""
+import collections
+import json
+import logging
+import os
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+SDR = 'sdr'
+NDR = 'ndr'
+
+SCENARIO_FIELD_LIST = [
+    'lulc', 'biophysical_table', 'lucode_field', 'fertilizer',
+    'precipitation']
+# fields that name data map entries rather than table columns
+_DATA_KEY_FIELD_LIST = [
+    'lulc', 'biophysical_table', 'fertilizer', 'precipitation']
+# scenario fields that change the results of each model
+_MODEL_FIELD_MAP = {
+    SDR: ['lulc', 'biophysical_table', 'lucode_field'],
+    NDR: SCENARIO_FIELD_LIST,
+}
+
+# rough rates to preview a plan with, override them in a plan's
+# "cost_model" once a run's telemetry gives better ones
+DEFAULT_COST_MODEL = {
+    # CPU seconds of a job regardless of its size
+    'job_overhead_cpu_s': 60,
+    # CPU seconds of a job per square degree of watersheds
+    'sdr_cpu_s_per_deg2': 900,
+    'ndr_cpu_s_per_deg2': 1500,
+    # peak workspace bytes of a job per square degree of watersheds
+    'workspace_bytes_per_deg2': 2 * 2**30,
+    # bytes read and written by a job per square degree of watersheds
+    'io_bytes_per_deg2': 8 * 2**30,
+}
+
+# area in square degrees is in the name of each watershed subset
+_WATERSHED_AREA_PATTERN = re.compile(r'_a(\d+(?:\.\d*)?)\.gpkg$')
+
+PlannedRun = collections.namedtuple(
+    'PlannedRun', [
+        'model', 'scenario_index', 'result_suffix', 'lulc',
+        'biophysical_table', 'lucode_field', 'fertilizer', 'precipitation',
+        'baseline_suffix', 'baseline_lulc'])
+
+
+def load_run_plan(run_plan_path, data_key_set=None):
+    """Load and check a run plan.
+
+    Args:
+        run_plan_path (str): path to a run plan JSON file.
+        data_key_set (set): if not None, every data map key the plan names
+            must be in this set.
+
+    Returns:
+        plan dictionary with every scenario's fields filled in from
+        ``defaults``.
+
+    Raises:
+        ValueError if a scenario is missing a field or names an unknown
+        data map key.
+    """
+    with open(run_plan_path, 'r') as run_plan_file:
+        run_plan = json.load(run_plan_file)
+    defaults = run_plan.get('defaults', {})
+    scenario_list = []
+    error_list = []
+    for scenario_index, scenario in enumerate(run_plan['scenarios']):
+        scenario = dict(defaults, **scenario)
+        unknown_field_list = sorted(set(scenario) - set(SCENARIO_FIELD_LIST))
+        if unknown_field_list:
+            error_list.append(
+                f'scenario {scenario_index} has unknown fields '
+                f'{unknown_field_list}')
+        for field in SCENARIO_FIELD_LIST:
+            if field not in scenario:
+                error_list.append(
+                    f'scenario {scenario_index} has no "{field}"')
+            elif (data_key_set is not None and
+                    field in _DATA_KEY_FIELD_LIST and
+                    scenario[field] not in data_key_set):
+                error_list.append(
+                    f'scenario {scenario_index} "{field}" is '
+                    f'"{scenario[field]}" which is not in the data map')
+        scenario_list.append(scenario)
+    baseline = run_plan.get('baseline')
+    if baseline is not None and baseline not in [
+            scenario.get('lulc') for scenario in scenario_list]:
+        error_list.append(f'baseline "{baseline}" is not a scenario lulc')
+    if error_list:
+        raise ValueError(
+            f'errors in run plan {run_plan_path}:\n' + '\n'.join(error_list))
+    run_plan['scenarios'] = scenario_list
+    run_plan.setdefault('run_sdr', True)
+    run_plan.setdefault('run_ndr', True)
+    run_plan.setdefault('incremental', False)
+    run_plan['cost_model'] = dict(
+        DEFAULT_COST_MODEL, **run_plan.get('cost_model', {}))
+    return run_plan
+
+
+def _result_suffix(model, scenario, vary_precipitation):
+    """Suffix of a run's outputs, the same names the pipeline always used."""
+    if model == SDR:
+        return scenario['lulc']
+    result_suffix = f'{scenario["lulc"]}_{scenario["fertilizer"]}'
+    if vary_precipitation:
+        result_suffix += f'_{scenario["precipitation"]}'
+    return result_suffix
+
+
+def expand_run_plan(run_plan):
+    """List the model runs of a plan without repeating shared work.
+
+    Args:
+        run_plan (dict): plan returned by ``load_run_plan``.
+
+    Returns:
+        list of ``PlannedRun`` in the order to submit them, baseline
+        scenarios first. ``scenario_index`` is the position of the run's
+        scenario in that order and ``baseline_lulc`` is the land cover of
+        the run named by ``baseline_suffix`` if that's the only input they
+        differ in, otherwise ``None`` and the run can't be incremental.
+
+    Raises:
+        ValueError if two different runs of a model would write the same
+        outputs.
+    """
+    baseline = run_plan.get('baseline')
+    # stable sort so the baseline scenarios go first
+    scenario_list = sorted(
+        run_plan['scenarios'],
+        key=lambda scenario: scenario['lulc'] != baseline)
+    vary_precipitation = len(set(
+        scenario['precipitation'] for scenario in scenario_list)) > 1
+    model_list = [
+        model for model, run_model in [
+            (SDR, run_plan['run_sdr']), (NDR, run_plan['run_ndr'])]
+        if run_model]
+
+    planned_run_list = []
+    # (model, model inputs) -> result suffix of the run that makes them
+    run_input_map = {}
+    suffix_input_map = {}
+    for scenario_index, scenario in enumerate(scenario_list):
+        for model in model_list:
+            run_inputs = (model, tuple(
+                scenario[field] for field in _MODEL_FIELD_MAP[model]))
+            result_suffix = _result_suffix(
+                model, scenario, vary_precipitation)
+            if run_inputs in run_input_map:
+                LOGGER.info(
+                    f'scenario {scenario_index} shares the {model} run '
+                    f'{run_input_map[run_inputs]}')
+                continue
+            if (model, result_suffix) in suffix_input_map:
+                raise ValueError(
+                    f'{model} scenarios '
+                    f'{suffix_input_map[(model, result_suffix)]} and '
+                    f'{run_inputs[1]} would both write {result_suffix}')
+            run_input_map[run_inputs] = result_suffix
+            suffix_input_map[(model, result_suffix)] = run_inputs[1]
+            baseline_suffix = None
+            baseline_lulc = None
+            if baseline is not None and scenario['lulc'] != baseline:
+                baseline_suffix = _result_suffix(
+                    model, dict(scenario, lulc=baseline), vary_precipitation)
+                if (model, baseline_suffix) not in suffix_input_map:
+                    LOGGER.warning(
+                        f'no {model} baseline run {baseline_suffix} for '
+                        f'{result_suffix} so not stitching deltas')
+                    baseline_suffix = None
+                else:
+                    differing_field_list = [
+                        field for field, baseline_value in zip(
+                            _MODEL_FIELD_MAP[model],
+                            suffix_input_map[(model, baseline_suffix)])
+                        if field != 'lulc' and
+                        scenario[field] != baseline_value]
+                    if differing_field_list:
+                        LOGGER.info(
+                            f'{model} {result_suffix} differs from its '
+                            f'baseline {baseline_suffix} in '
+                            f'{differing_field_list} so it can\'t be run '
+                            f'incrementally')
+                    else:
+                        baseline_lulc = baseline
+            planned_run_list.append(PlannedRun(
+                model, scenario_index, result_suffix, scenario['lulc'],
+                scenario['biophysical_table'], scenario['lucode_field'],
+                scenario['fertilizer'], scenario['precipitation'],
+                baseline_suffix, baseline_lulc))
+    return planned_run_list
+
+
+def unique_watershed_paths(watershed_path_list):
+    """Watershed subset paths in order without repeats of the same file."""
+    seen_path_set = set()
+    unique_path_list = []
+    for watershed_path in watershed_path_list:
+        real_path = os.path.realpath(watershed_path)
+        if real_path in seen_path_set:
+            continue
+        seen_path_set.add(real_path)
+        unique_path_list.append(watershed_path)
+    return unique_path_list
+
+
+def watershed_area_deg2(watershed_path):
+    """Square degrees of a watershed subset, from its ``_a<area>`` name."""
+    match = _WATERSHED_AREA_PATTERN.search(os.path.basename(watershed_path))
+    if match is None:
+        return 0.0
+    return float(match.group(1))
+
+
+def estimate_run_plan_cost(
+        planned_run_list, watershed_path_list, cost_model,
+        global_output_bytes_per_run=None, keep_intermediate_files=False,
+        n_workers=None, workspace_byte_budget=None):
+    """Rough CPU, disk and I/O budget of a set of planned runs.
+
+    Args:
+        planned_run_list (list): ``PlannedRun`` list of an expanded plan.
+        watershed_path_list (list): watershed subsets each run is over.
+        cost_model (dict): rates, see ``DEFAULT_COST_MODEL``.
+        global_output_bytes_per_run (dict): maps a model to the bytes of
+            the uncompressed global outputs of one of its runs, runs with
+            a baseline write as much again in deltas.
+        keep_intermediate_files (bool): if True, job workspaces are kept so
+            the disk budget includes every one of them.
+        n_workers (int): if not None, the wall hours at full use of this
+            many cores are included.
+        workspace_byte_budget (int): if not None, the
+            ``WorkspaceManager`` budget of the run. Kept workspaces past it
+            are evicted, so the disk estimate is capped at it, but not
+            below the workspaces pinned for a model's later runs.
+
+    Returns:
+        dictionary of the estimate, see ``format_cost_estimate``.
+    """
+    area_list = [watershed_area_deg2(path) for path in watershed_path_list]
+    total_area = sum(area_list)
+    n_jobs = len(area_list)
+    model_run_count = collections.Counter(
+        planned_run.model for planned_run in planned_run_list)
+    cpu_s = 0.0
+    io_bytes = 0.0
+    kept_workspace_bytes = 0.0
+    pinned_workspace_bytes = 0.0
+    for model, n_runs in model_run_count.items():
+        cpu_s += n_runs * (
+            n_jobs * cost_model['job_overhead_cpu_s'] +
+            total_area * cost_model[f'{model}_cpu_s_per_deg2'])
+        io_bytes += n_runs * total_area * cost_model['io_bytes_per_deg2']
+        # runs of a model share a workspace per watershed subset, pinned
+        # until the last of them has used it
+        model_workspace_bytes = (
+            total_area * cost_model['workspace_bytes_per_deg2'])
+        if n_runs > 1:
+            pinned_workspace_bytes += model_workspace_bytes
+        elif keep_intermediate_files:
+            kept_workspace_bytes += model_workspace_bytes
+    workspace_bytes = max(
+        kept_workspace_bytes + pinned_workspace_bytes,
+        max(area_list, default=0) * cost_model['workspace_bytes_per_deg2'])
+    output_bytes = sum(
+        (global_output_bytes_per_run or {}).get(planned_run.model, 0) * (
+            2 if planned_run.baseline_suffix else 1)
+        for planned_run in planned_run_list)
+    cost_estimate = {
+        'runs': dict(model_run_count),
+        'jobs': n_jobs * sum(model_run_count.values()),
+        'watershed_area_deg2': round(total_area, 3),
+        'cpu_hours': round(cpu_s / 3600, 1),
+        'workspace_bytes': int(workspace_bytes),
+        'global_output_bytes': int(output_bytes),
+        'io_bytes': int(io_bytes + output_bytes),
+    }
+    if workspace_byte_budget is not None and (
+            workspace_bytes > workspace_byte_budget):
+        cost_estimate['workspace_bytes'] = int(
+            max(workspace_byte_budget, pinned_workspace_bytes))
+        cost_estimate['workspace_bytes_unbounded'] = int(workspace_bytes)
+        cost_estimate['workspace_byte_budget'] = int(workspace_byte_budget)
+    if n_workers:
+        cost_estimate['wall_hours'] = round(cpu_s / 3600 / n_workers, 1)
+    return cost_estimate
+
+
+def _format_bytes(n_bytes):
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if n_bytes < 1024 or unit == 'TiB':
+            return f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1024
+
+
+def format_cost_estimate(planned_run_list, cost_estimate):
+    """Human readable lines of a plan's runs and their estimated cost."""
+    line_list = [
+        f'{planned_run.model} {planned_run.result_suffix}' + (
+            f' (deltas vs {planned_run.baseline_suffix})'
+            if planned_run.baseline_suffix else '')
+        for planned_run in planned_run_list]
+    line_list += [
+        f'{cost_estimate["jobs"]} jobs over '
+        f'{cost_estimate["watershed_area_deg2"]} square degrees of '
+        f'watersheds',
+        f'CPU: {cost_estimate["cpu_hours"]} core hours' + (
+            f', {cost_estimate["wall_hours"]} wall hours'
+            if 'wall_hours' in cost_estimate else ''),
+        f'disk: {_format_bytes(cost_estimate["workspace_bytes"])} of job '
+        f'workspaces, {_format_bytes(cost_estimate["global_output_bytes"])}'
+        f' of global outputs',
+        f'I/O: {_format_bytes(cost_estimate["io_bytes"])}',
+    ]
+    if 'workspace_bytes_unbounded' in cost_estimate:
+        line_list.append(
+            f'warning: the job workspaces would use '
+            f'{_format_bytes(cost_estimate["workspace_bytes_unbounded"])}, '
+            f'over the budget of '
+            f'{_format_bytes(cost_estimate["workspace_byte_budget"])}, so '
+            f'workspaces are evicted and a later run recomputes them')
+        if (cost_estimate['workspace_bytes'] >
+                cost_estimate['workspace_byte_budget']):
+            line_list.append(
+                'warning: the workspaces shared by the runs of a model '
+                'aren\'t evicted until its last run, so they alone go over '
+                'the budget')
+    return '\n'.join(line_list)
@@ -0,0 +1,362 @@
+"""Disk budget for the job workspaces of a pipeline run.
+
+Every job writes its intermediate rasters to its own workspace directory,
+which is removed, or kept for later runs, once its results are stitched. A
+``WorkspaceManager`` tracks the bytes those directories use:
+
+    workspace_manager.admit(job_dir)  # before the job is scheduled
+    workspace_manager.release(job_dir, keep)  # once the job is stitched
+
+``admit`` blocks while the live workspaces plus the expected size of a new
+one don't fit in the budget or on the disk, so a run waits for the stitcher
+instead of filling the disk. Kept workspaces are evicted least recently
+used first to make room. A workspace is only evictable after it's been
+released, so one that hasn't been stitched yet is never removed.
+
+Runs that share workspaces, such as a baseline and the scenarios that
+make deltas against its outputs, declare their later uses up front:
+
+    workspace_manager.plan_uses(job_dir_list)  # once per planned run
+
+A released workspace with planned uses left is pinned rather than kept, it
+counts against the budget but isn't evicted until its last planned use is
+released or cancelled with ``cancel_planned_uses``.
+
+A stitched workspace is only released once its data are on disk, so a
+stitcher holding them in cached tiles can keep a waiting ``admit`` from
+ever proceeding. Callbacks added with ``add_flush_callback`` are called
+when ``admit`` starts to wait and every ``poll_interval_s`` after, to ask
+the stitchers to write what they hold.
+"""
+import collections
+import logging
+import os
+import shutil
+import threading
+import time
+
+import pipeline_trace
+
+LOGGER = logging.getLogger(__name__)
+
+
+def dir_size(dir_path):
+    """Bytes used by the files under ``dir_path``."""
+    total_bytes = 0
+    for root_dir, _, file_list in os.walk(dir_path):
+        for filename in file_list:
+            try:
+                total_bytes += os.path.getsize(
+                    os.path.join(root_dir, filename))
+            except OSError:
+                # removed while walking
+                pass
+    return total_bytes
+
+
+class WorkspaceManager:
+    """Admit jobs and evict kept workspaces to stay within a byte budget."""
+
+    def __init__(
+            self, byte_budget, min_free_bytes=0,
+            default_workspace_bytes=2**30, poll_interval_s=60.0):
+        """Create a manager with no workspaces.
+
+        Args:
+            byte_budget (int): bytes the live and kept workspaces may use.
+            min_free_bytes (int): don't admit a job unless the disk of its
+                workspace has this many bytes free after the job's expected
+                size.
+            default_workspace_bytes (int): expected size of a workspace
+                until some have been released and measured.
+            poll_interval_s (float): seconds between re-measuring the live
+                workspaces while a job waits to be admitted.
+        """
+        self.byte_budget = byte_budget
+        self.min_free_bytes = min_free_bytes
+        self.poll_interval_s = poll_interval_s
+        self._default_workspace_bytes = default_workspace_bytes
+        # workspace dir -> number of admitted jobs not yet released, a
+        # workspace is shared by the outputs of every scenario
+        self._live_count = collections.Counter()
+        # workspace dir -> measured bytes of live workspaces
+        self._live_bytes = {}
+        # workspace dir -> bytes of kept workspaces, least recent first
+        self._kept_bytes = collections.OrderedDict()
+        # workspace dir -> admissions planned and not yet released
+        self._planned_count = collections.Counter()
+        # workspace dir -> (bytes, keep) of released workspaces that have
+        # planned uses left, ``keep`` is of their last release
+        self._pinned_map = {}
+        self._n_released = 0
+        self._released_bytes = 0
+        self.n_evicted = 0
+        self.evicted_bytes = 0
+        self._flush_callback_list = []
+        self._condition = threading.Condition()
+
+    def add_flush_callback(self, callback):
+        """Call ``callback()`` whenever a job waits to be admitted.
+
+        ``callback`` is called with the manager's lock held, so it must
+        not block or call back into the manager.
+        """
+        with self._condition:
+            self._flush_callback_list.append(callback)
+
+    def remove_flush_callback(self, callback):
+        """Stop calling a callback added with ``add_flush_callback``."""
+        with self._condition:
+            self._flush_callback_list.remove(callback)
+
+    def expected_workspace_bytes(self):
+        """Mean size of the released workspaces, or the default."""
+        if self._n_released == 0:
+            return self._default_workspace_bytes
+        return self._released_bytes // self._n_released
+
+    def _live_reserved_bytes(self):
+        """Bytes the live workspaces use or are expected to grow to."""
+        expected_bytes = self.expected_workspace_bytes()
+        return sum(
+            max(self._live_bytes.get(workspace_dir, 0), expected_bytes)
+            for workspace_dir in self._live_count)
+
+    def _pinned_bytes(self):
+        return sum(
+            pinned_bytes for pinned_bytes, _ in self._pinned_map.values())
+
+    def used_bytes(self):
+        """Bytes reserved by live workspaces plus the pinned and kept ones."""
+        with self._condition:
+            return (
+                self._live_reserved_bytes() + self._pinned_bytes() +
+                sum(self._kept_bytes.values()))
+
+    def _measure_live(self):
+        for workspace_dir in self._live_count:
+            self._live_bytes[workspace_dir] = dir_size(workspace_dir)
+
+    def _evict_oldest(self):
+        """Remove the least recently used kept workspace."""
+        workspace_dir, workspace_bytes = self._kept_bytes.popitem(last=False)
+        LOGGER.info(
+            f'evicting {workspace_dir} to free {workspace_bytes} bytes')
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+        self.n_evicted += 1
+        self.evicted_bytes += workspace_bytes
+
+    def _evict(self, target_bytes):
+        """Remove kept workspaces until the total is ``target_bytes``."""
+        unevictable_bytes = self._live_reserved_bytes() + self._pinned_bytes()
+        while self._kept_bytes and (
+                unevictable_bytes + sum(self._kept_bytes.values()) >
+                target_bytes):
+            self._evict_oldest()
+
+    def _disk_has_room(self, workspace_dir, expected_bytes):
+        """True if the disk fits a new workspace of ``expected_bytes``."""
+        disk_path = workspace_dir
+        while not os.path.exists(disk_path):
+            disk_path = os.path.dirname(os.path.abspath(disk_path))
+        free_bytes = shutil.disk_usage(disk_path).free
+        live_growth_bytes = sum(
+            max(0, expected_bytes - self._live_bytes.get(live_dir, 0))
+            for live_dir in self._live_count)
+        return (
+            free_bytes - live_growth_bytes - expected_bytes >=
+            self.min_free_bytes)
+
+    def add_existing(self, workspace_dir_list):
+        """Track workspaces kept by an earlier run as evictable.
+
+        Args:
+            workspace_dir_list (list): job workspace directories, the ones
+                that exist and aren't tracked are added oldest first by
+                modification time, pinned if they have planned uses.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            existing_dir_list = [
+                workspace_dir for workspace_dir in workspace_dir_list
+                if workspace_dir not in self._live_count and
+                workspace_dir not in self._kept_bytes and
+                workspace_dir not in self._pinned_map and
+                os.path.isdir(workspace_dir)]
+            for workspace_dir in sorted(
+                    existing_dir_list, key=os.path.getmtime):
+                if self._planned_count[workspace_dir] > 0:
+                    self._pinned_map[workspace_dir] = (
+                        dir_size(workspace_dir), True)
+                else:
+                    self._kept_bytes[workspace_dir] = dir_size(workspace_dir)
+            self._evict(self.byte_budget)
+
+    def plan_uses(self, workspace_dir_list):
+        """Record that a job will be admitted to each directory later.
+
+        A workspace isn't evicted while it has planned uses, so call this
+        for every run before the first job is admitted. Each planned use
+        ends with the ``release`` of its job or ``cancel_planned_uses``.
+
+        Args:
+            workspace_dir_list (list): job workspace directories of a run.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            self._planned_count.update(workspace_dir_list)
+
+    def cancel_planned_uses(self, workspace_dir_list):
+        """End planned uses that won't be admitted, e.g. filtered jobs.
+
+        Args:
+            workspace_dir_list (list): job workspace directories passed to
+                ``plan_uses`` whose jobs won't run, directories without
+                planned uses are ignored.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            for workspace_dir in workspace_dir_list:
+                self._end_planned_use(workspace_dir)
+            self._evict(self.byte_budget)
+            self._condition.notify_all()
+
+    def _end_planned_use(self, workspace_dir):
+        """Count down a planned use, unpin the workspace after its last."""
+        if self._planned_count[workspace_dir] <= 0:
+            return
+        self._planned_count[workspace_dir] -= 1
+        if self._planned_count[workspace_dir] > 0:
+            return
+        del self._planned_count[workspace_dir]
+        if workspace_dir not in self._pinned_map:
+            return
+        workspace_bytes, keep = self._pinned_map.pop(workspace_dir)
+        if keep and os.path.isdir(workspace_dir):
+            self._kept_bytes[workspace_dir] = workspace_bytes
+        else:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+
+    def admit(self, workspace_dir):
+        """Block until there's room for a job in ``workspace_dir``.
+
+        Kept workspaces are evicted first, then this waits for live
+        workspaces to be released, calling the flush callbacks while it
+        waits. A kept ``workspace_dir`` becomes live
+        again so it's not evicted while the job uses it.
+
+        Args:
+            workspace_dir (str): workspace directory of the job.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            if self._live_count[workspace_dir] > 0:
+                self._live_count[workspace_dir] += 1
+                return
+            kept_bytes = self._kept_bytes.pop(workspace_dir, None)
+            if workspace_dir in self._pinned_map:
+                kept_bytes, _ = self._pinned_map.pop(workspace_dir)
+            expected_bytes = max(
+                kept_bytes or 0, self.expected_workspace_bytes())
+            self._evict(self.byte_budget - expected_bytes)
+            waited = False
+            flush_due = True
+            start_time = time.time()
+            # with nothing live nothing will finish to make room, so go
+            while self._live_count:
+                if (self._live_reserved_bytes() + expected_bytes <=
+                        self.byte_budget):
+                    if self._disk_has_room(workspace_dir, expected_bytes):
+                        break
+                    if self._kept_bytes:
+                        # the disk is full of something else
+                        self._evict_oldest()
+                        continue
+                if not waited:
+                    LOGGER.info(
+                        f'waiting for room to admit {workspace_dir}, '
+                        f'{len(self._live_count)} live workspaces use '
+                        f'{self._live_reserved_bytes()} bytes of '
+                        f'{self.byte_budget}')
+                    waited = True
+                if flush_due:
+                    for callback in self._flush_callback_list:
+                        callback()
+                # flush again if nothing was released for a whole interval
+                flush_due = not self._condition.wait(self.poll_interval_s)
+                self._measure_live()
+                self._evict(self.byte_budget - expected_bytes)
+            self._live_count[workspace_dir] += 1
+            self._live_bytes[workspace_dir] = kept_bytes or 0
+        pipeline_trace.instant(
+            'workspace admitted', category='schedule',
+            job=os.path.basename(workspace_dir),
+            waited_s=time.time()-start_time)
+
+    def release(self, workspace_dir, keep):
+        """Record that a job in ``workspace_dir`` has been stitched.
+
+        Ends one of the workspace's planned uses, if it has any.
+
+        Args:
+            workspace_dir (str): workspace directory passed to ``admit``.
+            keep (bool): if True the workspace is kept, and evicted when
+                the budget needs the room, otherwise it's removed once no
+                other admitted or planned job uses it.
+
+        Returns:
+            None
+        """
+        with self._condition:
+            if self._live_count[workspace_dir] > 1:
+                self._live_count[workspace_dir] -= 1
+                self._end_planned_use(workspace_dir)
+                return
+            del self._live_count[workspace_dir]
+            self._live_bytes.pop(workspace_dir, None)
+            workspace_bytes = dir_size(workspace_dir)
+            if workspace_bytes > 0:
+                self._n_released += 1
+                self._released_bytes += workspace_bytes
+            if self._planned_count[workspace_dir] > 1:
+                # a later run still needs it, e.g. for the baseline outputs
+                # its deltas are made against
+                self._planned_count[workspace_dir] -= 1
+                self._pinned_map[workspace_dir] = (workspace_bytes, keep)
+            else:
+                self._end_planned_use(workspace_dir)
+                if keep and os.path.isdir(workspace_dir):
+                    self._kept_bytes[workspace_dir] = workspace_bytes
+                    self._evict(self.byte_budget)
+                else:
+                    shutil.rmtree(workspace_dir, ignore_errors=True)
+            self._condition.notify_all()
+
+    def live_workspaces(self):
+        """Directories of the workspaces admitted and not yet released."""
+        with self._condition:
+            return list(self._live_count)
+
+    def snapshot(self):
+        """Dictionary of the current state of the workspaces."""
+        with self._condition:
+            return {
+                'byte_budget': self.byte_budget,
+                'live_workspaces': len(self._live_count),
+                'live_reserved_bytes': self._live_reserved_bytes(),
+                'pinned_workspaces': len(self._pinned_map),
+                'pinned_bytes': self._pinned_bytes(),
+                'kept_workspaces': len(self._kept_bytes),
+                'kept_bytes': sum(self._kept_bytes.values()),
+                'expected_workspace_bytes': self.expected_workspace_bytes(),
+                'evicted_workspaces': self.n_evicted,
+                'evicted_bytes': self.evicted_bytes,
+            }
@@ -0,0 +1,246 @@
+"""Per UTM zone mosaics of the global inputs of the SDR/NDR jobs.
+
+Every job reprojects the global lat/lng inputs into the UTM zone of its
+watersheds, and the thousands of jobs in a zone redo overlapping warps of
+the same source pixels. A zone mosaic is the warp of one input onto a grid
+in the zone's projection, done once:
+
+    zone_map = zone_watershed_map(watershed_path_list)
+    build_zone_mosaic(
+        dem_path, 'bilinear', projection_wkt, footprint_bb_list, 300,
+        mosaic_path)
+    extract_window(mosaic_path, watershed_bb, target_path)
+
+The grid of every mosaic of a zone is snapped to multiples of the pixel
+size, so the window of a watershed is the same in each input's mosaic and
+is cut out with no resampling. Only the footprints of the zone's
+watersheds are warped, the rest of the tiled GeoTIFF is left sparse, and
+each footprint is warped in windows of ``WARP_WINDOW_SIZE`` pixels so a
+build's memory doesn't depend on the size of the zone.
+``zone_mosaic_path`` names a mosaic by a hash of its input and footprints
+so a build interrupted or made from other inputs is never reused.
+"""
+import collections
+import hashlib
+import logging
+import os
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+from osgeo import osr
+import numpy
+
+import pipeline_trace
+
+LOGGER = logging.getLogger(__name__)
+
+ZONE_MOSAIC_CREATION_OPTIONS = (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'SPARSE_OK=TRUE',
+    'BLOCKXSIZE=256', 'BLOCKYSIZE=256')
+WINDOW_CREATION_OPTIONS = (
+    'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW', 'BLOCKXSIZE=256',
+    'BLOCKYSIZE=256')
+# rows and columns of the windows a footprint is warped in, a multiple of
+# the mosaic's block size
+WARP_WINDOW_SIZE = 2048
+
+
+def zone_watershed_map(watershed_path_list):
+    """Group watershed subsets by the UTM zone they're projected in.
+
+    Args:
+        watershed_path_list (list): paths to watershed subset vectors, each
+            in the projection of its zone.
+
+    Returns:
+        dictionary mapping a zone's projection wkt to the list of
+        (watershed_path, bounding_box) of its watersheds, in the zone's
+        projected coordinates.
+    """
+    zone_map = collections.defaultdict(list)
+    for watershed_path in watershed_path_list:
+        watershed_info = geoprocessing.get_vector_info(watershed_path)
+        zone_map[watershed_info['projection_wkt']].append(
+            (watershed_path, watershed_info['bounding_box']))
+    return dict(zone_map)
+
+
+def zone_name(projection_wkt):
+    """``epsg<code>`` of a zone, or a digest if it has no EPSG code."""
+    zone_srs = osr.SpatialReference()
+    zone_srs.ImportFromWkt(projection_wkt)
+    epsg = zone_srs.GetAuthorityCode(None)
+    if epsg is not None:
+        return f'epsg{epsg}'
+    return 'zone' + hashlib.blake2b(
+        projection_wkt.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def snap_bounding_box(bounding_box, pixel_size):
+    """Grow ``bounding_box`` out to the nearest multiples of ``pixel_size``."""
+    return [
+        float(numpy.floor(bounding_box[0]/pixel_size)*pixel_size),
+        float(numpy.floor(bounding_box[1]/pixel_size)*pixel_size),
+        float(numpy.ceil(bounding_box[2]/pixel_size)*pixel_size),
+        float(numpy.ceil(bounding_box[3]/pixel_size)*pixel_size)]
+
+
+def zone_mosaic_path(
+        mosaic_dir, base_raster_path, resample_method, projection_wkt,
+        footprint_bb_list, pixel_size):
+    """Path of the zone mosaic of an input.
+
+    The name has the input's basename, the zone and a digest of the input's
+    path, size and modification time, the resampling, the pixel size and
+    the footprints, so any change to them names a new mosaic.
+
+    Returns:
+        path to a GeoTIFF in ``mosaic_dir``.
+    """
+    base_stat = os.stat(base_raster_path)
+    mosaic_key = hashlib.blake2b(
+        repr([
+            os.path.abspath(base_raster_path), base_stat.st_size,
+            base_stat.st_mtime_ns, resample_method, projection_wkt,
+            sorted(footprint_bb_list), pixel_size]).encode('utf-8'),
+        digest_size=8).hexdigest()
+    return os.path.join(
+        mosaic_dir,
+        f'{os.path.basename(os.path.splitext(base_raster_path)[0])}_'
+        f'{zone_name(projection_wkt)}_{mosaic_key}.tif')
+
+
+def _merge_overlapping(bb_list):
+    """Union bounding boxes that overlap so no pixel is warped twice."""
+    merged_bb_list = []
+    for bb in sorted(bb_list):
+        bb = list(bb)
+        overlap_found = True
+        while overlap_found:
+            overlap_found = False
+            for merged_bb in merged_bb_list:
+                if (merged_bb[0] < bb[2] and bb[0] < merged_bb[2] and
+                        merged_bb[1] < bb[3] and bb[1] < merged_bb[3]):
+                    merged_bb_list.remove(merged_bb)
+                    bb = [
+                        min(bb[0], merged_bb[0]), min(bb[1], merged_bb[1]),
+                        max(bb[2], merged_bb[2]), max(bb[3], merged_bb[3])]
+                    overlap_found = True
+                    break
+        merged_bb_list.append(bb)
+    return merged_bb_list
+
+
+@pipeline_trace.traced(
+    'build zone mosaic', lambda args: {
+        'input': os.path.basename(args['base_raster_path']),
+        'zone': zone_name(args['projection_wkt'])},
+    category='warp')
+def build_zone_mosaic(
+        base_raster_path, resample_method, projection_wkt, footprint_bb_list,
+        pixel_size, target_mosaic_path):
+    """Warp the footprints of a zone's watersheds out of a global input.
+
+    Args:
+        base_raster_path (str): path to a single band global input.
+        resample_method (str): GDAL resampling of the warp.
+        projection_wkt (str): projection of the zone.
+        footprint_bb_list (list): bounding boxes of the zone's watersheds
+            in ``projection_wkt``.
+        pixel_size (float): pixel size of the mosaic in projected units.
+        target_mosaic_path (str): path to the tiled GeoTIFF to create, it's
+            only moved into place once it's complete.
+
+    Returns:
+        None
+    """
+    base_info = geoprocessing.get_raster_info(base_raster_path)
+    nodata = base_info['nodata'][0]
+    mosaic_bb = snap_bounding_box(
+        geoprocessing.merge_bounding_box_list(footprint_bb_list, 'union'),
+        pixel_size)
+    n_cols = int(round((mosaic_bb[2]-mosaic_bb[0])/pixel_size))
+    n_rows = int(round((mosaic_bb[3]-mosaic_bb[1])/pixel_size))
+    LOGGER.info(
+        f'building {n_cols} by {n_rows} zone mosaic {target_mosaic_path}')
+    working_mosaic_path = '%s_working%s' % os.path.splitext(
+        target_mosaic_path)
+    mosaic_raster = gdal.GetDriverByName('GTiff').Create(
+        working_mosaic_path, n_cols, n_rows, 1, base_info['datatype'],
+        options=ZONE_MOSAIC_CREATION_OPTIONS)
+    mosaic_raster.SetProjection(projection_wkt)
+    mosaic_raster.SetGeoTransform(
+        [mosaic_bb[0], pixel_size, 0, mosaic_bb[3], 0, -pixel_size])
+    mosaic_band = mosaic_raster.GetRasterBand(1)
+    if nodata is not None:
+        mosaic_band.SetNoDataValue(nodata)
+
+    for footprint_bb in _merge_overlapping(
+            [snap_bounding_box(bb, pixel_size) for bb in footprint_bb_list]):
+        footprint_xoff = int(round((footprint_bb[0]-mosaic_bb[0])/pixel_size))
+        footprint_yoff = int(round((mosaic_bb[3]-footprint_bb[3])/pixel_size))
+        footprint_xend = int(round((footprint_bb[2]-mosaic_bb[0])/pixel_size))
+        footprint_yend = int(round((mosaic_bb[3]-footprint_bb[1])/pixel_size))
+        # warp the footprint a window at a time so the memory of a task
+        # doesn't grow with the footprint, windows line up with the
+        # mosaic's blocks so no compressed block is written twice
+        for yoff in range(
+                footprint_yoff - footprint_yoff % WARP_WINDOW_SIZE,
+                footprint_yend, WARP_WINDOW_SIZE):
+            win_yoff = max(yoff, footprint_yoff)
+            win_yend = min(yoff+WARP_WINDOW_SIZE, footprint_yend)
+            for xoff in range(
+                    footprint_xoff - footprint_xoff % WARP_WINDOW_SIZE,
+                    footprint_xend, WARP_WINDOW_SIZE):
+                win_xoff = max(xoff, footprint_xoff)
+                win_xend = min(xoff+WARP_WINDOW_SIZE, footprint_xend)
+                window_bb = [
+                    mosaic_bb[0]+win_xoff*pixel_size,
+                    mosaic_bb[3]-win_yend*pixel_size,
+                    mosaic_bb[0]+win_xend*pixel_size,
+                    mosaic_bb[3]-win_yoff*pixel_size]
+                warped_raster = gdal.Warp(
+                    '', base_raster_path, options=gdal.WarpOptions(
+                        format='MEM', outputBounds=window_bb,
+                        width=win_xend-win_xoff, height=win_yend-win_yoff,
+                        dstSRS=projection_wkt, resampleAlg=resample_method,
+                        dstNodata=nodata, multithread=True))
+                mosaic_band.WriteArray(
+                    warped_raster.GetRasterBand(1).ReadAsArray(),
+                    xoff=win_xoff, yoff=win_yoff)
+                warped_raster = None
+    mosaic_band = None
+    mosaic_raster = None
+    os.replace(working_mosaic_path, target_mosaic_path)
+
+
+def extract_window(mosaic_path, bounding_box, target_raster_path):
+    """Copy the pixels of a zone mosaic that cover ``bounding_box``.
+
+    Args:
+        mosaic_path (str): path to a mosaic from ``build_zone_mosaic``.
+        bounding_box (list): box in the mosaic's projection, grown out to
+            the mosaic's pixel grid and clipped to the mosaic.
+        target_raster_path (str): path to the GeoTIFF of the window.
+
+    Returns:
+        None
+    """
+    mosaic_info = geoprocessing.get_raster_info(mosaic_path)
+    gt = mosaic_info['geotransform']
+    n_cols, n_rows = mosaic_info['raster_size']
+    window_bb = snap_bounding_box(bounding_box, gt[1])
+    xoff = max(0, int(round((window_bb[0]-gt[0])/gt[1])))
+    yoff = max(0, int(round((window_bb[3]-gt[3])/gt[5])))
+    win_xsize = min(n_cols, int(round((window_bb[2]-gt[0])/gt[1]))) - xoff
+    win_ysize = min(n_rows, int(round((window_bb[1]-gt[3])/gt[5]))) - yoff
+    if win_xsize <= 0 or win_ysize <= 0:
+        raise ValueError(
+            f'{bounding_box} is outside of the mosaic {mosaic_path}')
+    working_raster_path = '%s_working%s' % os.path.splitext(
+        target_raster_path)
+    gdal.Translate(
+        working_raster_path, mosaic_path, options=gdal.TranslateOptions(
+            srcWin=[xoff, yoff, win_xsize, win_ysize],
+            creationOptions=WINDOW_CREATION_OPTIONS))
+    os.replace(working_raster_path, target_raster_path)